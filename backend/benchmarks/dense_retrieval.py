@@ -0,0 +1,100 @@
+"""
+Benchmark dense LSA retrieval against the TF-IDF cosine similarity path.
+
+Every questionnaire answer combination is turned into its query text and ranked
+both ways. Recall@k is the share of the TF-IDF top-k chunks that dense retrieval
+also returns, on semantic scores alone and on the final 70/30 blend with keyword
+relevance. Synonym probes show how similar two related phrasings look to each
+scorer (TF-IDF only sees shared words).
+
+Uses the configured corpus (the playbook, or RAG_CORPUS_DIR).
+
+Usage (from the backend directory):
+    python -m benchmarks.dense_retrieval
+"""
+import itertools
+import time
+
+import numpy as np
+from sklearn.metrics.pairwise import cosine_similarity
+
+from services.rag_index import load_index
+from services.rag_keywords import QUESTIONNAIRE_OPTIONS
+from services.rag_service import create_query_vector, top_k_indices
+
+TOP_K = 5
+LATENCY_QUERIES = 200
+
+SYNONYM_PROBES = [
+    ("credit card", "high-interest debt"),
+    ("EPF contributions", "retirement savings"),
+    ("unit trust", "investment fund"),
+    ("rainy day money", "emergency fund"),
+]
+
+
+def _latency(fn, queries) -> tuple:
+    """Median and p95 wall time of fn(query) in milliseconds."""
+    samples = []
+    for query in queries:
+        started = time.perf_counter()
+        fn(query)
+        samples.append((time.perf_counter() - started) * 1000)
+    return float(np.percentile(samples, 50)), float(np.percentile(samples, 95))
+
+
+def _recall(reference: np.ndarray, candidate: np.ndarray, k: int) -> float:
+    hits = [
+        len(set(top_k_indices(ref_row, k)) & set(top_k_indices(cand_row, k))) / k
+        for ref_row, cand_row in zip(reference, candidate)
+    ]
+    return float(np.mean(hits))
+
+
+def main():
+    index = load_index()
+    if index is None:
+        raise SystemExit("Corpus not found or empty")
+    if index.dense is None:
+        raise SystemExit("Index has no dense embeddings (RAG_DENSE_DIM=0 or corpus too small)")
+
+    answers_list = [dict(zip(QUESTIONNAIRE_OPTIONS, combo)) for combo in itertools.product(*QUESTIONNAIRE_OPTIONS.values())]
+    queries = [create_query_vector(answers) for answers in answers_list]
+    k = min(TOP_K, len(index.chunks))
+    print(f"{len(index.chunks)} chunks, {index.dense.dim} dense dimensions, {len(queries)} queries\n")
+
+    # Latency of one query against every chunk
+    sample = queries[::max(1, len(queries) // LATENCY_QUERIES)]
+    paths = {
+        "cosine_similarity": lambda q: cosine_similarity(index.vectorizer.transform([q]), index.chunk_vectors),
+        "tfidf sparse dot": lambda q: (index.vectorizer.transform([q]) @ index.chunk_vectors.T).toarray(),
+        "dense matvec": lambda q: index.dense.scores_many([q]),
+    }
+    print(f"{'path':<20} {'p50 ms':>8} {'p95 ms':>8} {'batch ms':>9}")
+    for name, fn in paths.items():
+        p50, p95 = _latency(fn, sample)
+        started = time.perf_counter()
+        if name == "dense matvec":
+            index.dense.scores_many(queries)
+        else:
+            fn_batch = index.vectorizer.transform(queries)
+            cosine_similarity(fn_batch, index.chunk_vectors)
+        batch_ms = (time.perf_counter() - started) * 1000
+        print(f"{name:<20} {p50:>8.3f} {p95:>8.3f} {batch_ms:>9.1f}")
+
+    # Recall of dense retrieval against the TF-IDF ranking
+    tfidf = cosine_similarity(index.vectorizer.transform(queries), index.chunk_vectors)
+    dense = index.dense.scores_many(queries)
+    keywords = index.keyword_matrix.scores_many(answers_list) / 20.0
+    print(f"\nrecall@{k} semantic only: {_recall(tfidf, dense, k):.3f}")
+    print(f"recall@{k} blended:       {_recall(0.7 * tfidf + 0.3 * keywords, 0.7 * dense + 0.3 * keywords, k):.3f}")
+
+    print(f"\n{'probe':<45} {'tfidf':>7} {'dense':>7}")
+    for left, right in SYNONYM_PROBES:
+        tfidf_similarity = cosine_similarity(index.vectorizer.transform([left]), index.vectorizer.transform([right]))[0, 0]
+        left_vector, right_vector = index.dense.embed([left, right])
+        print(f"{left + ' / ' + right:<45} {tfidf_similarity:>7.3f} {float(left_vector @ right_vector):>7.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+"""
+Benchmark keyword relevance scoring: per-chunk Python loop vs. precomputed feature matrix.
+
+The playbook chunks are replicated to simulate a growing guidance corpus.
+
+Usage (from the backend directory):
+    python -m benchmarks.keyword_scoring
+"""
+import time
+
+import numpy as np
+
+from services.rag_corpus import read_playbook
+from services.rag_index import chunk_text
+from services.rag_keywords import build_keyword_matrix
+from services.rag_service import calculate_keyword_relevance
+
+SCALES = [1, 10, 100, 1000]
+REPEATS = 20
+
+SAMPLE_ANSWERS = {
+    "aboutYou": "Student",
+    "income": "0–36,000",
+    "expenses": "1,001–2,500",
+    "debt": "Student loan",
+    "savings": "0",
+    "riskTolerance": "Low",
+}
+
+
+def _time(fn, repeats: int = REPEATS) -> float:
+    """Median wall time of fn() in milliseconds."""
+    samples = []
+    for _ in range(repeats):
+        started = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - started) * 1000)
+    return float(np.median(samples))
+
+
+def main():
+    base_chunks = chunk_text(read_playbook())
+    if not base_chunks:
+        raise SystemExit("Playbook not found or empty")
+
+    print(f"{'chunks':>8} {'build ms':>10} {'loop ms':>10} {'matrix ms':>10} {'speedup':>8}")
+    for scale in SCALES:
+        chunks = base_chunks * scale
+
+        started = time.perf_counter()
+        matrix = build_keyword_matrix(chunks)
+        build_ms = (time.perf_counter() - started) * 1000
+
+        loop_scores = [calculate_keyword_relevance(chunk, SAMPLE_ANSWERS) for chunk in chunks]
+        if not np.array_equal(matrix.scores(SAMPLE_ANSWERS), np.asarray(loop_scores)):
+            raise SystemExit(f"Score mismatch at scale {scale}")
+
+        loop_ms = _time(lambda: [calculate_keyword_relevance(chunk, SAMPLE_ANSWERS) for chunk in chunks])
+        matrix_ms = _time(lambda: matrix.scores(SAMPLE_ANSWERS))
+        print(f"{len(chunks):>8} {build_ms:>10.2f} {loop_ms:>10.3f} {matrix_ms:>10.3f} {loop_ms / matrix_ms:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
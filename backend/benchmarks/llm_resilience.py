@@ -0,0 +1,176 @@
+"""
+Tail-latency benchmark for retries and hedged requests against a local fake model.
+
+The fake model (``services/fake_gemini.py``) answers after a log-normal delay
+with a heavy tail (a share of calls are many times slower than the median) and
+fails a share of calls with ``ServiceUnavailable``, like an overloaded endpoint.
+Streams are read through the same thread bridge and scheduler slot as
+``/api/query``. The same workload runs through ``call_with_retries`` and
+``open_stream`` with:
+
+- single: one attempt, no retries
+- retries: jittered retries within the deadline budget
+- hedged: retries plus a hedge after the observed p95 latency
+
+and the report (JSON) gives the success rate, p50/p95/p99 latency (time to first
+chunk for streams) and how many extra model requests each mode cost.
+
+Usage (from the backend directory):
+    python -m benchmarks.llm_resilience [--calls 2000] [--output report.json]
+"""
+import argparse
+import asyncio
+import json
+from pathlib import Path
+from typing import Dict, List
+
+import numpy as np
+
+from services import llm, resilience
+from services import streaming as stream_bridge
+from services.fake_gemini import FakeGenerativeModel, FakeModelConfig
+from services.llm import LLMScheduler, Priority
+
+
+class CountingFakeModel(FakeGenerativeModel):
+    """The fake model, counting the requests each mode sends."""
+
+    def __init__(self, config: FakeModelConfig):
+        super().__init__("benchmark", config=config)
+        self.requests = 0
+
+    def _timing(self):
+        self.requests += 1
+        return super()._timing()
+
+
+MODES = {
+    "single": {"max_attempts": 1, "hedge": False},
+    "retries": {"max_attempts": 3, "hedge": False},
+    "hedged": {"max_attempts": 3, "hedge": True},
+}
+
+
+def summarize(latencies: List[float], failures: int, requests: int, calls: int) -> Dict:
+    values = np.asarray(latencies) * 1000 if latencies else np.zeros(1)
+    return {
+        "success_rate": round(len(latencies) / calls, 4),
+        "failures": failures,
+        "p50_ms": round(float(np.percentile(values, 50)), 1),
+        "p95_ms": round(float(np.percentile(values, 95)), 1),
+        "p99_ms": round(float(np.percentile(values, 99)), 1),
+        "max_ms": round(float(values.max()), 1),
+        "requests_per_call": round(requests / calls, 3),
+    }
+
+
+async def run_mode(mode: str, streaming: bool, args) -> Dict:
+    settings = MODES[mode]
+    resilience.MAX_ATTEMPTS = settings["max_attempts"]
+    resilience.HEDGE_REQUESTS = settings["hedge"]
+    resilience.RETRY_BASE_DELAY = args.median / 2
+    resilience.latency_trackers.clear()
+    resilience._counts.clear()
+    # Only the resilience layer is measured, so admission never waits
+    scheduler = LLMScheduler(max_in_flight=10_000, rate_per_minute=0, burst=1, background_limit=10_000)
+    llm.llm_scheduler = stream_bridge.llm_scheduler = scheduler
+
+    model = CountingFakeModel(FakeModelConfig(
+        ttfb=args.median,
+        tokens_per_second=2000,
+        response_tokens=40,
+        slow_share=args.slow_share,
+        slow_factor=args.slow_factor,
+        error_rate=args.error_share,
+        seed=args.seed,
+    ))
+    operation = "stream" if streaming else "call"
+    prompt = "How much should I keep in my emergency fund?"
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def one_call():
+        async with semaphore:
+            deadline = resilience.Deadline(args.budget)
+            started = loop.time()
+            if streaming:
+                _, stream = await resilience.open_stream(
+                    lambda: (None, stream_bridge.stream_model(
+                        lambda: model.generate_content(prompt, stream=True),
+                        Priority.INTERACTIVE,
+                        args.attempt_timeout,
+                    )),
+                    operation,
+                    deadline,
+                    args.attempt_timeout,
+                    hedge=True,
+                )
+                async for _ in stream:
+                    latency = loop.time() - started  # First chunk
+                    break
+                await stream.aclose()
+                return latency
+            await resilience.call_with_retries(
+                lambda: model.generate_content_async(prompt), operation, Priority.PLAN, deadline, args.attempt_timeout, hedge=True
+            )
+            return loop.time() - started
+
+    # Warm-up fills the latency tracker that the hedge delay is derived from
+    for _ in range(resilience.HEDGE_MIN_SAMPLES):
+        try:
+            await one_call()
+        except Exception:
+            pass
+    model.requests = 0
+
+    results = await asyncio.gather(*(one_call() for _ in range(args.calls)), return_exceptions=True)
+    latencies = [result for result in results if not isinstance(result, BaseException)]
+    return summarize(latencies, len(results) - len(latencies), model.requests, args.calls)
+
+
+async def run(args) -> Dict:
+    report = {
+        "config": {
+            "calls": args.calls,
+            "concurrency": args.concurrency,
+            "median_ms": args.median * 1000,
+            "slow_share": args.slow_share,
+            "slow_factor": args.slow_factor,
+            "error_share": args.error_share,
+            "budget_s": args.budget,
+            "attempt_timeout_s": args.attempt_timeout,
+        }
+    }
+    for streaming in (False, True):
+        report["stream" if streaming else "call"] = {
+            mode: await run_mode(mode, streaming, args) for mode in MODES
+        }
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--calls", type=int, default=2000)
+    # Kept below STREAM_POOL_SIZE so streams measure retries and hedges, not the thread pool
+    parser.add_argument("--concurrency", type=int, default=40)
+    parser.add_argument("--median", type=float, default=0.05, help="Median fake latency in seconds")
+    parser.add_argument("--slow-share", type=float, default=0.05, help="Share of calls in the slow tail")
+    parser.add_argument("--slow-factor", type=float, default=10.0, help="How much slower tail calls are")
+    parser.add_argument("--error-share", type=float, default=0.03, help="Share of calls that fail")
+    parser.add_argument("--budget", type=float, default=2.0, help="Deadline budget per call in seconds")
+    parser.add_argument("--attempt-timeout", type=float, default=1.5, help="Timeout per attempt in seconds")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Write the JSON report here instead of stdout")
+    args = parser.parse_args()
+
+    report = asyncio.run(run(args))
+    text = json.dumps(report, indent=2)
+    if args.output:
+        Path(args.output).write_text(text + "\n", encoding="utf-8")
+        print(f"Report written to {args.output}")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
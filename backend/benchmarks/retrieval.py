@@ -0,0 +1,266 @@
+"""
+Retrieval latency and quality benchmark for rag_service.
+
+Runs every questionnaire answer combination plus synthetic free-text answers
+through ``get_relevant_context`` and reports, as JSON:
+
+- p50/p95/p99 latency of cold (context cache cleared) and warm (cached) calls
+- index build and load time, peak Python memory and process RSS
+- hit rate of the retrieved contexts against the labeled playbook sections in
+  ``retrieval_labels.json``
+
+Settings come from the usual environment variables (RAG_SCORER,
+RAG_CHUNK_SIZE, RAG_CONTEXT_TOKEN_BUDGET, ...), so two configurations can be
+compared by diffing their reports.
+
+Usage (from the backend directory):
+    python -m benchmarks.retrieval [--output report.json] [--free-text 500]
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import platform
+import random
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+from typing import Dict, List
+
+import numpy as np
+
+from services import rag_index, rag_service
+from services.rag_keywords import QUESTIONNAIRE_OPTIONS
+
+LABELS_PATH = Path(__file__).parent / "retrieval_labels.json"
+
+# Free-text answers people type instead of picking an option
+FREE_TEXT_VALUES = {
+    "aboutYou": ["Freelancer", "Fresh graduate", "Gig driver", "Civil servant", "Homemaker", "Part-time tutor"],
+    "income": ["RM 3,500 a month", "Around 80k", "Commission based", "Pension", "Varies"],
+    "expenses": ["About half my income", "RM 2,000", "Not sure"],
+    "debt": ["PTPTN loan", "Personal loan", "Buy now pay later", "Home loan", "Business loan"],
+    "savings": ["About 5k", "Just started", "Fixed deposit 20k", "Nothing yet"],
+    "riskTolerance": ["Very low", "Moderate", "Aggressive", "Not sure"],
+}
+
+
+def questionnaire_answers() -> List[Dict]:
+    """Every combination of questionnaire options."""
+    return [
+        dict(zip(QUESTIONNAIRE_OPTIONS, values))
+        for values in itertools.product(*QUESTIONNAIRE_OPTIONS.values())
+    ]
+
+
+def free_text_answers(count: int, seed: int = 0) -> List[Dict]:
+    """Answers mixing questionnaire options with free-text values, deterministic for a seed."""
+    rng = random.Random(seed)
+    answers_list = []
+    for _ in range(count):
+        answers = {}
+        for field, options in QUESTIONNAIRE_OPTIONS.items():
+            pool = FREE_TEXT_VALUES[field] if rng.random() < 0.5 else options
+            answers[field] = rng.choice(pool)
+        answers_list.append(answers)
+    return answers_list
+
+
+def percentiles(samples: List[float]) -> Dict[str, float]:
+    """Latency summary in milliseconds."""
+    if not samples:
+        return {"count": 0}
+    values = np.asarray(samples)
+    return {
+        "count": len(samples),
+        "mean_ms": round(float(values.mean()), 4),
+        "p50_ms": round(float(np.percentile(values, 50)), 4),
+        "p95_ms": round(float(np.percentile(values, 95)), 4),
+        "p99_ms": round(float(np.percentile(values, 99)), 4),
+        "max_ms": round(float(values.max()), 4),
+    }
+
+
+def rss_mb() -> float:
+    """Peak resident set size of this process in MB."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def measure_build() -> Dict:
+    """Build the index from scratch into a scratch directory, then load it."""
+    with tempfile.TemporaryDirectory() as scratch:
+        index_root = Path(scratch)
+
+        tracemalloc.start()
+        started = time.perf_counter()
+        index_dir = rag_index.build_index(index_root=index_root)
+        build_seconds = time.perf_counter() - started
+        _, build_peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        if index_dir is None:
+            raise SystemExit("Corpus not found or has no indexable content")
+
+        size = sum(path.stat().st_size for path in index_dir.rglob("*") if path.is_file())
+        with open(index_dir / "meta.json", encoding="utf-8") as f:
+            meta = json.load(f)
+
+        tracemalloc.start()
+        started = time.perf_counter()
+        index = rag_index.load_index(index_root=index_root, build=False)
+        rag_service.IndexSnapshot(index)
+        load_seconds = time.perf_counter() - started
+        _, load_peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    return {
+        "documents": meta["documents"],
+        "chunks": meta["chunks"],
+        "features": meta["features"],
+        "dense_dim": meta.get("dense_dim", 0),
+        "build_seconds": round(build_seconds, 4),
+        "build_peak_mb": round(build_peak / 2 ** 20, 2),
+        "load_seconds": round(load_seconds, 4),
+        "load_peak_mb": round(load_peak / 2 ** 20, 2),
+        "artifact_mb": round(size / 2 ** 20, 2),
+    }
+
+
+async def measure_latency(answers_list: List[Dict]) -> Dict:
+    """Per-call latency of get_relevant_context with the context cache cleared (cold) and filled (warm)."""
+    rag_service.context_cache.clear()
+    cold, warm = [], []
+    contexts = []
+    for samples in (cold, warm):
+        for answers in answers_list:
+            started = time.perf_counter()
+            context = await rag_service.get_relevant_context(answers)
+            samples.append((time.perf_counter() - started) * 1000)
+            if samples is cold:
+                contexts.append(context)
+
+    rag_service.context_cache.clear()
+    started = time.perf_counter()
+    await rag_service.get_relevant_contexts(answers_list)
+    batch_seconds = time.perf_counter() - started
+
+    return {
+        "cold": percentiles(cold),
+        "warm": percentiles(warm),
+        "batch_seconds": round(batch_seconds, 4),
+    }, contexts
+
+
+def _retrieved(context: str, section: str) -> bool:
+    return any(line.startswith(section) for line in context.splitlines())
+
+
+def score_hits(answers_list: List[Dict], contexts: List[str], expected: List[List[str]]) -> Dict:
+    """Share of queries with at least one / all expected sections retrieved, and mean section recall."""
+    any_hits, all_hits, recalls = [], [], []
+    for sections, context in zip(expected, contexts):
+        if not sections:
+            continue
+        found = [_retrieved(context, section) for section in sections]
+        any_hits.append(any(found))
+        all_hits.append(all(found))
+        recalls.append(sum(found) / len(found))
+    return {
+        "queries": len(recalls),
+        "hit_rate": round(float(np.mean(any_hits)), 4) if recalls else None,
+        "all_sections_rate": round(float(np.mean(all_hits)), 4) if recalls else None,
+        "section_recall": round(float(np.mean(recalls)), 4) if recalls else None,
+    }
+
+
+def expected_sections(answers: Dict, labels: Dict) -> List[str]:
+    sections = []
+    for field, by_value in labels["answers"].items():
+        sections.extend(by_value.get(answers.get(field), []))
+    return list(dict.fromkeys(sections))
+
+
+def field_hit_rates(answers_list: List[Dict], contexts: List[str], labels: Dict) -> Dict:
+    """Section recall per questionnaire field, to see which answers retrieval serves worst."""
+    rates = {}
+    for field, by_value in labels["answers"].items():
+        expected = [by_value.get(answers.get(field), []) for answers in answers_list]
+        rates[field] = score_hits(answers_list, contexts, expected)["section_recall"]
+    return rates
+
+
+async def run(free_text_count: int) -> Dict:
+    with open(LABELS_PATH, encoding="utf-8") as f:
+        labels = json.load(f)
+
+    build = measure_build()
+
+    started = time.perf_counter()
+    rag_service.initialize_vectorizer()
+    initialize_seconds = time.perf_counter() - started
+    snapshot = rag_service.current_snapshot()
+    if snapshot is None:
+        raise SystemExit("Index could not be loaded")
+
+    questionnaire = questionnaire_answers()
+    free_text = free_text_answers(free_text_count)
+    labeled_free_text = [case["answers"] for case in labels["free_text"]]
+
+    questionnaire_latency, questionnaire_contexts = await measure_latency(questionnaire)
+    free_text_latency, _ = await measure_latency(free_text)
+    _, labeled_contexts = await measure_latency(labeled_free_text)
+
+    return {
+        "config": {
+            "scorer": rag_service.RETRIEVAL_SCORER,
+            "chunk_size": rag_index.CHUNK_SIZE,
+            "chunk_overlap": rag_index.CHUNK_OVERLAP,
+            "context_token_budget": rag_service.CONTEXT_TOKEN_BUDGET,
+            "mmr_diversity": rag_service.MMR_DIVERSITY,
+            "corpus": str(rag_index.CORPUS_DIR or rag_index.PLAYBOOK_PATH.name),
+            "index_key": snapshot.key,
+            "python": platform.python_version(),
+        },
+        "index": {**build, "initialize_seconds": round(initialize_seconds, 4)},
+        "latency": {
+            "questionnaire": questionnaire_latency,
+            "free_text": free_text_latency,
+        },
+        "quality": {
+            "questionnaire": score_hits(
+                questionnaire,
+                questionnaire_contexts,
+                [expected_sections(answers, labels) for answers in questionnaire],
+            ),
+            "questionnaire_by_field": field_hit_rates(questionnaire, questionnaire_contexts, labels),
+            "free_text": score_hits(
+                labeled_free_text,
+                labeled_contexts,
+                [case["expected"] for case in labels["free_text"]],
+            ),
+        },
+        "memory": {"peak_rss_mb": rss_mb()},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--output", help="Write the JSON report here instead of stdout")
+    parser.add_argument("--free-text", type=int, default=500, help="Number of synthetic free-text queries")
+    args = parser.parse_args()
+
+    report = asyncio.run(run(args.free_text))
+    text = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        Path(args.output).write_text(text + "\n", encoding="utf-8")
+        print(f"Report written to {args.output}")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,4 @@
-from fastapi import FastAPI, HTTPException, Depends, UploadFile, File, Form, BackgroundTasks
+from fastapi import FastAPI, HTTPException, Depends, UploadFile, File, Form, BackgroundTasks, Request, Header
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.security import HTTPAuthorizationCredentials
 from fastapi.responses import StreamingResponse
@@ -6,14 +6,38 @@ from pydantic import BaseModel
 from typing import Optional, List, Dict
 import uvicorn
 import os
+import hmac
 from dotenv import load_dotenv
 import httpx
-import json
+import asyncio
 import traceback
 import google.generativeai as genai
 from datetime import datetime
-from services.gemini_service import generate_financial_plan, refine_financial_plan
-from services.rag_service import get_relevant_context
+from services.gemini_service import generate_financial_plan, refine_financial_plan, plan_cache
+from services.model_backend import create_model
+from services.llm import CHAT_TIMEOUT, LLMTimeoutError, llm_scheduler, tool_executor
+from services.resilience import CHAT_BUDGET, Deadline, resilience_stats
+from services.plan_jobs import plan_jobs
+from services.chat_sessions import chat_sessions
+from services.chat_history import compact_history, with_summary
+from services.user_context import (
+    db_executor,
+    invalidate_user_context,
+    prefetch_query_context,
+    user_context_cache
+)
+from services.streaming import open_chat_stream, stream_executor
+from services.sse import sse_frames, sse_stats
+from services.rag_service import (
+    get_relevant_context,
+    initialize_vectorizer,
+    ReloadThrottled,
+    request_reload,
+    watch_playbook,
+    warm_context_cache,
+    context_cache,
+    retrieval_executor
+)
 from services.content_extraction import extract_content, summarize_document
 from services.retirement_tools import (
     get_investment_options,
@@ -29,7 +53,6 @@ from services.retirement_tools import (
 from services.user_profile_service import (
     save_user_profile,
     get_user_profile,
-    get_user_profile_summary,
     get_user_financial_profile,
     delete_user_profile
 )
@@ -40,7 +63,7 @@ load_dotenv()
 
 # Configure Gemini for streaming
 genai.configure(api_key=os.getenv("GOOGLE_API_KEY"))
-model = genai.GenerativeModel('gemini-2.5-flash')
+model = create_model('gemini-2.5-flash')
 
 app = FastAPI(title="Financial GPS API", version="1.0.0")
 
@@ -53,6 +76,26 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Background tasks started with the app (kept referenced so they are not garbage collected)
+background_jobs = []
+
+@app.on_event("startup")
+async def load_rag_index():
+    """Memory-map the prebuilt corpus index before serving traffic."""
+    initialize_vectorizer()
+    if os.getenv("RAG_WARM_CONTEXT_CACHE", "false").lower() == "true":
+        print(f"[RAG] Warmed context cache with {warm_context_cache()} answer combinations")
+    
+    # Hot-reload the index when the corpus files change
+    reload_interval = float(os.getenv("RAG_RELOAD_INTERVAL", "0"))
+    if reload_interval > 0:
+        background_jobs.append(asyncio.create_task(watch_playbook(reload_interval)))
+
+@app.on_event("shutdown")
+async def save_chat_sessions():
+    """Spill live chat sessions to SQLite (when CHAT_SESSION_DB is set) so they survive a restart."""
+    await chat_sessions.flush()
+
 # Request models
 class UserAnswers(BaseModel):
     aboutYou: Optional[str] = None
@@ -65,7 +108,8 @@ class UserAnswers(BaseModel):
 class RefinePlanRequest(BaseModel):
     message: str
     planData: Dict
-    chatHistory: List[Dict] = []
+    sessionId: Optional[str] = None  # Returned by the previous refine-plan response
+    chatHistory: List[Dict] = []  # Only used to seed a new session
 
 class GoogleAuthRequest(BaseModel):
     id_token: str
@@ -94,7 +138,8 @@ class InvestmentOrderRequest(BaseModel):
 
 class QueryRequest(BaseModel):
     query: str
-    chat_history: Optional[List[Dict]] = []
+    session_id: Optional[str] = None  # Sent in the first event of the previous stream
+    chat_history: Optional[List[Dict]] = []  # Only used to seed a new session
     context: Optional[Dict] = None
 
 class ExecuteActionRequest(BaseModel):
@@ -107,6 +152,24 @@ class ExecuteActionRequest(BaseModel):
 async def health_check():
     return {"status": "ok"}
 
+@app.get("/api/metrics")
+async def metrics():
+    """Queue depth and cache statistics for in-process workers."""
+    return {
+        "rag_executor": retrieval_executor.stats(),
+        "rag_context_cache": context_cache.stats(),
+        "plan_cache": plan_cache.stats(),
+        "plan_jobs": plan_jobs.stats(),
+        "llm_scheduler": llm_scheduler.stats(),
+        "llm_calls": resilience_stats(),
+        "db_executor": db_executor.stats(),
+        "user_context_cache": user_context_cache.stats(),
+        "chat_sessions": chat_sessions.stats(),
+        "tool_executor": tool_executor.stats(),
+        "stream_executor": stream_executor.stats(),
+        "sse": sse_stats()
+    }
+
 # Auth endpoints
 @app.post("/api/auth/google")
 async def google_auth(auth_request: GoogleAuthRequest):
@@ -174,6 +237,53 @@ async def test_auth(credentials: HTTPAuthorizationCredentials = Depends(security
     except Exception as e:
         return {"status": "error", "message": str(e), "type": type(e).__name__}
 
+# ============================================================================
+# ADMIN ENDPOINTS
+# ============================================================================
+
+def require_admin(
+    x_admin_key: Optional[str] = Header(None),
+    current_user: dict = Depends(get_current_user)
+) -> dict:
+    """
+    Allow only requests carrying ADMIN_API_KEY from users listed in ADMIN_USER_IDS.
+
+    The bearer token alone is not enough: ``verify_token`` does not check its
+    signature, so its user id could be forged. Admin endpoints are disabled
+    while ADMIN_API_KEY is unset.
+    """
+    admin_key = os.getenv("ADMIN_API_KEY", "")
+    if not admin_key or not x_admin_key or not hmac.compare_digest(x_admin_key.encode(), admin_key.encode()):
+        raise HTTPException(status_code=403, detail="Admin access required")
+    admin_ids = [user_id.strip() for user_id in os.getenv("ADMIN_USER_IDS", "").split(",") if user_id.strip()]
+    if current_user['id'] not in admin_ids:
+        raise HTTPException(status_code=403, detail="Admin access required")
+    return current_user
+
+@app.post("/api/admin/reload-index")
+async def reload_rag_index(current_user: dict = Depends(require_admin)):
+    """Rebuild the corpus index in the background and atomically swap it in (joins a reload in progress)."""
+    try:
+        swapped = await request_reload()
+        return {"success": True, "reloaded": swapped}
+    except ReloadThrottled as error:
+        raise HTTPException(
+            status_code=429,
+            detail={
+                "error": "Reload rate limited",
+                "message": str(error)
+            },
+            headers={"Retry-After": str(max(1, round(error.retry_after)))}
+        )
+    except Exception as error:
+        raise HTTPException(
+            status_code=500,
+            detail={
+                "error": "Failed to reload index",
+                "message": str(error)
+            }
+        )
+
 # ============================================================================
 # USER PROFILE ENDPOINTS
 # ============================================================================
@@ -186,6 +296,12 @@ async def save_profile(
     """Save or update user profile from questionnaire."""
     try:
         result = save_user_profile(current_user['id'], user_answers.dict())
+        invalidate_user_context(current_user['id'])
+        
+        # Start generating the plan now; /api/generate-plan will pick it up
+        if result.get("success") and os.getenv("SPECULATIVE_PLANS", "true").lower() == "true":
+            plan_jobs.submit(current_user['id'], user_answers.dict())
+        
         return result
     except Exception as error:
         raise HTTPException(
@@ -219,6 +335,7 @@ async def delete_profile(current_user: dict = Depends(get_current_user)):
     """Delete current user's profile."""
     try:
         result = delete_user_profile(current_user['id'])
+        invalidate_user_context(current_user['id'])
         return result
     except Exception as error:
         raise HTTPException(
@@ -237,17 +354,27 @@ async def delete_profile(current_user: dict = Depends(get_current_user)):
 @app.post("/api/generate-plan")
 async def generate_plan(
     user_answers: UserAnswers,
+    fresh: bool = False,
     current_user: dict = Depends(get_current_user)
 ):
+    """
+    Generate a plan. Joins the plan job started by the profile save if there is one;
+    identical profiles are served from the plan cache unless ?fresh=true.
+    """
     try:
         # Save user profile first
         save_user_profile(current_user['id'], user_answers.dict())
+        invalidate_user_context(current_user['id'])
         
-        # Get relevant context from financial playbook using RAG
-        context = await get_relevant_context(user_answers.dict())
-        
-        # Generate financial plan using Gemini
-        plan = await generate_financial_plan(user_answers.dict(), context)
+        if fresh:
+            # Get relevant context from financial playbook using RAG
+            context = await get_relevant_context(user_answers.dict())
+            
+            # Generate financial plan using Gemini
+            plan = await generate_financial_plan(user_answers.dict(), context, use_cache=False)
+        else:
+            # One plan generation per user at a time; joins an in-flight job for the same answers
+            plan = await plan_jobs.get_plan(current_user['id'], user_answers.dict())
         
         # Optionally save plan to Supabase for the user
         try:
@@ -261,6 +388,14 @@ async def generate_plan(
             pass  # Continue even if save fails
         
         return plan
+    except LLMTimeoutError as error:
+        raise HTTPException(
+            status_code=504,
+            detail={
+                "error": "Financial plan generation timed out",
+                "message": str(error)
+            }
+        )
     except Exception as error:
         raise HTTPException(
             status_code=500,
@@ -279,16 +414,35 @@ async def refine_plan(
     try:
         # Get relevant context from financial playbook
         context = await get_relevant_context(request.planData or {})
+        session = await chat_sessions.open(
+            request.sessionId,
+            current_user.get('id'),
+            "refine",
+            request.chatHistory,
+            request.message
+        )
+        prompt_history = compact_history(session)
         
         # Refine plan using Gemini
         result = await refine_financial_plan(
             request.message,
             request.planData,
-            request.chatHistory,
-            context
+            prompt_history.history,
+            context,
+            prompt_history.summary
         )
+        await chat_sessions.record_turn(session, request.message, result["message"])
         
+        result["sessionId"] = session.session_id
         return result
+    except LLMTimeoutError as error:
+        raise HTTPException(
+            status_code=504,
+            detail={
+                "error": "Plan refinement timed out",
+                "message": str(error)
+            }
+        )
     except Exception as error:
         raise HTTPException(
             status_code=500,
@@ -452,63 +606,9 @@ async def create_order_endpoint(
 # STREAMING QUERY ENDPOINT
 # ============================================================================
 
-@app.post("/api/query")
-async def stream_query(
-    request: QueryRequest,
-    current_user: dict = Depends(get_current_user)
-):
-    """
-    Stream AI responses to user queries in real-time with function calling support.
-    Supports chat history, context, and can use retirement planning tools.
-    """
-    print("\n" + "="*80)
-    print("[STREAM QUERY] New request received")
-    print(f"[STREAM QUERY] User ID: {current_user.get('id', 'unknown')}")
-    print(f"[STREAM QUERY] Query: {request.query[:100]}...")
-    print(f"[STREAM QUERY] Chat history length: {len(request.chat_history) if request.chat_history else 0}")
-    print(f"[STREAM QUERY] Context provided: {bool(request.context)}")
-    print("="*80 + "\n")
-    
-    async def generate_stream():
-        try:
-            print("[STREAM] Starting stream generation with function calling...")
-            
-            # Get user profile summary for personalization
-            user_profile_summary = get_user_profile_summary(current_user.get('id'))
-            print(f"[STREAM] User profile: {user_profile_summary[:100]}...")
-            
-            # Get user's uploaded documents summaries
-            document_summaries = ""
-            try:
-                supabase = get_supabase_client()
-                docs_result = supabase.table('user_uploaded_documents')\
-                    .select('fileName, summary, extractionStatus')\
-                    .eq('userId', str(current_user.get('id')))\
-                    .eq('extractionStatus', 'completed')\
-                    .execute()
-                
-                if docs_result.data and len(docs_result.data) > 0:
-                    document_summaries = "\n\nUser's Financial Documents:\n"
-                    for doc in docs_result.data:
-                        if doc.get('summary'):
-                            document_summaries += f"\n- {doc['fileName']}:\n{doc['summary']}\n"
-                    print(f"[STREAM] Found {len(docs_result.data)} document summaries")
-                else:
-                    print("[STREAM] No document summaries found")
-            except Exception as doc_error:
-                print(f"[STREAM] Error fetching documents: {doc_error}")
-            
-            # Get relevant context from RAG if no specific context provided
-            rag_context = ""
-            if request.context:
-                print(f"[STREAM] Fetching RAG context for: {request.context}")
-                rag_context = await get_relevant_context(request.context)
-                print(f"[STREAM] RAG context length: {len(rag_context)} chars")
-            else:
-                print("[STREAM] No context provided, skipping RAG")
-            
-            # Build the conversation prompt with tool instructions
-            system_prompt = f"""You are a knowledgeable financial advisor assistant specializing in Malaysian personal finance.
+def chat_system_prompt(user_profile_summary: str, document_summaries: str) -> str:
+    """Chat system prompt with tool instructions, personalized with the user's profile and documents."""
+    return f"""You are a knowledgeable financial advisor assistant specializing in Malaysian personal finance.
 You provide clear, actionable advice on financial planning, investments, retirement planning, and money management.
 
 {user_profile_summary}
@@ -558,164 +658,193 @@ Guidelines:
 - When presenting tool results, format them nicely with tables or lists
 - If you notice discrepancies between questionnaire data and documents, ask for clarification"""
 
-            if rag_context:
-                system_prompt += f"\n\nRelevant Financial Guidance:\n{rag_context}"
-
-            # Build conversation history
-            conversation_parts = [system_prompt]
+@app.post("/api/query")
+async def stream_query(
+    request: QueryRequest,
+    http_request: Request,
+    current_user: dict = Depends(get_current_user)
+):
+    """
+    Stream AI responses to user queries in real-time with function calling support.
+    Keeps the chat history in a server-side session, supports context, and can use retirement planning tools.
+    """
+    print("\n" + "="*80)
+    print("[STREAM QUERY] New request received")
+    print(f"[STREAM QUERY] User ID: {current_user.get('id', 'unknown')}")
+    print(f"[STREAM QUERY] Query: {request.query[:100]}...")
+    print(f"[STREAM QUERY] Session: {request.session_id or 'new'}")
+    print(f"[STREAM QUERY] Context provided: {bool(request.context)}")
+    print("="*80 + "\n")
+    
+    async def generate_stream():
+        try:
+            print("[STREAM] Starting stream generation with function calling...")
             
-            # Add chat history (last 10 messages)
-            recent_history = request.chat_history[-10:] if request.chat_history else []
-            print(f"[STREAM] Adding {len(recent_history)} messages from history")
-            for msg in recent_history:
-                role = msg.get("role", "user")
-                content = msg.get("content", "")
-                conversation_parts.append(f"{role.upper()}: {content}")
+            # The conversation so far lives in the server-side session; the client sends
+            # only the new message. The session id goes out first so the client can send
+            # it with the next message.
+            session = await chat_sessions.open(
+                request.session_id,
+                current_user.get('id'),
+                "query",
+                request.chat_history,
+                request.query
+            )
+            yield {"session_id": session.session_id, "content": ""}
             
-            # Add current query
-            conversation_parts.append(f"USER: {request.query}")
-            conversation_parts.append("ASSISTANT:")
+            # Profile summary, document summaries and RAG context (only when context is
+            # provided) are fetched concurrently, each falling back if slow or failing.
+            # The profile, documents and system prompt built from them are cached per user.
+            query_context = await prefetch_query_context(
+                current_user.get('id'),
+                request.context,
+                chat_system_prompt
+            )
+            rag_context = query_context.rag_context
+            print(f"[STREAM] User profile: {query_context.profile_summary[:100]}...")
+            print(f"[STREAM] RAG context length: {len(rag_context)} chars")
             
-            conversation = "\n\n".join(conversation_parts)
-            print(f"[STREAM] Total conversation length: {len(conversation)} chars")
+            # Build the conversation prompt with tool instructions
+            system_prompt = query_context.prompt_prefix
+            if rag_context:
+                system_prompt += f"\n\nRelevant Financial Guidance:\n{rag_context}"
+
+            # Recent turns go to the chat as history and older ones as a summary, within a
+            # fixed token budget; the system prompt is rebuilt every turn and sent with the
+            # new message
+            prompt_history = compact_history(session)
+            history = prompt_history.history
+            print(f"[STREAM] Session has {len(session.messages)} messages (~{session.token_count} tokens), "
+                  f"sending {len(history)} (~{prompt_history.tokens} tokens with summary)")
+            conversation = f"{with_summary(system_prompt, prompt_history.summary)}\n\nUSER: {request.query}\n\nASSISTANT:"
+            print(f"[STREAM] Prompt length: {len(conversation)} chars")
 
             # Import the tool-enabled model from gemini_service
-            from services.gemini_service import model as tool_model, execute_tool
+            from services.gemini_service import (
+                model as tool_model,
+                execute_function_calls,
+                function_responses
+            )
             
             print("[STREAM] Starting chat with function calling enabled...")
-            chat = tool_model.start_chat(enable_automatic_function_calling=False)
-            
-            # Send initial message
-            response = chat.send_message(
-                conversation,
-                generation_config=genai.GenerationConfig(
-                    temperature=0.7,
-                    max_output_tokens=4000,  # Increased from 2000
-                ),
-                stream=True
+            deadline = Deadline(CHAT_BUDGET)
+            generation_config = genai.GenerationConfig(
+                temperature=0.7,
+                max_output_tokens=4000,  # Increased from 2000
             )
             
+            def response_parts(chunk, label):
+                """Content parts of a streamed chunk, logging the finish reason."""
+                if not chunk.candidates:
+                    return []
+                candidate = chunk.candidates[0]
+                if hasattr(candidate, 'finish_reason') and candidate.finish_reason:
+                    print(f"[STREAM] {label} finish reason: {candidate.finish_reason}")
+                if candidate.content and candidate.content.parts:
+                    return candidate.content.parts
+                return []
+            
+            def text_event(text):
+                nonlocal chunk_count, total_chars
+                reply_parts.append(text)
+                chunk_count += 1
+                total_chars += len(text)
+                if chunk_count <= 3:
+                    print(f"[STREAM] Chunk {chunk_count}: {text[:50]}...")
+                elif chunk_count % 10 == 0:
+                    print(f"[STREAM] Chunk {chunk_count} (total chars: {total_chars})")
+                return {"content": text}
+            
             print("[STREAM] Processing response chunks...")
             chunk_count = 0
             total_chars = 0
+            reply_parts = []
             
-            # Process streaming response
-            for chunk in response:
-                # Check for function calls
-                if chunk.candidates and len(chunk.candidates) > 0:
-                    candidate = chunk.candidates[0]
-                    
-                    # Check finish reason
-                    if hasattr(candidate, 'finish_reason') and candidate.finish_reason:
-                        print(f"[STREAM] Finish reason: {candidate.finish_reason}")
+            # The SDK stream is blocking, so it is read on a worker thread and handed over
+            # chunk by chunk; the stream is fully read before any tool runs, because the chat
+            # session only accepts the next message once the previous response is complete.
+            # Attempts are retried (or hedged) only until the first chunk arrives, each on a
+            # fresh chat so a retried or hedged stream starts from a clean session.
+            function_calls = []
+            chat, response = await open_chat_stream(
+                lambda: tool_model.start_chat(history=history, enable_automatic_function_calling=False),
+                conversation,
+                deadline,
+                CHAT_TIMEOUT,
+                hedge=True,
+                generation_config=generation_config
+            )
+            async for chunk in response:
+                for part in response_parts(chunk, "Initial"):
+                    if hasattr(part, 'function_call') and part.function_call:
+                        function_calls.append(part.function_call)
+                    elif hasattr(part, 'text') and part.text:
+                        yield text_event(part.text)
+            
+            if function_calls:
+                # Send tool call notifications to client with better formatting
+                tool_display_names = {
+                    "get_user_financial_profile": "📊 Analyzing your financial profile",
+                    "get_investment_options": "🔍 Finding suitable investment options",
+                    "compare_investments": "⚖️ Comparing investment products",
+                    "calculate_retirement_projection": "📈 Calculating retirement projection",
+                    "get_product_details": "📋 Getting product details",
+                    "create_investment_order": "💰 Creating investment order",
+                    "create_epf_topup_action": "🏦 Preparing EPF top-up",
+                    "create_insurance_recommendation": "🛡️ Finding insurance options",
+                    "create_savings_goal_action": "🎯 Setting up savings goal"
+                }
+                for function_call in function_calls:
+                    tool_name = function_call.name
+                    tool_display = tool_display_names.get(tool_name, f"🔧 Using tool: {tool_name}")
+                    tool_msg = f"\n\n*{tool_display}...*\n\n"
+                    yield {"content": tool_msg, "toolCall": tool_name}
+                
+                # Run every tool of this turn concurrently; add user_id where the tool needs it
+                user_parameters = {"user_id": current_user.get('id')}
+                tool_calls = await execute_function_calls(function_calls, {
+                    "create_investment_order": user_parameters,
+                    "create_epf_topup_action": user_parameters
+                })
+                
+                for tool_call in tool_calls:
+                    tool_result = tool_call["result"]
+                    print(f"[STREAM TOOL RESULT] {tool_call['tool']}: {str(tool_result)[:200]}...")
                     
-                    if candidate.content and candidate.content.parts:
-                        for part in candidate.content.parts:
-                            # Handle function call
-                            if hasattr(part, 'function_call') and part.function_call:
-                                function_call = part.function_call
-                                tool_name = function_call.name
-                                
-                                # Extract parameters
-                                parameters = {}
-                                for key, value in function_call.args.items():
-                                    parameters[key] = value
-                                
-                                # Add user_id if the tool needs it
-                                if tool_name in ["create_investment_order", "create_epf_topup_action"]:
-                                    parameters["user_id"] = current_user.get('id')
-                                
-                                print(f"[STREAM TOOL CALL] {tool_name} with params: {parameters}")
-                                
-                                # Send tool call notification to client with better formatting
-                                tool_display_names = {
-                                    "get_user_financial_profile": "📊 Analyzing your financial profile",
-                                    "get_investment_options": "🔍 Finding suitable investment options",
-                                    "compare_investments": "⚖️ Comparing investment products",
-                                    "calculate_retirement_projection": "📈 Calculating retirement projection",
-                                    "get_product_details": "📋 Getting product details",
-                                    "create_investment_order": "💰 Creating investment order",
-                                    "create_epf_topup_action": "🏦 Preparing EPF top-up",
-                                    "create_insurance_recommendation": "🛡️ Finding insurance options",
-                                    "create_savings_goal_action": "🎯 Setting up savings goal"
-                                }
-                                
-                                tool_display = tool_display_names.get(tool_name, f"🔧 Using tool: {tool_name}")
-                                tool_msg = f"\n\n*{tool_display}...*\n\n"
-                                data = json.dumps({"content": tool_msg, "toolCall": tool_name})
-                                yield f"data: {data}\n\n"
-                                
-                                # Execute the tool
-                                tool_result = execute_tool(tool_name, parameters)
-                                print(f"[STREAM TOOL RESULT] {str(tool_result)[:200]}...")
-                                
-                                # Check if tool result contains action_card
-                                if isinstance(tool_result, dict) and 'action_card' in tool_result:
-                                    print(f"[STREAM] Action card detected: {tool_result['action_card']['type']}")
-                                    # Send action card to frontend
-                                    action_card_data = json.dumps({
-                                        "action_card": tool_result['action_card'],
-                                        "content": ""  # Empty content, action card will be displayed separately
-                                    })
-                                    yield f"data: {action_card_data}\n\n"
-                                
-                                # Send tool result back to model and continue streaming
-                                follow_up = chat.send_message(
-                                    genai.protos.Content(
-                                        parts=[genai.protos.Part(
-                                            function_response=genai.protos.FunctionResponse(
-                                                name=tool_name,
-                                                response={"result": tool_result}
-                                            )
-                                        )]
-                                    ),
-                                    generation_config=genai.GenerationConfig(
-                                        temperature=0.7,
-                                        max_output_tokens=4000,
-                                    ),
-                                    stream=True
-                                )
-                                
-                                # Stream the follow-up response
-                                for follow_chunk in follow_up:
-                                    # Check if chunk has candidates and parts
-                                    if follow_chunk.candidates and len(follow_chunk.candidates) > 0:
-                                        follow_candidate = follow_chunk.candidates[0]
-                                        
-                                        # Check finish reason
-                                        if hasattr(follow_candidate, 'finish_reason') and follow_candidate.finish_reason:
-                                            print(f"[STREAM] Follow-up finish reason: {follow_candidate.finish_reason}")
-                                        
-                                        if follow_candidate.content and follow_candidate.content.parts:
-                                            for follow_part in follow_candidate.content.parts:
-                                                # Only process text parts
-                                                if hasattr(follow_part, 'text') and follow_part.text:
-                                                    chunk_count += 1
-                                                    total_chars += len(follow_part.text)
-                                                    if chunk_count <= 3:
-                                                        print(f"[STREAM] Chunk {chunk_count}: {follow_part.text[:50]}...")
-                                                    elif chunk_count % 10 == 0:
-                                                        print(f"[STREAM] Chunk {chunk_count} (total chars: {total_chars})")
-                                                    
-                                                    data = json.dumps({"content": follow_part.text})
-                                                    yield f"data: {data}\n\n"
-                            
-                            # Handle regular text
-                            elif hasattr(part, 'text') and part.text:
-                                chunk_count += 1
-                                total_chars += len(part.text)
-                                if chunk_count <= 3:
-                                    print(f"[STREAM] Chunk {chunk_count}: {part.text[:50]}...")
-                                elif chunk_count % 10 == 0:
-                                    print(f"[STREAM] Chunk {chunk_count} (total chars: {total_chars})")
-                                
-                                data = json.dumps({"content": part.text})
-                                yield f"data: {data}\n\n"
+                    # Check if tool result contains action_card
+                    if isinstance(tool_result, dict) and 'action_card' in tool_result:
+                        print(f"[STREAM] Action card detected: {tool_result['action_card']['type']}")
+                        # Send action card to frontend
+                        yield {
+                            "action_card": tool_result['action_card'],
+                            "content": ""  # Empty content, action card will be displayed separately
+                        }
+                
+                # Send all tool results back to model in one message and continue streaming.
+                # Each attempt gets its own session rebuilt from this turn's history: a timed-out
+                # send may still be finishing on its worker thread and writing to its session
+                function_response = function_responses(tool_calls)
+                turn_history = list(chat.history)
+                _, follow_up = await open_chat_stream(
+                    lambda: tool_model.start_chat(history=turn_history, enable_automatic_function_calling=False),
+                    function_response,
+                    deadline,
+                    CHAT_TIMEOUT,
+                    hedge=True,
+                    generation_config=generation_config
+                )
+                
+                # Stream the follow-up response (text parts only)
+                async for follow_chunk in follow_up:
+                    for follow_part in response_parts(follow_chunk, "Follow-up"):
+                        if hasattr(follow_part, 'text') and follow_part.text:
+                            yield text_event(follow_part.text)
             
             print(f"[STREAM] Streaming complete! Total chunks: {chunk_count}, Total chars: {total_chars}")
+            await chat_sessions.record_turn(session, request.query, "".join(reply_parts))
             
             # Send completion signal
-            yield f"data: {json.dumps({'done': True})}\n\n"
+            yield {"done": True}
             print("[STREAM] Sent completion signal")
 
         except Exception as error:
@@ -723,16 +852,17 @@ Guidelines:
             print(f"[STREAM ERROR] Error type: {type(error).__name__}")
             print(f"[STREAM ERROR] Traceback:\n{traceback.format_exc()}")
             
-            error_data = json.dumps({
+            yield {
                 "error": str(error),
                 "done": True
-            })
-            yield f"data: {error_data}\n\n"
+            }
             print("[STREAM ERROR] Sent error to client")
 
+    # Text parts are coalesced into frames, heartbeats keep the connection open while
+    # tools run, and a client disconnect cancels the model stream and pending tool calls
     print("[STREAM] Returning StreamingResponse...")
     return StreamingResponse(
-        generate_stream(),
+        sse_frames(generate_stream(), http_request.is_disconnected),
         media_type="text/event-stream",
         headers={
             "Cache-Control": "no-cache",
@@ -784,6 +914,9 @@ async def extract_and_store_content(
             }).eq('id', document_id).execute()
         except:
             pass
+    finally:
+        # Chat context includes the summaries of completed documents
+        invalidate_user_context(user_id)
 
 
 # Upload files to Cloudflare Worker (protected)
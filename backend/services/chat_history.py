@@ -0,0 +1,170 @@
+"""
+Token-budgeted chat history for prompts.
+
+A session's most recent turns go to the model verbatim, newest first, until
+``CHAT_HISTORY_TOKENS`` is used (a turn that does not fit whole is trimmed at a
+sentence boundary). Everything older is represented by one running summary of
+at most ``CHAT_SUMMARY_TOKENS``, which counts against the same budget, so the
+history part of the prompt stays under a fixed size however long the
+conversation runs.
+
+The summary is updated incrementally in the background: once the messages that
+have left the verbatim window but are not yet summarized reach
+``CHAT_SUMMARY_BATCH_TOKENS``, one background model call folds them into the
+previous summary. Requests never wait for it; until it lands, those messages
+are simply left out of the prompt.
+"""
+import asyncio
+import os
+from typing import Dict, List, NamedTuple
+
+from services.chat_sessions import ChatSession
+from services.llm import SUMMARY_TIMEOUT, Priority, request_options
+from services.model_backend import create_model
+from services.rag_context import MIN_TRIM_TOKENS, trim_to_sentence
+from services.resilience import SUMMARY_BUDGET, Deadline, call_with_retries
+from services.tokens import estimate_tokens, token_budget_chars
+
+# Tokens of history per prompt: verbatim turns plus the summary of older ones
+HISTORY_TOKENS = int(os.getenv("CHAT_HISTORY_TOKENS", "3000"))
+SUMMARY_TOKENS = int(os.getenv("CHAT_SUMMARY_TOKENS", "400"))
+# Unsummarized older messages that trigger a summary update
+SUMMARY_BATCH_TOKENS = int(os.getenv("CHAT_SUMMARY_BATCH_TOKENS", "600"))
+# Most of one message that goes into a summary update
+SUMMARY_MESSAGE_TOKENS = 1500
+
+summary_model = create_model('gemini-2.5-flash')
+
+
+class PromptHistory(NamedTuple):
+    summary: str  # Summary of the messages before `history` ("" if none yet)
+    history: List[Dict]  # Recent turns for ``start_chat(history=...)``
+    tokens: int  # Estimated tokens of both
+
+
+def _turn_starts(session: ChatSession) -> List[int]:
+    """Indices of the messages that start a turn (a user message and the model reply after it)."""
+    return [index for index, message in enumerate(session.messages) if message["role"] == "user"]
+
+
+def _clip(text: str, max_tokens: int) -> str:
+    """Text trimmed to a token budget at a sentence boundary, or cut hard if it has none."""
+    max_chars = token_budget_chars(max_tokens)
+    return trim_to_sentence(text, max_chars) or text[:max_chars]
+
+
+def _trimmed(message: Dict, max_tokens: int) -> Dict:
+    return {"role": message["role"], "parts": [_clip(message["parts"][0], max_tokens)]}
+
+
+def compact_history(session: ChatSession) -> PromptHistory:
+    """
+    The session's history to send with the next message, within ``CHAT_HISTORY_TOKENS``.
+
+    Starts a background summary update when enough messages have left the
+    verbatim window.
+
+    Returns:
+        PromptHistory with the summary and the verbatim (possibly trimmed) recent turns
+    """
+    summary = session.summary
+    budget = max(0, HISTORY_TOKENS - estimate_tokens(summary))
+    history: List[Dict] = []
+    used = 0
+    # Index of the first message that goes into the prompt verbatim, even if trimmed
+    start = len(session.messages)
+
+    for turn_start in reversed(_turn_starts(session)):
+        turn = session.messages[turn_start:start]
+        turn_tokens = sum(session.message_tokens[turn_start:start])
+        remaining = budget - used
+        if turn_tokens <= remaining:
+            history[:0] = [{"role": message["role"], "parts": list(message["parts"])} for message in turn]
+            used += turn_tokens
+            start = turn_start
+            continue
+        if remaining >= MIN_TRIM_TOKENS:
+            # Question first, then as much of the answer as still fits
+            question = _trimmed(turn[0], min(session.message_tokens[turn_start], remaining // 2))
+            trimmed = [question]
+            answer_tokens = remaining - estimate_tokens(question["parts"][0])
+            if len(turn) > 1 and answer_tokens >= MIN_TRIM_TOKENS:
+                trimmed.append(_trimmed(turn[1], answer_tokens))
+            if trimmed[0]["parts"][0]:
+                history[:0] = trimmed
+                used += sum(estimate_tokens(message["parts"][0]) for message in trimmed)
+                start = turn_start
+        break
+
+    pending = sum(session.message_tokens[max(0, session.summarized - session.dropped):start])
+    if pending >= SUMMARY_BATCH_TOKENS:
+        schedule_summary(session, session.dropped + start)
+
+    return PromptHistory(summary, history, used + estimate_tokens(summary))
+
+
+def with_summary(prompt: str, summary: str) -> str:
+    """The prompt with the summary of the earlier conversation appended, if there is one."""
+    if not summary:
+        return prompt
+    return f"{prompt}\n\nSummary of the earlier conversation:\n{summary}"
+
+
+def schedule_summary(session: ChatSession, upto: int):
+    """
+    Fold the session's messages before position ``upto`` into its summary, in the background.
+
+    The messages are copied out now: by the time the task runs, the size cap
+    may have dropped some of them and shifted every in-memory index.
+    """
+    if session.summary_task is not None and not session.summary_task.done():
+        return
+    first = max(session.summarized, session.dropped)
+    start = max(0, first - session.dropped)
+    end = max(0, upto - session.dropped)
+    if end <= start or end > len(session.messages):
+        return  # Range no longer (or not yet) in memory
+    messages = [{"role": message["role"], "parts": list(message["parts"])} for message in session.messages[start:end]]
+    session.summary_task = asyncio.create_task(_update_summary(session, first, upto, messages))
+
+
+async def _update_summary(session: ChatSession, first: int, upto: int, messages: List[Dict]):
+    transcript = "\n\n".join(
+        f"{'USER' if message['role'] == 'user' else 'ASSISTANT'}: "
+        f"{_clip(message['parts'][0], SUMMARY_MESSAGE_TOKENS)}"
+        for message in messages
+    )
+    previous = f"Summary so far:\n{session.summary}\n\n" if session.summary else ""
+    prompt = f"""You maintain a running summary of a conversation between a user and their financial advisor assistant.
+Update the summary with the new messages below. Keep the facts the assistant needs later: the user's figures,
+goals and decisions, products and amounts discussed, and any open questions. Drop pleasantries and formatting.
+Write plain prose in at most {int(SUMMARY_TOKENS * 0.75)} words.
+
+{previous}New messages:
+{transcript}
+
+Updated summary:"""
+
+    try:
+        deadline = Deadline(SUMMARY_BUDGET)
+        response = await call_with_retries(
+            lambda: summary_model.generate_content_async(
+                prompt,
+                request_options=request_options(deadline.attempt_timeout(SUMMARY_TIMEOUT, "Chat summary"))
+            ),
+            "Chat summary",
+            Priority.BACKGROUND,
+            deadline,
+            SUMMARY_TIMEOUT
+        )
+        summary = _clip(response.text.strip(), SUMMARY_TOKENS)
+    except Exception as error:
+        # The messages stay unsummarized; the next turn tries again
+        print(f"[HISTORY] Summary update for session {session.session_id} failed: {error}")
+        return
+
+    # Only fold in if nothing else has moved the summary past where this update started
+    if summary and session.summarized <= first:
+        session.summary = summary
+        session.summarized = upto
+        print(f"[HISTORY] Session {session.session_id}: summarized {upto} messages in ~{estimate_tokens(summary)} tokens")
@@ -0,0 +1,283 @@
+"""
+Server-side chat sessions for ``/api/query`` and ``/api/refine-plan``.
+
+A session keeps the conversation in the shape Gemini's ``start_chat(history=...)``
+takes, plus a running token count, so a request carries only the new message
+and its session id instead of the whole transcript. Sessions live in an
+in-memory LRU. With ``CHAT_SESSION_DB`` set, every completed turn is also
+written through to a SQLite file that all workers share, and a session is read
+back from it whenever it is missing from memory or another worker has stored a
+newer turn. Without it, sessions exist only in the process that created them,
+so running several workers needs sticky routing; an evicted, expired or
+unknown session simply starts over (with a new id), seeded from whatever
+history the client still sends.
+
+Only the user and model text of each turn is stored. The system prompt is
+rebuilt every turn (the profile, documents and plan it carries can change), and
+tool calls stay inside the turn that made them. Which messages go to the model
+is decided by ``services/chat_history.py``, which also keeps the session's
+running summary of older messages up to date.
+"""
+import json
+import os
+import sqlite3
+import time
+import uuid
+from collections import OrderedDict
+from threading import Lock
+from typing import Any, Dict, List, Optional
+
+from services.executor import BoundedExecutor
+from services.tokens import estimate_tokens
+
+SESSION_MEMORY_SIZE = int(os.getenv("CHAT_SESSION_MEMORY_SIZE", "2000"))
+# Idle seconds after which a session is forgotten
+SESSION_TTL = float(os.getenv("CHAT_SESSION_TTL", "86400"))
+# Messages kept per session; older ones are dropped
+SESSION_MAX_MESSAGES = int(os.getenv("CHAT_SESSION_MAX_MESSAGES", "100"))
+SESSION_DB_PATH = os.getenv("CHAT_SESSION_DB") or None
+
+# Client roles mapped to Gemini's
+_ROLES = {"user": "user", "assistant": "model", "model": "model"}
+
+
+class ChatSession:
+    """
+    One conversation: its owner, Gemini-style messages with their token counts,
+    and a summary of its older messages.
+
+    Message positions in ``dropped``/``summarized`` count from the start of the
+    conversation, including messages the size cap has since dropped.
+    """
+
+    def __init__(self, session_id: str, user_id: str, kind: str, messages: Optional[List[Dict]] = None,
+                 updated_at: Optional[float] = None, summary: str = "", summarized: int = 0, dropped: int = 0):
+        self.session_id = session_id
+        self.user_id = user_id
+        self.kind = kind  # "query" or "refine"; a session only serves the endpoint that created it
+        self.messages: List[Dict[str, Any]] = messages or []
+        self.message_tokens = [estimate_tokens(message["parts"][0]) for message in self.messages]
+        self.updated_at = updated_at or time.time()
+        self.dropped = dropped  # Messages removed by the size cap
+        self.summary = summary  # Summary of the first `summarized` messages
+        self.summarized = summarized
+        self.summary_task = None  # Background summary update in flight
+
+    @property
+    def token_count(self) -> int:
+        return sum(self.message_tokens)
+
+    def append(self, role: str, text: str):
+        """Add a message, merging it into the previous one if both have the same role."""
+        role = _ROLES.get(role, "user")
+        if self.messages and self.messages[-1]["role"] == role:
+            self.messages[-1]["parts"][0] += f"\n\n{text}"
+            self.message_tokens[-1] = estimate_tokens(self.messages[-1]["parts"][0])
+        else:
+            self.messages.append({"role": role, "parts": [text]})
+            self.message_tokens.append(estimate_tokens(text))
+        if len(self.messages) > SESSION_MAX_MESSAGES:
+            excess = len(self.messages) - SESSION_MAX_MESSAGES
+            del self.messages[:excess]
+            del self.message_tokens[:excess]
+            self.dropped += excess
+        self.updated_at = time.time()
+
+    def expired(self) -> bool:
+        return SESSION_TTL > 0 and time.time() - self.updated_at > SESSION_TTL
+
+
+class ChatSessionStore:
+    """
+    In-memory LRU of chat sessions with an optional SQLite write-through.
+
+    SQLite calls are blocking, so they run on a single worker thread that owns
+    the connection.
+    """
+
+    def __init__(self, memory_size: int = SESSION_MEMORY_SIZE, db_path: Optional[str] = SESSION_DB_PATH):
+        self.memory_size = memory_size
+        self.db_path = db_path
+        self.created = 0
+        self.restored = 0
+        self.spilled = 0
+        self.expired = 0
+        self._sessions: "OrderedDict[str, ChatSession]" = OrderedDict()
+        self._lock = Lock()
+        self._db: Optional[sqlite3.Connection] = None
+        self._executor = BoundedExecutor("chat_sessions", max_workers=1, max_queue=256) if db_path else None
+
+    # SQLite side, run on the executor thread only
+
+    def _connection(self) -> sqlite3.Connection:
+        if self._db is None:
+            self._db = sqlite3.connect(self.db_path)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS chat_sessions ("
+                "session_id TEXT PRIMARY KEY, user_id TEXT NOT NULL, kind TEXT NOT NULL, "
+                "state TEXT NOT NULL, updated_at REAL NOT NULL)"
+            )
+        return self._db
+
+    def _write(self, sessions: List[ChatSession]):
+        db = self._connection()
+        with db:
+            db.executemany(
+                "INSERT OR REPLACE INTO chat_sessions VALUES (?, ?, ?, ?, ?)",
+                [
+                    (session.session_id, session.user_id, session.kind, json.dumps({
+                        "messages": session.messages,
+                        "summary": session.summary,
+                        "summarized": session.summarized,
+                        "dropped": session.dropped,
+                    }), session.updated_at)
+                    for session in sessions
+                ],
+            )
+            if SESSION_TTL > 0:
+                db.execute("DELETE FROM chat_sessions WHERE updated_at < ?", (time.time() - SESSION_TTL,))
+
+    def _read(self, session_id: str) -> Optional[ChatSession]:
+        db = self._connection()
+        row = db.execute(
+            "SELECT user_id, kind, state, updated_at FROM chat_sessions WHERE session_id = ?", (session_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        user_id, kind, state, updated_at = row
+        return ChatSession(session_id, user_id, kind, updated_at=updated_at, **json.loads(state))
+
+    def _remove(self, session_id: str):
+        with self._connection() as db:
+            db.execute("DELETE FROM chat_sessions WHERE session_id = ?", (session_id,))
+
+    # In-memory side
+
+    async def _remember(self, session: ChatSession):
+        """Put a session in memory, spilling whatever that evicts."""
+        evicted = []
+        with self._lock:
+            self._sessions[session.session_id] = session
+            self._sessions.move_to_end(session.session_id)
+            while len(self._sessions) > max(1, self.memory_size):
+                evicted.append(self._sessions.popitem(last=False)[1])
+        evicted = [old for old in evicted if not old.expired()]
+        if evicted and self._executor is not None:
+            self.spilled += len(evicted)
+            await self._executor.run(self._write, evicted)
+
+    async def get(self, session_id: str, user_id: str, kind: str) -> Optional[ChatSession]:
+        """The user's session of this kind, or None if it is unknown, expired or not theirs."""
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is not None:
+                self._sessions.move_to_end(session_id)
+        if self._executor is not None:
+            # Another worker may have stored newer turns than this process has seen
+            stored = await self._executor.run(self._read, session_id)
+            if stored is not None and (session is None or stored.updated_at > session.updated_at):
+                session = stored
+                self.restored += 1
+                await self._remember(session)
+        if session is None:
+            return None
+        if session.expired():
+            self.expired += 1
+            await self.delete(session_id, session.user_id)
+            return None
+        if session.user_id != str(user_id) or session.kind != kind:
+            return None
+        return session
+
+    async def open(self, session_id: Optional[str], user_id: str, kind: str,
+                   seed_history: Optional[List[Dict]] = None, message: Optional[str] = None) -> ChatSession:
+        """
+        The session to continue, or a new one.
+
+        Args:
+            session_id: Id the client got from a previous response, if any
+            user_id: The signed-in user; a session never serves anyone else
+            kind: Endpoint the session belongs to ("query" or "refine")
+            seed_history: ``[{"role", "content"}]`` messages from clients that
+                still send the transcript; only used to start a new session
+            message: The message this request answers; a trailing copy of it in
+                ``seed_history`` is dropped, since the turn records it
+
+        Returns:
+            The existing session, or a new one (with a new id) if the id was
+            missing, unknown or expired
+        """
+        if session_id:
+            session = await self.get(session_id, user_id, kind)
+            if session is not None:
+                return session
+            print(f"[SESSION] Session {session_id} not found, starting a new one")
+
+        seed_history = list(seed_history or [])
+        if seed_history and message is not None:
+            last = seed_history[-1]
+            if _ROLES.get(last.get("role", "user"), "user") == "user" and str(last.get("content")) == message:
+                seed_history.pop()
+        session = ChatSession(uuid.uuid4().hex, str(user_id), kind)
+        for seed in seed_history[-SESSION_MAX_MESSAGES:]:
+            content = seed.get("content")
+            if content:
+                session.append(seed.get("role", "user"), str(content))
+        self.created += 1
+        await self._remember(session)
+        return session
+
+    async def record_turn(self, session: ChatSession, user_text: str, model_text: str):
+        """
+        Append a completed exchange and write the session through to SQLite,
+        so any worker can continue it. An empty model reply stores nothing, so
+        the next turn can retry.
+        """
+        if not model_text:
+            return
+        session.append("user", user_text)
+        session.append("model", model_text)
+        await self._remember(session)
+        if self._executor is not None:
+            await self._executor.run(self._write, [session])
+
+    async def delete(self, session_id: str, user_id: str) -> bool:
+        """Forget a session; False if the user has no session with that id."""
+        with self._lock:
+            session = self._sessions.get(session_id)
+        if session is None and self._executor is not None:
+            session = await self._executor.run(self._read, session_id)
+        if session is None or session.user_id != str(user_id):
+            return False
+        with self._lock:
+            self._sessions.pop(session_id, None)
+        if self._executor is not None:
+            await self._executor.run(self._remove, session_id)
+        return True
+
+    async def flush(self):
+        """Spill every live in-memory session to SQLite (no-op without CHAT_SESSION_DB)."""
+        if self._executor is None:
+            return
+        with self._lock:
+            sessions = [session for session in self._sessions.values() if not session.expired()]
+        if sessions:
+            await self._executor.run(self._write, sessions)
+            print(f"[SESSION] Saved {len(sessions)} chat sessions to {self.db_path}")
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            sessions = list(self._sessions.values())
+        return {
+            "in_memory": len(sessions),
+            "memory_size": self.memory_size,
+            "tokens_in_memory": sum(session.token_count for session in sessions),
+            "created": self.created,
+            "restored": self.restored,
+            "spilled": self.spilled,
+            "expired": self.expired,
+            "spill_db": self.db_path,
+        }
+
+
+chat_sessions = ChatSessionStore()
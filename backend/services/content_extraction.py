@@ -9,6 +9,9 @@ from typing import Optional
 from docling.document_converter import DocumentConverter
 import google.generativeai as genai
 from config import get_settings
+from services.model_backend import create_model
+from services.llm import SUMMARY_TIMEOUT, Priority, request_options
+from services.resilience import SUMMARY_BUDGET, Deadline, call_with_retries
 
 
 # Initialize Docling converter (reuse across requests)
@@ -111,7 +114,7 @@ async def summarize_document(extracted_content: str, filename: str) -> str:
     try:
         settings = get_settings()
         genai.configure(api_key=settings.google_api_key)
-        model = genai.GenerativeModel('gemini-2.5-flash')
+        model = create_model('gemini-2.5-flash')
         
         # Create summarization prompt
         prompt = f"""
@@ -130,7 +133,17 @@ Content:
 Provide a clear, structured summary in 200-300 words that captures the essential financial information.
 """
         
-        response = model.generate_content(prompt)
+        deadline = Deadline(SUMMARY_BUDGET)
+        response = await call_with_retries(
+            lambda: model.generate_content_async(
+                prompt,
+                request_options=request_options(deadline.attempt_timeout(SUMMARY_TIMEOUT, "Document summarization"))
+            ),
+            "Document summarization",
+            Priority.BACKGROUND,
+            deadline,
+            SUMMARY_TIMEOUT
+        )
         summary = response.text.strip()
         
         if not summary:
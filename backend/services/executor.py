@@ -0,0 +1,91 @@
+"""
+Bounded thread pools for running blocking work from async request handlers.
+"""
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from typing import Any, Callable, Dict
+
+
+class BoundedExecutor:
+    """
+    Thread pool with a bounded backlog and queue-depth metrics.
+
+    At most ``max_workers`` calls run at once and at most ``max_queue`` more wait
+    in the pool's queue; further callers wait (without blocking the event loop)
+    until a slot frees up.
+    """
+
+    def __init__(self, name: str, max_workers: int, max_queue: int):
+        self.name = name
+        self.max_workers = max(1, max_workers)
+        self.max_queue = max(0, max_queue)
+        self._pool = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix=name)
+        self._slots = None
+        self._lock = Lock()
+        self._queued = 0
+        self._running = 0
+        self._completed = 0
+        self._cancelled = 0
+        self._max_queue_depth = 0
+
+    def _get_slots(self) -> asyncio.Semaphore:
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_workers + self.max_queue)
+        return self._slots
+
+    def _run(self, call: Dict[str, bool], fn: Callable, *args, **kwargs) -> Any:
+        with self._lock:
+            if call["cancelled"]:
+                return None  # Its caller gave up while it was queued
+            call["started"] = True
+            self._queued -= 1
+            self._running += 1
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            with self._lock:
+                self._running -= 1
+                self._completed += 1
+
+    async def run(self, fn: Callable, *args, **kwargs) -> Any:
+        """
+        Run fn(*args, **kwargs) on the pool and await its result.
+
+        Cancelling the caller skips the call if it has not started yet; a call
+        already running on a thread finishes and its result is dropped.
+        """
+        async with self._get_slots():
+            with self._lock:
+                self._queued += 1
+                self._max_queue_depth = max(self._max_queue_depth, self._queued)
+            loop = asyncio.get_running_loop()
+            call = {"started": False, "cancelled": False}
+            try:
+                future = loop.run_in_executor(self._pool, functools.partial(self._run, call, fn, *args, **kwargs))
+            except BaseException:
+                with self._lock:
+                    self._queued -= 1
+                raise
+            try:
+                return await future
+            except asyncio.CancelledError:
+                with self._lock:
+                    if not call["started"]:
+                        call["cancelled"] = True
+                        self._queued -= 1
+                        self._cancelled += 1
+                raise
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "max_workers": self.max_workers,
+                "max_queue": self.max_queue,
+                "queue_depth": self._queued,
+                "running": self._running,
+                "completed": self._completed,
+                "cancelled": self._cancelled,
+                "max_queue_depth": self._max_queue_depth,
+            }
@@ -0,0 +1,352 @@
+"""
+Deterministic local stand-in for the Gemini SDK, for offline load testing.
+
+``FakeGenerativeModel`` implements the parts of ``genai.GenerativeModel`` the
+backend uses (``generate_content``/``generate_content_async``, ``start_chat``
+and chat ``send_message``/``send_message_async``, streaming or not) and answers
+without any network access:
+
+- prompts asking for a JSON plan get a valid plan with every required field
+- with tools declared, a share of messages get one or more function calls to
+  the declared tools, with arguments built from their parameter schemas; the
+  function responses get a text reply
+- anything else gets filler text (or ``FAKE_LLM_TEXT``)
+
+Content is derived from the prompt, so the same prompt always gets the same
+answer. Latency (time to first token, then ``FAKE_LLM_TOKENS_PER_SECOND``),
+slow-tail calls and injected errors come from one seeded random sequence, so a
+load test run is reproducible.
+
+Enable it with ``LLM_BACKEND=fake`` (see ``services/model_backend.py``).
+"""
+import asyncio
+import hashlib
+import json
+import os
+import random
+import re
+import threading
+import time
+from typing import Any, Dict, Iterator, List, NamedTuple, Optional
+
+from google.api_core import exceptions as google_exceptions
+
+PLAN_FIELDS = ("situation", "priorities", "roadmap", "thisMonthActions", "longTermStrategy")
+
+_FILLER_WORDS = (
+    "Build an emergency fund covering three to six months of expenses before investing. "
+    "Pay down high-interest debt first, then top up EPF for the tax relief. "
+    "Automate a monthly transfer into savings on payday so spending adjusts to what is left. "
+    "Review insurance coverage, keep investment fees low and rebalance once a year."
+).split()
+
+# Values for tool parameters whose schema alone does not give a useful value
+_ARGUMENT_VALUES = {
+    "risk_tolerance": ["low", "medium", "high"],
+    "time_horizon": [10, 20, 30],
+    "current_age": [25, 35, 45],
+    "retirement_age": [55, 60, 65],
+    "expected_return": [4.0, 5.5, 7.0],
+    "goal_name": ["Emergency fund", "House deposit", "Wedding"],
+    "months": [6, 12, 24],
+    "user_id": ["fake-user"],
+    "user_profile": [{}],
+}
+
+
+class FakeModelConfig(NamedTuple):
+    ttfb: float = 0.4  # Seconds before the first token
+    tokens_per_second: float = 80.0
+    response_tokens: int = 120  # Words in a text reply
+    chunk_tokens: int = 8  # Words per streamed chunk
+    slow_share: float = 0.0  # Share of calls in the slow tail
+    slow_factor: float = 10.0  # How much slower tail calls are
+    error_rate: float = 0.0  # Share of calls failing before the first token
+    stream_error_rate: float = 0.0  # Share of streams failing after their first chunk
+    function_call_rate: float = 0.3  # Share of messages answered with tool calls
+    max_function_calls: int = 3  # Tool calls per answer, at most
+    text: Optional[str] = None  # Fixed text reply instead of filler
+    seed: int = 0
+
+    @classmethod
+    def from_env(cls) -> "FakeModelConfig":
+        return cls(
+            ttfb=float(os.getenv("FAKE_LLM_TTFB", "0.4")),
+            tokens_per_second=float(os.getenv("FAKE_LLM_TOKENS_PER_SECOND", "80")),
+            response_tokens=int(os.getenv("FAKE_LLM_RESPONSE_TOKENS", "120")),
+            chunk_tokens=int(os.getenv("FAKE_LLM_CHUNK_TOKENS", "8")),
+            slow_share=float(os.getenv("FAKE_LLM_SLOW_SHARE", "0")),
+            slow_factor=float(os.getenv("FAKE_LLM_SLOW_FACTOR", "10")),
+            error_rate=float(os.getenv("FAKE_LLM_ERROR_RATE", "0")),
+            stream_error_rate=float(os.getenv("FAKE_LLM_STREAM_ERROR_RATE", "0")),
+            function_call_rate=float(os.getenv("FAKE_LLM_FUNCTION_CALL_RATE", "0.3")),
+            max_function_calls=int(os.getenv("FAKE_LLM_MAX_FUNCTION_CALLS", "3")),
+            text=os.getenv("FAKE_LLM_TEXT") or None,
+            seed=int(os.getenv("FAKE_LLM_SEED", "0")),
+        )
+
+
+# Minimal response objects with the attributes the backend reads from SDK responses
+
+class FakeFunctionCall:
+    def __init__(self, name: str, args: Dict[str, Any]):
+        self.name = name
+        self.args = args
+
+
+class FakePart:
+    def __init__(self, text: str = "", function_call: Optional[FakeFunctionCall] = None):
+        self.text = text
+        self.function_call = function_call
+
+
+class FakeContent:
+    def __init__(self, parts: List[FakePart], role: str = "model"):
+        self.parts = parts
+        self.role = role
+
+
+class FakeCandidate:
+    def __init__(self, parts: List[FakePart], finish_reason: Optional[str] = None):
+        self.content = FakeContent(parts)
+        self.finish_reason = finish_reason
+
+
+class FakeResponse:
+    def __init__(self, parts: List[FakePart], finish_reason: Optional[str] = "STOP"):
+        self.candidates = [FakeCandidate(parts, finish_reason)]
+
+    @property
+    def text(self) -> str:
+        return "".join(part.text for part in self.candidates[0].content.parts)
+
+
+class _Reply(NamedTuple):
+    parts: List[FakePart]
+    tokens: int
+
+
+class _Timing(NamedTuple):
+    ttfb: float
+    seconds_per_token: float
+    fails: bool
+    fails_midstream: bool
+
+
+def _message_text(content: Any) -> str:
+    """Text of a prompt: a string, an SDK Content/dict with parts, or a list of either."""
+    if isinstance(content, str):
+        return content
+    if isinstance(content, (list, tuple)):
+        return "\n".join(_message_text(item) for item in content)
+    parts = content.get("parts", []) if isinstance(content, dict) else getattr(content, "parts", [])
+    return "\n".join(part if isinstance(part, str) else getattr(part, "text", "") or "" for part in parts)
+
+
+def _is_function_response(content: Any) -> bool:
+    parts = getattr(content, "parts", None) or []
+    return any(getattr(getattr(part, "function_response", None), "name", "") for part in parts)
+
+
+def _type_name(schema: Any) -> str:
+    schema_type = getattr(schema, "type", None) or getattr(schema, "type_", None)
+    return getattr(schema_type, "name", str(schema_type)).upper()
+
+
+class FakeGenerativeModel:
+    """Offline drop-in for ``genai.GenerativeModel``."""
+
+    def __init__(self, model_name: str, tools: Optional[List] = None, config: Optional[FakeModelConfig] = None):
+        self.model_name = model_name
+        self.config = config or FakeModelConfig.from_env()
+        self._declarations = [
+            declaration
+            for tool in tools or []
+            for declaration in getattr(tool, "function_declarations", [])
+        ]
+        self._timing_rng = random.Random(self.config.seed)
+        self._timing_lock = threading.Lock()  # Streams draw timings from worker threads
+
+    # -- content ---------------------------------------------------------
+
+    def _content_rng(self, prompt: str) -> random.Random:
+        digest = hashlib.sha256(f"{self.config.seed}:{self.model_name}:{prompt}".encode("utf-8")).hexdigest()
+        return random.Random(int(digest[:16], 16))
+
+    def _text(self, rng: random.Random, tokens: int) -> str:
+        if self.config.text is not None:
+            return self.config.text
+        start = rng.randrange(len(_FILLER_WORDS))
+        words = [_FILLER_WORDS[(start + index) % len(_FILLER_WORDS)] for index in range(tokens)]
+        return " ".join(words)
+
+    def _plan(self, prompt: str, rng: random.Random) -> str:
+        profile = dict(re.findall(r"^(About You|Debt|Savings|Risk Tolerance): (.*)$", prompt, re.MULTILINE))
+        about = profile.get("About You", "Not specified")
+        risk = profile.get("Risk Tolerance", "Medium")
+        plan = {
+            "situation": f"As a {about.lower()} with {profile.get('Debt', 'no').lower()} debt and "
+                         f"{profile.get('Savings', 'some')} in savings, {self._text(rng, 20)}",
+            "priorities": [self._text(rng, 8) for _ in range(3)],
+            "roadmap": self._text(rng, 60),
+            "thisMonthActions": self._text(rng, 30),
+            "longTermStrategy": f"With a {risk.lower()} risk tolerance, {self._text(rng, 50)}",
+        }
+        return json.dumps(plan)
+
+    def _arguments(self, declaration: Any, rng: random.Random) -> Dict[str, Any]:
+        parameters = getattr(declaration, "parameters", None)
+        arguments = {}
+        for name, schema in dict(getattr(parameters, "properties", {}) or {}).items():
+            if name in _ARGUMENT_VALUES:
+                arguments[name] = rng.choice(_ARGUMENT_VALUES[name])
+            elif name == "product_id":
+                arguments[name] = rng.choice(_product_ids())
+            elif name == "product_ids":
+                arguments[name] = rng.sample(_product_ids(), 2)
+            else:
+                kind = _type_name(schema)
+                if kind == "NUMBER":
+                    arguments[name] = float(rng.choice([500, 1000, 5000, 10000, 50000]))
+                elif kind == "INTEGER":
+                    arguments[name] = rng.randint(1, 30)
+                elif kind == "BOOLEAN":
+                    arguments[name] = rng.random() < 0.5
+                elif kind == "ARRAY":
+                    arguments[name] = []
+                elif kind == "OBJECT":
+                    arguments[name] = {}
+                else:
+                    arguments[name] = self._text(rng, 3)
+        return arguments
+
+    def _reply(self, content: Any, allow_tools: bool) -> _Reply:
+        prompt = _message_text(content)
+        rng = self._content_rng(prompt)
+        if '"longTermStrategy"' in prompt and "valid JSON" in prompt:
+            text = self._plan(prompt, rng)
+            return _Reply([FakePart(text)], len(text.split()))
+        if (
+            allow_tools
+            and self._declarations
+            and not _is_function_response(content)
+            and rng.random() < self.config.function_call_rate
+        ):
+            count = rng.randint(1, max(1, min(self.config.max_function_calls, len(self._declarations))))
+            parts = [
+                FakePart(function_call=FakeFunctionCall(declaration.name, self._arguments(declaration, rng)))
+                for declaration in rng.sample(self._declarations, count)
+            ]
+            return _Reply(parts, 10 * count)
+        text = self._text(rng, self.config.response_tokens)
+        return _Reply([FakePart(text)], len(text.split()))
+
+    # -- timing ----------------------------------------------------------
+
+    def _timing(self) -> _Timing:
+        config = self.config
+        with self._timing_lock:
+            rng = self._timing_rng
+            ttfb = config.ttfb * rng.lognormvariate(0, 0.25)
+            seconds_per_token = 1 / config.tokens_per_second if config.tokens_per_second > 0 else 0.0
+            if rng.random() < config.slow_share:
+                ttfb *= config.slow_factor
+                seconds_per_token *= config.slow_factor
+            return _Timing(
+                ttfb,
+                seconds_per_token,
+                rng.random() < config.error_rate,
+                rng.random() < config.stream_error_rate,
+            )
+
+    @staticmethod
+    def _check_deadline(seconds: float, request_options: Optional[Dict]) -> Optional[float]:
+        """The request timeout if the call would run past it, else None."""
+        timeout = (request_options or {}).get("timeout")
+        if timeout is not None and seconds > timeout:
+            return timeout
+        return None
+
+    def _failure(self, timing: _Timing, timeout: Optional[float]) -> Optional[Exception]:
+        if timeout is not None:
+            return google_exceptions.DeadlineExceeded(f"Fake model: deadline of {timeout:g}s exceeded")
+        if timing.fails:
+            return google_exceptions.ServiceUnavailable("Fake model: injected error")
+        return None
+
+    # -- SDK surface -----------------------------------------------------
+
+    def generate_content(self, contents: Any, generation_config=None, request_options=None, stream: bool = False, **kwargs):
+        return self._generate(contents, request_options, stream, allow_tools=True)
+
+    async def generate_content_async(self, contents: Any, generation_config=None, request_options=None, **kwargs):
+        return await self._generate_async(contents, request_options, allow_tools=True)
+
+    def start_chat(self, history: Optional[List] = None, enable_automatic_function_calling: bool = False):
+        return FakeChatSession(self, history)
+
+    def _generate(self, contents: Any, request_options: Optional[Dict], stream: bool, allow_tools: bool):
+        reply = self._reply(contents, allow_tools)
+        timing = self._timing()
+        total = timing.ttfb + reply.tokens * timing.seconds_per_token
+        timeout = self._check_deadline(timing.ttfb if stream else total, request_options)
+        time.sleep(timeout if timeout is not None else timing.ttfb)
+        failure = self._failure(timing, timeout)
+        if failure is not None:
+            raise failure
+        if stream:
+            # Like the SDK, the first chunk has arrived by the time the call returns
+            return self._chunks(reply, timing)
+        time.sleep(total - timing.ttfb)
+        return FakeResponse(reply.parts)
+
+    async def _generate_async(self, contents: Any, request_options: Optional[Dict], allow_tools: bool):
+        reply = self._reply(contents, allow_tools)
+        timing = self._timing()
+        total = timing.ttfb + reply.tokens * timing.seconds_per_token
+        timeout = self._check_deadline(total, request_options)
+        await asyncio.sleep(timeout if timeout is not None else total)
+        failure = self._failure(timing, timeout)
+        if failure is not None:
+            raise failure
+        return FakeResponse(reply.parts)
+
+    def _chunks(self, reply: _Reply, timing: _Timing) -> Iterator[FakeResponse]:
+        parts = reply.parts
+        if parts[0].function_call is not None:
+            yield FakeResponse(parts, finish_reason="STOP")
+            return
+        words = parts[0].text.split(" ")
+        size = max(1, self.config.chunk_tokens)
+        for start in range(0, len(words), size):
+            if start:
+                time.sleep(size * timing.seconds_per_token)
+                if timing.fails_midstream and start >= len(words) // 2:
+                    raise google_exceptions.InternalServerError("Fake model: injected stream error")
+            last = start + size >= len(words)
+            text = " ".join(words[start:start + size]) + ("" if last else " ")
+            yield FakeResponse([FakePart(text)], finish_reason="STOP" if last else None)
+
+
+class FakeChatSession:
+    """Chat session over ``FakeGenerativeModel``; like the SDK, history only grows on success."""
+
+    def __init__(self, model: FakeGenerativeModel, history: Optional[List] = None):
+        self.model = model
+        self.history = list(history or [])
+
+    def send_message(self, content: Any, generation_config=None, request_options=None, stream: bool = False, **kwargs):
+        response = self.model._generate(content, request_options, stream, allow_tools=True)
+        self.history.append(content)
+        return response
+
+    async def send_message_async(self, content: Any, generation_config=None, request_options=None, **kwargs):
+        response = await self.model._generate_async(content, request_options, allow_tools=True)
+        self.history.extend([content, response.candidates[0].content])
+        return response
+
+
+def _product_ids() -> List[str]:
+    # Imported lazily: the tools module pulls in the Supabase client
+    from services.retirement_tools import INVESTMENT_PRODUCTS
+    return sorted(INVESTMENT_PRODUCTS)
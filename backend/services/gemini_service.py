@@ -1,10 +1,26 @@
 import os
+import copy
+import hashlib
 import json
 import re
+import asyncio
 import google.generativeai as genai
 from dotenv import load_dotenv
-from typing import Dict, List
+from typing import Dict, List, Optional
+from services.cache import LRUCache
 from services.retirement_tools import execute_tool
+from services.model_backend import create_model
+from services.llm import (
+    CHAT_TIMEOUT,
+    PLAN_TIMEOUT,
+    LLMTimeoutError,
+    Priority,
+    PriorityLike,
+    request_options,
+    tool_executor
+)
+from services.resilience import CHAT_BUDGET, PLAN_BUDGET, Deadline, call_with_retries
+from services.chat_history import with_summary
 
 load_dotenv()
 
@@ -151,14 +167,57 @@ retirement_tools = genai.protos.Tool(
     ]
 )
 
+MODEL_NAME = 'gemini-2.5-flash'
+
 # Initialize the model with tools
-model = genai.GenerativeModel(
-    'gemini-2.5-flash',
+model = create_model(
+    MODEL_NAME,
     tools=[retirement_tools]
 )
 
-async def generate_financial_plan(user_answers: Dict, context: str):
-    """Generate a personalized financial plan using Google Gemini."""
+# Bump whenever the plan prompt changes so plans generated from the old prompt are not served
+PLAN_PROMPT_VERSION = 1
+
+PLAN_ANSWER_FIELDS = ("aboutYou", "income", "expenses", "debt", "savings", "riskTolerance")
+
+# Generated plans keyed on (normalized answers, context hash, prompt version, model)
+plan_cache = LRUCache(
+    max_size=int(os.getenv("PLAN_CACHE_SIZE", "1024")),
+    ttl=float(os.getenv("PLAN_CACHE_TTL", "86400")) or None,
+)
+
+def normalize_answers(user_answers: Dict) -> tuple:
+    """Questionnaire answers as a hashable tuple; values differing only in case or whitespace are equal."""
+    return tuple(
+        " ".join(str(user_answers.get(field, "Not specified")).split()).casefold()
+        for field in PLAN_ANSWER_FIELDS
+    )
+
+def plan_cache_key(user_answers: Dict, context: str):
+    """Cache key for a plan generated from these answers and RAG context."""
+    context_hash = hashlib.sha256(context.encode("utf-8")).hexdigest()[:16]
+    return (normalize_answers(user_answers), context_hash, PLAN_PROMPT_VERSION, MODEL_NAME)
+
+async def generate_financial_plan(
+    user_answers: Dict,
+    context: str,
+    use_cache: bool = True,
+    priority: PriorityLike = Priority.PLAN
+):
+    """
+    Generate a personalized financial plan using Google Gemini.
+
+    Plans are cached per profile and context; pass use_cache=False to force a
+    fresh generation (the result still replaces the cached plan). Speculative
+    callers pass Priority.BACKGROUND so they yield to plans users are waiting on,
+    or a function returning the job's current priority so it can be raised.
+    """
+    cache_key = plan_cache_key(user_answers, context)
+    if use_cache:
+        cached_plan = plan_cache.get(cache_key)
+        if cached_plan is not None:
+            return copy.deepcopy(cached_plan)
+
     system_prompt = """You are a certified financial advisor with expertise in personal finance planning for Malaysian residents (RM currency). 
 Generate a comprehensive, actionable financial plan based on user responses and relevant financial guidance.
 
@@ -198,12 +257,21 @@ Return ONLY valid JSON, no markdown formatting or code blocks."""
     try:
         full_prompt = f"{system_prompt}\n\n{user_prompt}"
         
-        response = model.generate_content(
-            full_prompt,
-            generation_config=genai.GenerationConfig(
-                temperature=0.7,
-                max_output_tokens=8000,
-            )
+        deadline = Deadline(PLAN_BUDGET)
+        response = await call_with_retries(
+            lambda: model.generate_content_async(
+                full_prompt,
+                generation_config=genai.GenerationConfig(
+                    temperature=0.7,
+                    max_output_tokens=8000,
+                ),
+                request_options=request_options(deadline.attempt_timeout(PLAN_TIMEOUT, "Plan generation"))
+            ),
+            "Plan generation",
+            priority,
+            deadline,
+            PLAN_TIMEOUT,
+            hedge=True
         )
 
         response_text = response.text.strip()
@@ -221,14 +289,71 @@ Return ONLY valid JSON, no markdown formatting or code blocks."""
             missing = [f for f in required_fields if f not in plan]
             raise ValueError(f"Invalid plan structure. Missing: {missing}")
 
+        plan_cache.set(cache_key, copy.deepcopy(plan))
         return plan
+    except LLMTimeoutError:
+        raise
     except json.JSONDecodeError as e:
         raise Exception(f"Failed to parse Gemini response: {str(e)}")
     except Exception as error:
         raise Exception(f"Failed to generate plan: {str(error)}")
 
-async def refine_financial_plan(message: str, plan_data: Dict, chat_history: List[Dict], context: str):
-    """Refine financial plan through chat interaction using Google Gemini with function calling."""
+def function_calls_in(parts) -> List:
+    """The function_call parts of a model response, in the order the model emitted them."""
+    return [part.function_call for part in parts if hasattr(part, 'function_call') and part.function_call]
+
+async def execute_function_calls(function_calls: List, extra_parameters: Optional[Dict[str, Dict]] = None) -> List[Dict]:
+    """
+    Run every function call of one model turn concurrently on the tool pool.
+
+    Args:
+        function_calls: function_call parts from a single model response
+        extra_parameters: Parameters to add per tool name (e.g. the user_id)
+
+    Returns:
+        One {"tool", "parameters", "result"} dict per call, in call order
+    """
+    calls = []
+    for function_call in function_calls:
+        parameters = dict(function_call.args.items())
+        parameters.update((extra_parameters or {}).get(function_call.name, {}))
+        print(f"[TOOL CALL] {function_call.name} with params: {parameters}")
+        calls.append((function_call.name, parameters))
+
+    results = await asyncio.gather(*(
+        tool_executor.run(execute_tool, tool_name, parameters)
+        for tool_name, parameters in calls
+    ))
+    return [
+        {"tool": tool_name, "parameters": parameters, "result": result}
+        for (tool_name, parameters), result in zip(calls, results)
+    ]
+
+def function_responses(tool_calls: List[Dict]):
+    """One message carrying a FunctionResponse part per executed call, answering the whole turn at once."""
+    return genai.protos.Content(
+        parts=[
+            genai.protos.Part(
+                function_response=genai.protos.FunctionResponse(
+                    name=tool_call["tool"],
+                    response={"result": tool_call["result"]}
+                )
+            )
+            for tool_call in tool_calls
+        ]
+    )
+
+async def refine_financial_plan(message: str, plan_data: Dict, history: List[Dict], context: str, summary: str = ""):
+    """
+    Refine financial plan through chat interaction using Google Gemini with function calling.
+
+    Args:
+        message: The user's new message
+        plan_data: The plan being refined
+        history: Recent turns of the conversation, as ``start_chat`` history
+        context: Relevant financial guidance
+        summary: Summary of the turns before ``history`` (see ``compact_history``)
+    """
     system_prompt = f"""You are a financial advisor assistant helping users refine their financial plan.
 You have access to their current financial plan and can answer questions, suggest improvements, or clarify aspects of their plan.
 
@@ -260,31 +385,33 @@ Current Financial Plan:
 Relevant Financial Guidance:
 {context}"""
 
-    # Build conversation history
-    conversation_parts = [system_prompt]
-
-    # Add chat history (last 10 messages to avoid token limits)
-    recent_history = chat_history[-10:] if chat_history else []
-    for msg in recent_history:
-        role = msg.get("role", "user")
-        content = msg.get("content", "")
-        conversation_parts.append(f"{role.upper()}: {content}")
+    # Earlier turns go to the chat as history; the system prompt (with the current plan) is sent with the new message
+    conversation = f"{with_summary(system_prompt, summary)}\n\nUSER: {message}"
 
-    # Add current message
-    conversation_parts.append(f"USER: {message}")
-    
-    conversation = "\n\n".join(conversation_parts)
+    deadline = Deadline(CHAT_BUDGET)
 
-    try:
-        # Start chat with function calling enabled
-        chat = model.start_chat(enable_automatic_function_calling=False)
-        
-        response = chat.send_message(
+    async def start_refinement():
+        # A fresh chat per attempt, so a hedged duplicate never shares session history
+        attempt_chat = model.start_chat(history=history, enable_automatic_function_calling=False)
+        attempt_response = await attempt_chat.send_message_async(
             conversation,
             generation_config=genai.GenerationConfig(
                 temperature=0.7,
                 max_output_tokens=4000,
-            )
+            ),
+            request_options=request_options(deadline.attempt_timeout(CHAT_TIMEOUT, "Plan refinement"))
+        )
+        return attempt_chat, attempt_response
+
+    try:
+        # Start chat with function calling enabled
+        chat, response = await call_with_retries(
+            start_refinement,
+            "Plan refinement",
+            Priority.INTERACTIVE,
+            deadline,
+            CHAT_TIMEOUT,
+            hedge=True
         )
 
         # Handle function calls
@@ -293,46 +420,40 @@ Relevant Financial Guidance:
         
         # Check if model wants to call functions
         while response.candidates[0].content.parts:
-            part = response.candidates[0].content.parts[0]
+            parts = response.candidates[0].content.parts
+            function_calls = function_calls_in(parts)
             
-            # Check if it's a function call
-            if hasattr(part, 'function_call') and part.function_call:
-                function_call = part.function_call
-                tool_name = function_call.name
-                
-                # Extract parameters
-                parameters = {}
-                for key, value in function_call.args.items():
-                    parameters[key] = value
-                
-                print(f"[TOOL CALL] {tool_name} with params: {parameters}")
-                
-                # Execute the tool
-                tool_result = execute_tool(tool_name, parameters)
-                
-                # Store tool call info
-                tool_calls.append({
-                    "tool": tool_name,
-                    "parameters": parameters,
-                    "result": tool_result
-                })
-                
-                # Send tool result back to model
-                response = chat.send_message(
-                    genai.protos.Content(
-                        parts=[genai.protos.Part(
-                            function_response=genai.protos.FunctionResponse(
-                                name=tool_name,
-                                response={"result": tool_result}
-                            )
-                        )]
-                    )
-                )
-            else:
+            if not function_calls:
                 # Regular text response
-                if hasattr(part, 'text'):
-                    final_response_text = part.text
+                final_response_text = "".join(
+                    part.text for part in parts if hasattr(part, 'text') and part.text
+                )
                 break
+            
+            # Run all calls of this turn concurrently and answer them in one message
+            turn_calls = await execute_function_calls(function_calls)
+            tool_calls.extend(turn_calls)
+            
+            # Send tool results back to model, each attempt on a session rebuilt from this
+            # turn's history, so a retry never shares a session with an abandoned attempt
+            turn_history = list(chat.history)
+            tool_results = function_responses(turn_calls)
+
+            async def send_tool_results():
+                attempt_chat = model.start_chat(history=turn_history, enable_automatic_function_calling=False)
+                attempt_response = await attempt_chat.send_message_async(
+                    tool_results,
+                    request_options=request_options(deadline.attempt_timeout(CHAT_TIMEOUT, "Plan refinement"))
+                )
+                return attempt_chat, attempt_response
+
+            chat, response = await call_with_retries(
+                send_tool_results,
+                "Plan refinement",
+                Priority.INTERACTIVE,
+                deadline,
+                CHAT_TIMEOUT
+            )
 
         # If no text response yet, get it from the response
         if not final_response_text and response.text:
@@ -365,6 +486,8 @@ Relevant Financial Guidance:
             result["toolCalls"] = tool_calls
 
         return result
+    except LLMTimeoutError:
+        raise
     except Exception as error:
         print(f"Error in refine_financial_plan: {error}")
         raise Exception(f"Failed to refine plan: {str(error)}")
@@ -0,0 +1,285 @@
+"""
+Shared plumbing for calling Gemini from async request handlers.
+
+Model calls go through the SDK's async API (``generate_content_async``,
+``send_message_async``), so a worker can keep hundreds of them in flight without
+blocking the event loop. Every call gets a deadline: the SDK cancels the RPC
+when ``request_options["timeout"]`` expires, and ``with_deadline`` bounds the
+await itself so a stuck call can never hold a request forever.
+
+Every call is also admitted by ``llm_scheduler``, which shares the Gemini quota
+between callers: a token bucket caps the request rate, a semaphore caps calls in
+flight, and waiting calls are admitted by priority, so a burst of document
+summaries cannot starve interactive chat. A priority can also be given as a
+function: it is read again on every admission and while the call waits, so a
+speculative call can be raised once a user starts waiting on its result.
+"""
+import asyncio
+import collections
+import contextlib
+import enum
+import os
+import time
+from typing import Any, AsyncIterator, Awaitable, Callable, Deque, Dict, List, Optional, Set, Union
+
+from google.api_core import exceptions as google_exceptions
+
+from services.executor import BoundedExecutor
+
+# Per-call deadlines in seconds
+PLAN_TIMEOUT = float(os.getenv("GEMINI_PLAN_TIMEOUT", "60"))
+CHAT_TIMEOUT = float(os.getenv("GEMINI_CHAT_TIMEOUT", "30"))
+SUMMARY_TIMEOUT = float(os.getenv("GEMINI_SUMMARY_TIMEOUT", "45"))
+
+# Tools are plain blocking functions (some query Supabase), so they run here
+tool_executor = BoundedExecutor(
+    "tools",
+    max_workers=int(os.getenv("TOOL_POOL_SIZE", "8")),
+    max_queue=int(os.getenv("TOOL_MAX_QUEUE", "128")),
+)
+
+
+class LLMTimeoutError(TimeoutError):
+    """A model call did not finish before its deadline."""
+
+
+class Priority(enum.IntEnum):
+    """Scheduling class of a model call; lower values are admitted first."""
+
+    INTERACTIVE = 0  # Chat: a user is watching the reply arrive
+    PLAN = 1  # Plan generation the user asked for
+    BACKGROUND = 2  # Document summaries and speculative plans
+
+
+# A fixed priority, or a function returning the current one
+PriorityLike = Union[Priority, Callable[[], Priority]]
+
+
+class _Waiter:
+    __slots__ = ("future", "enqueued", "priority", "current")
+
+    def __init__(self, future: asyncio.Future, priority: Priority, current: Optional[Callable[[], Priority]]):
+        self.future = future
+        self.enqueued = time.perf_counter()
+        self.priority = priority  # Class it waits in, then the class it was admitted under
+        self.current = current
+
+
+class LLMScheduler:
+    """
+    Admission control for model calls: rate limit, in-flight cap and priorities.
+
+    A call is admitted once it holds a rate token and an in-flight slot. Waiting
+    calls are admitted strictly by priority, first come first served within a
+    class, and background calls may only hold ``background_limit`` of the slots
+    so interactive calls always find free capacity.
+    """
+
+    def __init__(
+        self,
+        max_in_flight: int,
+        rate_per_minute: float,
+        burst: int,
+        background_limit: int,
+        wait_samples: int = 1000,
+    ):
+        self.max_in_flight = max(1, max_in_flight)
+        self.rate = max(0.0, rate_per_minute) / 60  # Tokens per second; 0 disables the limit
+        self.burst = max(1, burst)
+        self.limits = {
+            Priority.INTERACTIVE: self.max_in_flight,
+            Priority.PLAN: self.max_in_flight,
+            Priority.BACKGROUND: max(1, min(background_limit, self.max_in_flight)),
+        }
+        self._tokens = float(self.burst)
+        self._refilled = time.monotonic()
+        self._refill_timer: Optional[asyncio.TimerHandle] = None
+        self._waiters: Dict[Priority, Deque[_Waiter]] = {p: collections.deque() for p in Priority}
+        self._in_flight = dict.fromkeys(Priority, 0)
+        self._admitted = dict.fromkeys(Priority, 0)
+        self._waits: Dict[Priority, Deque[float]] = {
+            p: collections.deque(maxlen=wait_samples) for p in Priority
+        }
+        self._max_wait = dict.fromkeys(Priority, 0.0)
+        # Waiting calls whose priority may still be raised
+        self._raisable: Set[_Waiter] = set()
+
+    def _refill(self):
+        now = time.monotonic()
+        if self.rate:
+            self._tokens = min(self.burst, self._tokens + (now - self._refilled) * self.rate)
+        else:
+            self._tokens = float(self.burst)
+        self._refilled = now
+
+    def _promote(self):
+        """Move waiters whose priority was raised while they waited to their new class."""
+        for waiter in list(self._raisable):
+            if waiter.future.done():
+                self._raisable.discard(waiter)
+                continue
+            priority = waiter.current()
+            if priority < waiter.priority:
+                self._waiters[waiter.priority].remove(waiter)
+                waiter.priority = priority
+                self._waiters[priority].append(waiter)
+
+    def _next_class(self) -> Optional[Priority]:
+        """Highest priority class with a live waiter and a free slot."""
+        self._promote()
+        if sum(self._in_flight.values()) >= self.max_in_flight:
+            return None
+        for priority in Priority:
+            waiters = self._waiters[priority]
+            while waiters and waiters[0].future.done():
+                waiters.popleft()  # Cancelled while waiting
+            if waiters and self._in_flight[priority] < self.limits[priority]:
+                return priority
+        return None
+
+    def _dispatch(self):
+        self._refill_timer = None
+        self._refill()
+        while True:
+            priority = self._next_class()
+            if priority is None:
+                return
+            if self._tokens < 1:
+                delay = (1 - self._tokens) / self.rate
+                self._refill_timer = asyncio.get_running_loop().call_later(delay, self._dispatch)
+                return
+            waiter = self._waiters[priority].popleft()
+            self._raisable.discard(waiter)
+            self._admit(priority, waiter.enqueued)
+            waiter.future.set_result(None)
+
+    def reprioritize(self):
+        """Re-read the priority of waiting calls now (call after raising one)."""
+        if self._refill_timer is None:
+            self._dispatch()
+
+    def _admit(self, priority: Priority, enqueued: float):
+        wait = time.perf_counter() - enqueued
+        self._tokens -= 1
+        self._in_flight[priority] += 1
+        self._admitted[priority] += 1
+        self._waits[priority].append(wait)
+        self._max_wait[priority] = max(self._max_wait[priority], wait)
+
+    def _release(self, priority: Priority):
+        self._in_flight[priority] -= 1
+        if self._refill_timer is None:
+            self._dispatch()
+
+    @contextlib.asynccontextmanager
+    async def slot(self, priority: PriorityLike, timeout: Optional[float] = None) -> AsyncIterator[None]:
+        """
+        Hold an admission for the duration of the block (e.g. a whole stream).
+
+        Args:
+            priority: Scheduling class, or a function returning it; a function is
+                called now and again while the call waits, so the call moves up
+                if its priority is raised
+            timeout: Seconds to wait for admission (None waits indefinitely)
+
+        Raises:
+            LLMTimeoutError: Not admitted within ``timeout`` seconds
+        """
+        current = priority if callable(priority) else None
+        waiter = _Waiter(asyncio.get_running_loop().create_future(), current() if current else priority, current)
+        self._waiters[waiter.priority].append(waiter)
+        if current is not None:
+            self._raisable.add(waiter)
+        if self._refill_timer is None:
+            self._dispatch()
+        try:
+            await asyncio.wait_for(waiter.future, timeout)
+        except asyncio.TimeoutError:
+            raise LLMTimeoutError(f"Not admitted by the model scheduler within {timeout:g}s") from None
+        except BaseException:
+            if waiter.future.done() and not waiter.future.cancelled():
+                self._release(waiter.priority)  # Admitted just as the wait was cancelled
+            raise
+        finally:
+            self._raisable.discard(waiter)
+        try:
+            yield
+        finally:
+            self._release(waiter.priority)
+
+    async def run(self, call: Awaitable, priority: PriorityLike) -> Any:
+        """Await a model call once the scheduler admits it."""
+        try:
+            async with self.slot(priority):
+                return await call
+        finally:
+            if asyncio.iscoroutine(call):
+                call.close()  # Never started if the wait was cancelled; no-op otherwise
+
+    def stats(self) -> Dict[str, Any]:
+        self._refill()
+        classes = {}
+        for priority in Priority:
+            waits = sorted(self._waits[priority])
+            classes[priority.name.lower()] = {
+                "limit": self.limits[priority],
+                "queued": sum(1 for w in self._waiters[priority] if not w.future.done()),
+                "in_flight": self._in_flight[priority],
+                "admitted": self._admitted[priority],
+                "queue_wait_p50_ms": _percentile_ms(waits, 50),
+                "queue_wait_p95_ms": _percentile_ms(waits, 95),
+                "queue_wait_max_ms": round(self._max_wait[priority] * 1000, 2),
+            }
+        return {
+            "max_in_flight": self.max_in_flight,
+            "rate_per_minute": round(self.rate * 60, 2),
+            "burst": self.burst,
+            "tokens": round(self._tokens, 2),
+            "in_flight": sum(self._in_flight.values()),
+            "classes": classes,
+        }
+
+
+def _percentile_ms(sorted_values: List[float], percentile: float) -> Optional[float]:
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(len(sorted_values) * percentile / 100))
+    return round(sorted_values[index] * 1000, 2)
+
+
+# Shared by every Gemini call in the process
+llm_scheduler = LLMScheduler(
+    max_in_flight=int(os.getenv("LLM_MAX_IN_FLIGHT", "32")),
+    rate_per_minute=float(os.getenv("LLM_RATE_PER_MINUTE", "600")),
+    burst=int(os.getenv("LLM_RATE_BURST", "20")),
+    background_limit=int(os.getenv("LLM_BACKGROUND_MAX_IN_FLIGHT", "4")),
+)
+
+
+def request_options(timeout: float) -> Dict[str, Any]:
+    """SDK request options that make the RPC itself give up at the deadline."""
+    return {"timeout": timeout}
+
+
+async def with_deadline(
+    call: Awaitable,
+    timeout: float,
+    operation: str,
+    priority: PriorityLike,
+) -> Any:
+    """
+    Await a model call, cancelling it if it runs past ``timeout`` seconds.
+
+    Args:
+        call: The SDK coroutine, not yet awaited
+        timeout: Deadline in seconds, including time spent waiting for admission
+        operation: Name used in the timeout message
+        priority: Scheduling class the call is admitted under, or a function returning it
+
+    Raises:
+        LLMTimeoutError: The deadline passed before the call finished
+    """
+    try:
+        return await asyncio.wait_for(llm_scheduler.run(call, priority), timeout)
+    except (asyncio.TimeoutError, google_exceptions.DeadlineExceeded):
+        raise LLMTimeoutError(f"{operation} timed out after {timeout:g}s") from None
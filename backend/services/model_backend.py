@@ -0,0 +1,35 @@
+"""
+Model backend selection.
+
+Every ``GenerativeModel`` in the backend is created through ``create_model`` so
+the whole stack can run against the local fake (``services/fake_gemini.py``)
+instead of Google: set ``LLM_BACKEND=fake`` to load-test on one machine with no
+network access. The default, ``gemini``, uses the real SDK.
+"""
+import os
+from typing import List, Optional
+
+import google.generativeai as genai
+
+LLM_BACKEND = os.getenv("LLM_BACKEND", "gemini").lower()
+BACKENDS = ("gemini", "fake")
+
+if LLM_BACKEND not in BACKENDS:
+    raise ValueError(f"LLM_BACKEND must be one of {', '.join(BACKENDS)}, got '{LLM_BACKEND}'")
+
+
+def create_model(model_name: str, tools: Optional[List] = None):
+    """
+    A generative model for the configured backend.
+
+    Args:
+        model_name: Gemini model name (the fake uses it only to vary its output)
+        tools: Tool declarations the model may call
+
+    Returns:
+        ``genai.GenerativeModel``, or ``FakeGenerativeModel`` when LLM_BACKEND=fake
+    """
+    if LLM_BACKEND == "fake":
+        from services.fake_gemini import FakeGenerativeModel
+        return FakeGenerativeModel(model_name, tools=tools)
+    return genai.GenerativeModel(model_name, tools=tools)
@@ -3,6 +3,7 @@ import json
 import re
 import google.generativeai as genai
 from dotenv import load_dotenv
+from services.model_backend import create_model
 from typing import Dict, List
 
 load_dotenv()
@@ -11,7 +12,7 @@ load_dotenv()
 genai.configure(api_key=os.getenv("GOOGLE_API_KEY"))
 
 # Initialize the model
-model = genai.GenerativeModel('gemini-3-flash-preview')
+model = create_model('gemini-3-flash-preview')
 
 async def generate_financial_plan(user_answers: Dict, context: str):
     """Generate a personalized financial plan using Google Gemini."""
@@ -0,0 +1,180 @@
+"""
+Speculative plan generation.
+
+The frontend saves the questionnaire profile (``POST /api/profile``) before the
+user asks for a plan, so the plan can be generated in the background while they
+are still on the page. Jobs are single-flight per user: a user has at most one
+job, a repeat save of the same answers is a no-op, and ``/api/generate-plan``
+joins the user's job instead of starting a duplicate Gemini call.
+
+Background jobs wait in a bounded queue served by a few workers; when the queue
+is full a speculative job is simply dropped, since the plan will be generated
+on demand anyway. Background jobs call Gemini at ``Priority.BACKGROUND``; a job
+that ``/api/generate-plan`` starts or joins runs at ``Priority.PLAN``. The
+priority is kept on the job and read again whenever its model call waits for
+admission or retries, so joining a running background job raises it.
+"""
+import asyncio
+import copy
+import os
+from typing import Awaitable, Callable, Dict, Optional
+
+from services.gemini_service import generate_financial_plan, normalize_answers
+from services.llm import Priority, PriorityLike, llm_scheduler
+from services.rag_service import get_relevant_context
+
+PlanGenerator = Callable[[Dict, PriorityLike], Awaitable[Dict]]
+
+
+async def generate_plan_for_answers(user_answers: Dict, priority: PriorityLike) -> Dict:
+    """Retrieve the RAG context for the answers and generate (or fetch the cached) plan."""
+    context = await get_relevant_context(user_answers)
+    return await generate_financial_plan(user_answers, context, priority=priority)
+
+
+class _Job:
+    __slots__ = ("answers", "answers_key", "future", "started", "priority", "task")
+
+    def __init__(self, user_answers: Dict):
+        self.answers = dict(user_answers)
+        self.answers_key = normalize_answers(user_answers)
+        self.future = asyncio.get_running_loop().create_future()
+        # Avoid "exception was never retrieved" for speculative jobs nobody joins
+        self.future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        self.started = False
+        self.priority = Priority.BACKGROUND
+        self.task: Optional[asyncio.Task] = None
+
+    def raise_priority(self, priority: Priority):
+        self.priority = min(self.priority, priority)
+
+
+class PlanJobQueue:
+    """Per-user single-flight plan jobs with a bounded background queue."""
+
+    def __init__(self, generate: PlanGenerator, workers: int, max_queue: int):
+        self._generate = generate
+        self.workers = max(1, workers)
+        self.max_queue = max(1, max_queue)
+        self._jobs: Dict[str, _Job] = {}
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker_tasks = []
+        self._counts = dict.fromkeys(
+            ("submitted", "deduplicated", "superseded", "dropped", "joined", "completed", "failed"), 0
+        )
+
+    def _ensure_workers(self) -> asyncio.Queue:
+        if self._queue is None:
+            self._queue = asyncio.Queue(maxsize=self.max_queue)
+            self._worker_tasks = [asyncio.ensure_future(self._worker()) for _ in range(self.workers)]
+        return self._queue
+
+    def submit(self, user_id: str, user_answers: Dict) -> bool:
+        """
+        Queue a low-priority plan job for the user's saved answers.
+
+        Returns:
+            True if a job for these answers is queued or running, False if the queue was full
+        """
+        queue = self._ensure_workers()
+        answers_key = normalize_answers(user_answers)
+        job = self._jobs.get(user_id)
+        if job is not None and job.answers_key == answers_key:
+            self._counts["deduplicated"] += 1
+            return True
+        if job is not None and not job.started:
+            # Answers changed before the job ran; it keeps its place in the queue
+            job.answers = dict(user_answers)
+            job.answers_key = answers_key
+            self._counts["superseded"] += 1
+            return True
+        if queue.full():
+            self._counts["dropped"] += 1
+            return False
+
+        job = _Job(user_answers)
+        self._jobs[user_id] = job
+        queue.put_nowait((user_id, job))
+        self._counts["submitted"] += 1
+        return True
+
+    async def get_plan(self, user_id: str, user_answers: Dict) -> Dict:
+        """
+        The user's plan for these answers: join their queued or running job, or start one now.
+
+        A job still waiting in the background queue is started immediately rather
+        than waiting for a worker.
+        """
+        answers_key = normalize_answers(user_answers)
+        job = self._jobs.get(user_id)
+        if job is not None and job.answers_key == answers_key:
+            self._counts["joined"] += 1
+        elif job is not None and not job.started:
+            job.answers = dict(user_answers)
+            job.answers_key = answers_key
+        else:
+            job = _Job(user_answers)
+            self._jobs[user_id] = job
+        if job.started:
+            # Already running at background priority; its next admission or retry goes in as a plan
+            job.raise_priority(Priority.PLAN)
+            llm_scheduler.reprioritize()
+        else:
+            self._start(user_id, job, Priority.PLAN)
+
+        # Shielded so a client disconnect does not cancel a job other requests may join
+        plan = await asyncio.shield(job.future)
+        return copy.deepcopy(plan)
+
+    async def _worker(self):
+        while True:
+            user_id, job = await self._queue.get()
+            try:
+                if job.started:
+                    continue  # Already promoted by get_plan
+                await self._start(user_id, job, Priority.BACKGROUND)
+            finally:
+                self._queue.task_done()
+
+    def _start(self, user_id: str, job: _Job, priority: Priority) -> asyncio.Task:
+        """
+        Run the job in a task kept on the job. It is marked started before this
+        returns, so neither a worker nor another request can start it again.
+        """
+        job.started = True
+        job.raise_priority(priority)
+        job.task = asyncio.ensure_future(self._run(user_id, job))
+        return job.task
+
+    async def _run(self, user_id: str, job: _Job):
+        try:
+            plan = await self._generate(job.answers, lambda: job.priority)
+        except Exception as error:
+            self._counts["failed"] += 1
+            print(f"[PLAN JOB] Plan generation failed for user {user_id}: {error}")
+            if not job.future.done():
+                job.future.set_exception(error)
+        else:
+            self._counts["completed"] += 1
+            if not job.future.done():
+                job.future.set_result(plan)
+        finally:
+            # The finished plan lives on in the plan cache
+            if self._jobs.get(user_id) is job:
+                del self._jobs[user_id]
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "workers": self.workers,
+            "max_queue": self.max_queue,
+            "queue_depth": self._queue.qsize() if self._queue is not None else 0,
+            "in_flight": sum(1 for job in self._jobs.values() if job.started),
+            **self._counts,
+        }
+
+
+plan_jobs = PlanJobQueue(
+    generate_plan_for_answers,
+    workers=int(os.getenv("PLAN_JOB_WORKERS", "2")),
+    max_queue=int(os.getenv("PLAN_JOB_QUEUE", "100")),
+)
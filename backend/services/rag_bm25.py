@@ -0,0 +1,89 @@
+"""
+Sparse-matrix BM25 scoring for playbook chunks.
+
+Same formula as the BM25 ranker in the frontend's ui-ux-pro-max scripts, but the
+per-term BM25 weights of every chunk are precomputed into a CSR matrix, so a batch
+of queries is scored against all chunks with one sparse product and there is no
+vocabulary cap.
+
+The weights are computed when the index is built and saved alongside it; workers
+memory-map them like the TF-IDF arrays instead of re-tokenizing every chunk.
+"""
+import json
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+from scipy.sparse import csr_matrix
+from sklearn.feature_extraction.text import CountVectorizer
+
+# Lowercased words of three or more characters, as in the frontend BM25 tokenizer
+TOKEN_PATTERN = r"(?u)\b\w\w\w+\b"
+
+
+_ARRAYS = ("data", "indices", "indptr")
+
+
+class BM25Index:
+    """BM25 weights for a fixed list of chunks."""
+
+    def __init__(self, vocabulary: Dict[str, int], weights: csr_matrix):
+        self.vectorizer = CountVectorizer(token_pattern=TOKEN_PATTERN, vocabulary=vocabulary)
+        self.weights = weights
+
+    def scores_many(self, queries: List[str]) -> np.ndarray:
+        """BM25 score of every chunk for each query, shape (len(queries), chunks)."""
+        if not self.weights.shape[1]:
+            return np.zeros((len(queries), self.weights.shape[0]))
+        query_counts = self.vectorizer.transform(queries)
+        return (query_counts @ self.weights.T).toarray()
+
+    def save(self, directory: Path) -> None:
+        terms = sorted(self.vectorizer.vocabulary, key=self.vectorizer.vocabulary.get)
+        with open(directory / "bm25_vocabulary.json", "w", encoding="utf-8") as f:
+            json.dump(terms, f, ensure_ascii=False)
+        for name in _ARRAYS:
+            np.save(directory / f"bm25_{name}.npy", getattr(self.weights, name))
+
+
+def fit_bm25(chunks: Sequence[str], k1: float = 1.5, b: float = 0.75) -> BM25Index:
+    """Tokenize the chunks and precompute their BM25 term weights."""
+    vectorizer = CountVectorizer(token_pattern=TOKEN_PATTERN)
+    try:
+        term_freqs = vectorizer.fit_transform(chunks).tocsr().astype(np.float64)
+    except ValueError:
+        # No token of three or more characters anywhere; nothing can match
+        return BM25Index({}, csr_matrix((len(chunks), 0), dtype=np.float64))
+    n_docs = term_freqs.shape[0]
+    doc_lengths = np.asarray(term_freqs.sum(axis=1)).ravel()
+    avg_length = doc_lengths.mean() if n_docs else 0.0
+
+    doc_freqs = np.bincount(term_freqs.indices, minlength=term_freqs.shape[1])
+    idf = np.log((n_docs - doc_freqs + 0.5) / (doc_freqs + 0.5) + 1)
+
+    # weight[d, t] = idf[t] * tf * (k1 + 1) / (tf + k1 * (1 - b + b * len(d) / avgdl))
+    length_norm = k1 * (1 - b + b * doc_lengths / avg_length) if avg_length else np.full(n_docs, k1)
+    rows = np.repeat(np.arange(n_docs), np.diff(term_freqs.indptr))
+    tf = term_freqs.data
+    weights = idf[term_freqs.indices] * tf * (k1 + 1) / (tf + length_norm[rows])
+    return BM25Index(
+        vectorizer.vocabulary_,
+        csr_matrix((weights, term_freqs.indices, term_freqs.indptr), shape=term_freqs.shape),
+    )
+
+
+def load_bm25(directory: Path) -> Optional[BM25Index]:
+    """Memory-map the BM25 weights saved alongside an index, or None if there are none."""
+    if not (directory / "bm25_vocabulary.json").exists():
+        return None
+    with open(directory / "bm25_vocabulary.json", "r", encoding="utf-8") as f:
+        terms = json.load(f)
+    data, indices, indptr = (np.load(directory / f"bm25_{name}.npy", mmap_mode="r") for name in _ARRAYS)
+    weights = csr_matrix((data, indices, indptr), shape=(len(indptr) - 1, len(terms)), copy=False)
+    return BM25Index({term: i for i, term in enumerate(terms)}, weights)
+
+
+def normalize_rows(scores: np.ndarray) -> np.ndarray:
+    """Scale each row into [0, 1] by its maximum so BM25 can be blended with other scores."""
+    maxima = scores.max(axis=1, keepdims=True) if scores.size else scores
+    return np.divide(scores, maxima, out=np.zeros_like(scores), where=maxima > 0)
@@ -0,0 +1,90 @@
+"""
+Context assembly for retrieved playbook chunks.
+
+Ranking returns more candidates than fit in a prompt. Maximal marginal relevance
+(MMR) picks chunks that are relevant but not near-duplicates of chunks already
+picked, and the result is packed into a token budget, trimming the last chunk at
+a sentence boundary instead of dropping it or cutting mid-sentence.
+"""
+import re
+from typing import List, Sequence
+
+import numpy as np
+
+from services.tokens import estimate_tokens, token_budget_chars
+
+CONTEXT_SEPARATOR = "\n\n---\n\n"
+
+# Smallest remainder worth filling with a trimmed chunk
+MIN_TRIM_TOKENS = 40
+
+_SENTENCE_END = re.compile(r'[.!?](?=\s)|\n')
+
+
+def mmr_select(candidates: Sequence[int], relevance: np.ndarray, similarity: np.ndarray,
+               k: int, diversity: float = 0.3, duplicate_threshold: float = 0.85) -> List[int]:
+    """
+    Select up to k candidates by maximal marginal relevance.
+
+    Args:
+        candidates: Chunk indices, best first
+        relevance: Relevance score per candidate (same order as candidates)
+        similarity: Pairwise chunk similarity between candidates
+        k: Maximum number of chunks to keep
+        diversity: Weight of the redundancy penalty (0 = pure relevance order)
+        duplicate_threshold: Candidates at least this similar to a selected chunk are dropped
+
+    Returns:
+        Selected chunk indices in selection order
+    """
+    remaining = list(range(len(candidates)))
+    selected = []
+    while remaining and len(selected) < k:
+        best, best_score = None, None
+        for position in remaining:
+            redundancy = max((similarity[position, other] for other in selected), default=0.0)
+            score = (1 - diversity) * relevance[position] - diversity * redundancy
+            if best_score is None or score > best_score:
+                best, best_score = position, score
+        remaining.remove(best)
+        selected.append(best)
+        # Near-duplicates of the new pick can never add coverage
+        remaining = [p for p in remaining if similarity[p, best] < duplicate_threshold]
+    return [candidates[position] for position in selected]
+
+
+def trim_to_sentence(text: str, max_chars: int) -> str:
+    """Longest prefix of text within max_chars that ends at a sentence or line boundary."""
+    if len(text) <= max_chars:
+        return text
+    cut = 0
+    for match in _SENTENCE_END.finditer(text, 0, max_chars):
+        cut = match.end()
+    trimmed = text[:cut].rstrip()
+
+    # A header whose body was cut off adds nothing
+    lines = trimmed.split("\n")
+    while lines and lines[-1].lstrip().startswith("#"):
+        lines.pop()
+    return "\n".join(lines).rstrip()
+
+
+def pack_chunks(chunks: List[str], token_budget: int) -> str:
+    """Join chunks in order until the token budget is used, trimming the last one to fit."""
+    parts = []
+    used = 0
+    separator_tokens = estimate_tokens(CONTEXT_SEPARATOR)
+    for chunk in chunks:
+        cost = estimate_tokens(chunk) + (separator_tokens if parts else 0)
+        if used + cost <= token_budget:
+            parts.append(chunk)
+            used += cost
+            continue
+
+        remaining = token_budget - used - (separator_tokens if parts else 0)
+        if remaining >= MIN_TRIM_TOKENS:
+            trimmed = trim_to_sentence(chunk, token_budget_chars(remaining))
+            if trimmed:
+                parts.append(trimmed)
+        break
+    return CONTEXT_SEPARATOR.join(parts)
@@ -0,0 +1,86 @@
+"""
+Guidance corpus discovery for the RAG index.
+
+By default the corpus is just the financial playbook. Set ``RAG_CORPUS_DIR`` to
+index a whole directory tree of guidance documents (tax rules, EPF circulars,
+product factsheets, ...) instead; every ``.md`` and ``.txt`` file under it is
+included, in path order.
+"""
+import hashlib
+import os
+from pathlib import Path
+from typing import Iterator, List, NamedTuple, Optional, Tuple
+
+DATA_DIR = Path(__file__).parent.parent / "data"
+PLAYBOOK_PATH = DATA_DIR / "financial-playbook.md"
+
+CORPUS_DIR = os.getenv("RAG_CORPUS_DIR") or None
+CORPUS_EXTENSIONS = (".md", ".txt")
+
+
+class Document(NamedTuple):
+    """One guidance document: its path relative to the corpus root and its text."""
+    path: str
+    text: str
+
+
+def read_playbook(path: Path = PLAYBOOK_PATH) -> str:
+    """Read the playbook markdown file, returning an empty string if it is missing."""
+    try:
+        if not path.exists():
+            return ""
+        with open(path, "r", encoding="utf-8") as f:
+            return f.read()
+    except Exception:
+        return ""
+
+
+def corpus_paths(corpus_dir: Optional[str] = CORPUS_DIR) -> List[Tuple[str, Path]]:
+    """(relative path, absolute path) of every corpus document, sorted by relative path."""
+    if not corpus_dir:
+        return [(PLAYBOOK_PATH.name, PLAYBOOK_PATH)] if PLAYBOOK_PATH.exists() else []
+
+    root = Path(corpus_dir)
+    paths = []
+    for directory, _, filenames in os.walk(root):
+        for filename in filenames:
+            if filename.startswith(".") or not filename.lower().endswith(CORPUS_EXTENSIONS):
+                continue
+            path = Path(directory) / filename
+            paths.append((path.relative_to(root).as_posix(), path))
+    paths.sort()
+    return paths
+
+
+def iter_documents(corpus_dir: Optional[str] = CORPUS_DIR) -> Iterator[Document]:
+    """Stream corpus documents one at a time, skipping unreadable or empty files."""
+    for relative_path, path in corpus_paths(corpus_dir):
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                text = f.read()
+        except (OSError, UnicodeDecodeError) as error:
+            print(f"[RAG] Skipping {relative_path}: {error}")
+            continue
+        if text.strip():
+            yield Document(relative_path, text)
+
+
+def corpus_fingerprint(corpus_dir: Optional[str] = CORPUS_DIR) -> Tuple:
+    """Cheap change detector for the corpus (paths, sizes and mtimes, no file reads)."""
+    fingerprint = []
+    for relative_path, path in corpus_paths(corpus_dir):
+        try:
+            stat = path.stat()
+        except OSError:
+            continue
+        fingerprint.append((relative_path, stat.st_size, stat.st_mtime_ns))
+    return tuple(fingerprint)
+
+
+def content_hash(*parts: str) -> str:
+    """Short SHA-256 hex digest of the given strings."""
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(part.encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()[:16]
@@ -0,0 +1,163 @@
+"""
+Offline LSA embeddings for dense chunk retrieval.
+
+TF-IDF with a 500-term vocabulary only matches literal words, so a query for
+"credit card" scores nothing against a chunk about "high-interest debt". Latent
+semantic analysis projects chunks into a low-dimensional space learnt from term
+co-occurrence across the corpus, where terms used in the same contexts end up
+close together. Everything runs locally: hashed term counts (no vocabulary to
+store), IDF weights and a TruncatedSVD fitted when the index is built.
+
+Chunk embeddings are kept as one contiguous float32 matrix, so scoring a query
+against every chunk is a single matrix-vector product.
+
+Refitting the SVD means hashing every chunk of the corpus, so incremental builds
+keep the previous projection instead: chunks of unchanged documents keep their
+embeddings and only new or edited ones are projected (``extend_dense``). Terms
+that first appear after the last fit carry no weight until the next full refit,
+which happens once ``RAG_DENSE_REFIT_FRACTION`` of the chunks have changed since
+it, or it is older than ``RAG_DENSE_REFIT_AGE`` seconds.
+"""
+import os
+from pathlib import Path
+from typing import List, Optional, Sequence
+
+import numpy as np
+from scipy.sparse import csr_matrix
+from sklearn.decomposition import TruncatedSVD
+from sklearn.feature_extraction.text import HashingVectorizer
+from sklearn.preprocessing import normalize
+
+# Embedding dimensions (capped by the number of chunks); 0 disables dense retrieval
+DENSE_DIM = int(os.getenv("RAG_DENSE_DIM", "128"))
+
+# Full refit once this share of chunks changed since the last fit, or after this many seconds
+DENSE_REFIT_FRACTION = float(os.getenv("RAG_DENSE_REFIT_FRACTION", "0.2"))
+DENSE_REFIT_AGE = float(os.getenv("RAG_DENSE_REFIT_AGE", str(7 * 86400)))
+
+HASH_FEATURES = 2 ** 18
+
+# Chunks embedded per batch when extending an index
+EMBED_BATCH = 1000
+
+_ARRAYS = ("columns", "idf", "projection", "embeddings")
+
+
+def _hasher() -> HashingVectorizer:
+    return HashingVectorizer(
+        n_features=HASH_FEATURES,
+        stop_words="english",
+        ngram_range=(1, 2),
+        alternate_sign=False,
+        norm=None,
+    )
+
+
+class DenseIndex:
+    """LSA projection and unit-length chunk embeddings for a fixed list of chunks."""
+
+    def __init__(self, columns: np.ndarray, idf: np.ndarray, projection: np.ndarray, embeddings: np.ndarray):
+        # Only hash buckets that occur in the corpus carry weight, so the projection
+        # is stored for those columns alone, one row per column so a query only reads
+        # the rows of its own terms
+        self.columns = columns
+        self.idf = idf
+        self.projection = projection
+        self.embeddings = embeddings
+
+    @property
+    def dim(self) -> int:
+        return self.embeddings.shape[1]
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        """Unit-length float32 embeddings for the given texts, shape (len(texts), dim)."""
+        hashed = _hasher().transform(texts)
+
+        # Map hash buckets to stored columns; buckets never seen in the corpus carry no weight
+        positions = np.minimum(np.searchsorted(self.columns, hashed.indices), len(self.columns) - 1)
+        known = self.columns[positions] == hashed.indices
+        rows = np.repeat(np.arange(hashed.shape[0]), np.diff(hashed.indptr))[known]
+        positions = positions[known]
+        weighted = csr_matrix(
+            (hashed.data[known] * self.idf[positions], (rows, positions)),
+            shape=(hashed.shape[0], len(self.columns)),
+            dtype=np.float32,
+        )
+        return normalize(np.asarray(weighted @ self.projection, dtype=np.float32))
+
+    def scores_many(self, texts: List[str]) -> np.ndarray:
+        """Cosine similarity of every chunk for each text, shape (len(texts), chunks)."""
+        return self.embed(texts) @ self.embeddings.T
+
+    def save(self, directory: Path) -> None:
+        for name in _ARRAYS:
+            np.save(directory / f"dense_{name}.npy", getattr(self, name))
+
+
+def fit_dense(chunks: Sequence[str], dim: int = DENSE_DIM) -> Optional[DenseIndex]:
+    """
+    Fit the LSA projection over the chunks and embed them.
+
+    Args:
+        chunks: Chunk texts in index order
+        dim: Requested embedding dimensions
+
+    Returns:
+        DenseIndex, or None if dense retrieval is disabled or the corpus is too small
+    """
+    if dim <= 0 or not chunks:
+        return None
+
+    hashed = _hasher().transform(chunks).tocsr()
+    columns = np.unique(hashed.indices)
+    counts = hashed[:, columns]
+
+    # Smoothed IDF, as in TfidfTransformer
+    n_chunks = counts.shape[0]
+    doc_freqs = np.bincount(counts.indices, minlength=counts.shape[1])
+    idf = np.log((n_chunks + 1) / (doc_freqs + 1)) + 1
+    weighted = normalize(counts.multiply(idf).tocsr())
+
+    dim = min(dim, n_chunks - 1, len(columns) - 1)
+    if dim < 1:
+        return None
+
+    svd = TruncatedSVD(n_components=dim, algorithm="randomized", random_state=0)
+    embeddings = normalize(svd.fit_transform(weighted))
+
+    return DenseIndex(
+        columns.astype(np.int64),
+        idf.astype(np.float32),
+        np.ascontiguousarray(svd.components_.T, dtype=np.float32),
+        np.ascontiguousarray(embeddings, dtype=np.float32),
+    )
+
+
+def extend_dense(base: DenseIndex, chunks: Sequence[str], source: np.ndarray) -> DenseIndex:
+    """
+    Embed a new list of chunks with an already fitted projection.
+
+    Args:
+        base: Index whose projection is reused
+        chunks: Chunk texts in index order
+        source: Row of ``base.embeddings`` holding each chunk's embedding, or -1
+            for chunks to project
+
+    Returns:
+        DenseIndex sharing ``base``'s projection
+    """
+    embeddings = np.empty((len(chunks), base.dim), dtype=np.float32)
+    known = source >= 0
+    embeddings[known] = base.embeddings[source[known]]
+    missing = np.where(~known)[0]
+    for start in range(0, len(missing), EMBED_BATCH):
+        rows = missing[start:start + EMBED_BATCH]
+        embeddings[rows] = base.embed([chunks[int(i)] for i in rows])
+    return DenseIndex(base.columns, base.idf, base.projection, embeddings)
+
+
+def load_dense(directory: Path) -> Optional[DenseIndex]:
+    """Memory-map the dense arrays saved alongside an index, or None if there are none."""
+    if not (directory / "dense_embeddings.npy").exists():
+        return None
+    return DenseIndex(*(np.load(directory / f"dense_{name}.npy", mmap_mode="r") for name in _ARRAYS))
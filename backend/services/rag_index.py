@@ -0,0 +1,903 @@
+"""
+Persistent TF-IDF index for the guidance corpus.
+
+The corpus is the financial playbook, or every document under ``RAG_CORPUS_DIR``
+(see ``services.rag_corpus``). The index is built offline and written to
+``data/index/<key>/`` where the key is a content hash of the corpus. Workers
+memory-map the arrays and the concatenated corpus text at startup, so all uvicorn
+workers share one copy of the pages and nobody re-fits at request time.
+
+Documents are chunked and tokenized in shards on a process pool. Term counts are
+cached per document under ``data/index/documents/``, keyed on the document's
+content, so adding or removing a document only tokenizes what changed; the
+vocabulary and IDF weights are then re-derived from the cached counts.
+
+Every process that loads an index leaves a lease naming it under
+``data/index/leases/``. After a build, artifacts no live process leases and
+document counts none of the kept artifacts reference are deleted, so the
+directory does not grow with every corpus edit.
+
+Build the index before starting the server:
+
+    python -m services.rag_index
+"""
+import json
+import mmap
+import multiprocessing
+import os
+import re
+import shutil
+import tempfile
+import time
+from collections.abc import Sequence
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple
+
+try:
+    import fcntl
+except ImportError:  # Not on POSIX: no advisory locks, so old artifacts are never pruned
+    fcntl = None
+
+import numpy as np
+from scipy.sparse import coo_matrix, csr_matrix
+from sklearn.feature_extraction.text import CountVectorizer, TfidfVectorizer
+from sklearn.preprocessing import normalize
+
+from services.rag_bm25 import BM25Index, fit_bm25, load_bm25
+from services.rag_corpus import (
+    CORPUS_DIR,
+    DATA_DIR,
+    PLAYBOOK_PATH,
+    Document,
+    content_hash,
+    iter_documents,
+)
+from services.rag_dense import (
+    DENSE_DIM,
+    DENSE_REFIT_AGE,
+    DENSE_REFIT_FRACTION,
+    DenseIndex,
+    extend_dense,
+    fit_dense,
+    load_dense,
+)
+from services.rag_keywords import KeywordMatrix, build_keyword_matrix, load_keyword_matrix
+
+# Bump whenever chunking, vectorizer or artifact layout changes so old artifacts are ignored
+INDEX_VERSION = 7
+
+CHUNK_SIZE = int(os.getenv("RAG_CHUNK_SIZE", "1500"))
+CHUNK_OVERLAP = int(os.getenv("RAG_CHUNK_OVERLAP", "300"))
+
+# Documents per tokenization task, and processes tokenizing shards in parallel
+SHARD_SIZE = int(os.getenv("RAG_SHARD_SIZE", "200"))
+BUILD_WORKERS = int(os.getenv("RAG_BUILD_WORKERS", str(min(4, os.cpu_count() or 1))))
+
+INDEX_ROOT = DATA_DIR / "index"
+DOCUMENT_CACHE = "documents"
+LEASE_DIR = "leases"
+LOCK_FILE = ".lock"
+
+VECTORIZER_PARAMS = {
+    "stop_words": "english",
+    "ngram_range": (1, 2),
+}
+
+# Vocabulary pruning, applied over the chunks of the whole corpus
+MAX_FEATURES = 500
+MIN_DF = 1
+MAX_DF = 0.95
+
+
+def _salt() -> str:
+    return f"rag-index-v{INDEX_VERSION}-{CHUNK_SIZE}-{CHUNK_OVERLAP}"
+
+
+def document_hash(text: str) -> str:
+    """Content hash of one document, salted with the index format version and chunking settings."""
+    return content_hash(_salt(), text)
+
+
+def corpus_key(entries: Iterable[Tuple[str, str]]) -> str:
+    """Artifact key for a corpus given its (relative path, document hash) pairs in order."""
+    return content_hash(_salt(), f"dense-{DENSE_DIM}", *(f"{path}:{doc_hash}" for path, doc_hash in entries))
+
+
+# A chunk carries at most the "##" and "###" headers it belongs to as its prefix
+MAX_HEADER_DEPTH = 2
+
+_HEADER_RE = re.compile(r'^(#{2,3}) .*$', re.MULTILINE)
+
+# Preferred window break points, best first
+_BREAKS = ("\n\n", "\n", ". ", " ")
+
+
+class Chunk(NamedTuple):
+    """A chunk body as offsets into the playbook, plus the header lines prefixed to it."""
+    start: int
+    end: int
+    headers: Tuple[Tuple[int, int], ...] = ()
+
+
+def _strip(text: str, start: int, end: int) -> Tuple[int, int]:
+    while start < end and text[start].isspace():
+        start += 1
+    while end > start and text[end - 1].isspace():
+        end -= 1
+    return start, end
+
+
+def _line_end(text: str, start: int) -> int:
+    end = text.find('\n', start)
+    return len(text) if end == -1 else end
+
+
+def _prefix_length(headers) -> int:
+    return sum(end - start + 1 for start, end in headers)
+
+
+def _fit_headers(headers, chunk_size: int):
+    """The innermost headers whose prefix leaves at least half of ``chunk_size`` for the body."""
+    kept = ()
+    for header in reversed(headers):
+        if _prefix_length((header,) + kept) > chunk_size // 2:
+            break
+        kept = (header,) + kept
+    return kept
+
+
+def _window_end(text: str, start: int, limit: int) -> int:
+    """Latest natural break in text[start:limit], never earlier than half the window."""
+    floor = start + (limit - start) // 2
+    for separator in _BREAKS:
+        position = text.rfind(separator, floor, limit)
+        if position != -1:
+            return position + len(separator)
+    return limit
+
+
+def _windows(text: str, start: int, end: int, parents, own_header, chunk_size: int, overlap: int) -> List[Chunk]:
+    """Slide a character budget over one oversized section, overlapping consecutive windows."""
+    chunks = []
+    while start < end:
+        headers = _fit_headers(parents if not chunks else parents + own_header, chunk_size)
+        budget = chunk_size - _prefix_length(headers)
+        limit = start + budget
+        window_end = end if limit >= end else _window_end(text, start, limit)
+
+        s, e = _strip(text, start, window_end)
+        if s < e:
+            chunks.append(Chunk(s, e, headers))
+        if window_end >= end:
+            break
+
+        # Step back by the overlap, then forward to the start of a word
+        next_start = max(window_end - min(overlap, budget // 2), start + 1)
+        space = text.find(' ', next_start, window_end)
+        newline = text.find('\n', next_start, window_end)
+        candidates = [p for p in (space, newline) if p != -1]
+        start = min(candidates) + 1 if candidates else window_end
+    return chunks
+
+
+def chunk_layout(text: str, chunk_size: int = 1500, overlap: int = 300) -> List[Chunk]:
+    """
+    Split the playbook into header-aware chunks of at most ``chunk_size`` characters.
+
+    ``##`` sections that fit the budget stay whole. Larger sections are packed by
+    ``###`` subsection, and subsections that are still too large are cut into
+    overlapping windows at paragraph, line, sentence or word boundaries. Chunks
+    that do not start at their own header get the enclosing ``##``/``###`` header
+    lines as a prefix so they keep their place in the hierarchy.
+
+    Returns:
+        Chunks as offsets into ``text`` (no substrings are copied)
+    """
+    headers = [(m.start(), len(m.group(1))) for m in _HEADER_RE.finditer(text)]
+    boundaries = [0] + [position for position, _ in headers] + [len(text)]
+    levels = [0] + [level for _, level in headers]
+
+    # Group the blocks between headers into "##" sections
+    sections = []
+    for i, level in enumerate(levels):
+        block = (boundaries[i], boundaries[i + 1], level)
+        if level == 3 and sections:
+            sections[-1].append(block)
+        else:
+            sections.append([block])
+
+    chunks = []
+    for blocks in sections:
+        section_start, section_end = _strip(text, blocks[0][0], blocks[-1][1])
+        if section_start >= section_end:
+            continue
+        if section_end - section_start <= chunk_size:
+            chunks.append(Chunk(section_start, section_end))
+            continue
+
+        first_level = blocks[0][2]
+        parents = ()
+        if first_level == 2:
+            parents = ((blocks[0][0], _line_end(text, blocks[0][0])),)
+
+        # Pack consecutive subsections while they fit the budget
+        pack_start = pack_end = None
+        for block_start, block_end, level in blocks:
+            block_start, block_end = _strip(text, block_start, block_end)
+            if block_start >= block_end:
+                continue
+
+            prefix = () if block_start == section_start else parents
+            if pack_start is not None and \
+                    _prefix_length(pack_prefix) + block_end - pack_start <= chunk_size:
+                pack_end = block_end
+                continue
+            if pack_start is not None:
+                # A lone "##" header line is not a chunk; the chunks after it carry it as their prefix
+                if not (parents and pack_start == section_start and pack_end <= parents[0][1]):
+                    chunks.append(Chunk(pack_start, pack_end, pack_prefix))
+                pack_start = None
+
+            if _prefix_length(prefix) + block_end - block_start <= chunk_size:
+                pack_start, pack_end, pack_prefix = block_start, block_end, prefix
+                continue
+
+            own_header = ()
+            if level > 0:
+                own_header = ((block_start, _line_end(text, block_start)),)
+                if level == first_level:
+                    prefix = ()  # The block is its section's own "##" header
+            chunks.extend(_windows(text, block_start, block_end, prefix, own_header, chunk_size, overlap))
+
+        if pack_start is not None:
+            chunks.append(Chunk(pack_start, pack_end, pack_prefix))
+
+    return chunks
+
+
+def render_chunk(text: str, chunk: Chunk) -> str:
+    """Materialize a chunk: its header prefix followed by the body."""
+    body = text[chunk.start:chunk.end]
+    if not chunk.headers:
+        return body
+    prefix = "\n".join(text[start:end] for start, end in chunk.headers)
+    return f"{prefix}\n{body}"
+
+
+def chunk_text(text: str, chunk_size: int = 1500, overlap: int = 300):
+    """Split text into header-aware chunks of at most chunk_size characters with overlap."""
+    return [render_chunk(text, chunk) for chunk in chunk_layout(text, chunk_size, overlap)]
+
+
+def _byte_offsets(text: str, positions: np.ndarray) -> np.ndarray:
+    """Translate character offsets into UTF-8 byte offsets (-1 padding is kept)."""
+    if text.isascii():
+        return positions
+    codepoints = np.frombuffer(text.encode("utf-32-le"), dtype=np.uint32)
+    widths = 1 + (codepoints >= 0x80) + (codepoints >= 0x800) + (codepoints >= 0x10000)
+    starts = np.concatenate(([0], np.cumsum(widths)))
+    return np.where(positions >= 0, starts[np.maximum(positions, 0)], -1)
+
+
+def count_document(text: str) -> Dict[str, np.ndarray]:
+    """
+    Chunk one document and count the terms of every chunk.
+
+    Returns:
+        Arrays stored in the document cache: chunk offsets and header spans in
+        UTF-8 bytes relative to the document, the document's sorted vocabulary,
+        and the chunk-by-term counts as CSR components
+    """
+    layout = chunk_layout(text, CHUNK_SIZE, CHUNK_OVERLAP)
+    offsets = np.asarray([chunk[:2] for chunk in layout], dtype=np.int64).reshape(-1, 2)
+    headers = np.full((len(layout), MAX_HEADER_DEPTH, 2), -1, dtype=np.int64)
+    for i, chunk in enumerate(layout):
+        for depth, span in enumerate(chunk.headers):
+            headers[i, depth] = span
+
+    counts = csr_matrix((len(layout), 0), dtype=np.int64)
+    terms = np.array([], dtype=str)
+    if layout:
+        vectorizer = CountVectorizer(**VECTORIZER_PARAMS)
+        try:
+            counts = vectorizer.fit_transform([render_chunk(text, chunk) for chunk in layout]).tocsr()
+            terms = vectorizer.get_feature_names_out().astype(str)
+        except ValueError:
+            pass  # Nothing but stop words; the chunks stay retrievable by keyword
+
+    return {
+        "offsets": _byte_offsets(text, offsets),
+        "headers": _byte_offsets(text, headers),
+        "terms": terms,
+        "data": counts.data,
+        "indices": counts.indices,
+        "indptr": counts.indptr,
+    }
+
+
+def _cache_path(cache_dir: Path, doc_hash: str) -> Path:
+    return cache_dir / f"{doc_hash}.npz"
+
+
+def _count_shard(cache_dir: str, shard: List[Tuple[str, str]]) -> int:
+    """Tokenize a shard of (document hash, text) pairs into the document cache (runs in worker processes)."""
+    cache_dir = Path(cache_dir)
+    for doc_hash, text in shard:
+        arrays = count_document(text)
+        fd, tmp_path = tempfile.mkstemp(prefix=f".{doc_hash}-", suffix=".npz", dir=cache_dir)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                np.savez(f, **arrays)
+            os.replace(tmp_path, _cache_path(cache_dir, doc_hash))
+        except BaseException:
+            Path(tmp_path).unlink(missing_ok=True)
+            raise
+    return len(shard)
+
+
+@contextmanager
+def _index_lock(index_root: Path, exclusive: bool = False) -> Iterator[bool]:
+    """
+    Advisory lock on the index directory.
+
+    Builds and loads hold it shared; pruning takes it exclusively and without
+    waiting, so it never deletes files another process is writing or opening.
+
+    Yields:
+        Whether the lock was acquired (an exclusive lock is skipped, not waited for)
+    """
+    if fcntl is None:
+        yield not exclusive
+        return
+    index_root.mkdir(parents=True, exist_ok=True)
+    with open(index_root / LOCK_FILE, "a") as lock_file:
+        try:
+            fcntl.flock(lock_file, (fcntl.LOCK_EX | fcntl.LOCK_NB) if exclusive else fcntl.LOCK_SH)
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass  # Exists, owned by someone else
+    return True
+
+
+def _lease(index_root: Path, key: str) -> None:
+    """Record that this process serves the index ``key``, so pruning keeps it."""
+    lease_dir = index_root / LEASE_DIR
+    lease_dir.mkdir(parents=True, exist_ok=True)
+    (lease_dir / str(os.getpid())).write_text(key, encoding="utf-8")
+
+
+def prune_index(index_root: Path = INDEX_ROOT, keep: Iterable[str] = ()) -> int:
+    """
+    Delete index artifacts nobody serves and document counts nothing references.
+
+    An artifact is kept if it is in ``keep`` or leased by a running process;
+    leases of processes that have exited are dropped. A process keeps its
+    arrays memory-mapped, so deleting the artifact of a snapshot it is just
+    swapping out is safe. Skipped while another process holds the index lock.
+
+    Returns:
+        Number of artifacts deleted
+    """
+    with _index_lock(index_root, exclusive=True) as locked:
+        if not locked:
+            return 0  # A build or load is in progress; the next build prunes
+
+        live = set(keep)
+        lease_dir = index_root / LEASE_DIR
+        for lease in (lease_dir.iterdir() if lease_dir.is_dir() else ()):
+            if lease.name.isdigit() and _pid_alive(int(lease.name)):
+                live.add(lease.read_text(encoding="utf-8").strip())
+            else:
+                lease.unlink(missing_ok=True)
+
+        removed = 0
+        referenced = set()
+        for path in index_root.iterdir():
+            if not path.is_dir() or path.name in (DOCUMENT_CACHE, LEASE_DIR):
+                continue
+            if path.name in live:
+                manifest = path / "documents.json"
+                if manifest.exists():
+                    with open(manifest, "r", encoding="utf-8") as f:
+                        referenced.update(document["hash"] for document in json.load(f))
+                continue
+            # Unleased artifacts, and build directories left behind by a crashed builder
+            shutil.rmtree(path, ignore_errors=True)
+            removed += not path.name.startswith(".")
+
+        cache_dir = index_root / DOCUMENT_CACHE
+        stale = [path for path in cache_dir.glob("*.npz") if path.stem not in referenced] if cache_dir.is_dir() else []
+        for path in stale:
+            path.unlink(missing_ok=True)
+
+    if removed or stale:
+        print(f"[RAG] Pruned {removed} old index artifacts and {len(stale)} cached document counts")
+    return removed
+
+
+class BuildStats(NamedTuple):
+    """Throughput of one index build."""
+    documents: int
+    tokenized: int
+    cached: int
+    chunks: int
+    features: int
+    seconds: float
+
+    @property
+    def docs_per_second(self) -> float:
+        return self.documents / self.seconds if self.seconds > 0 else 0.0
+
+
+class _Entry(NamedTuple):
+    path: str
+    doc_hash: str
+    start: int
+
+
+def _tokenize_corpus(documents: Iterable[Document], corpus_file, cache_dir: Path,
+                     workers: int) -> Tuple[List[_Entry], int]:
+    """
+    Stream documents into the corpus file and tokenize the ones missing from the cache.
+
+    Full shards go to a process pool as they fill up, with a bounded number in
+    flight; a corpus that fits in one shard is tokenized in-process.
+
+    Returns:
+        (one entry per document, number of documents tokenized)
+    """
+    entries = []
+    queued = set()
+    shards = []
+    shard = []
+    pool = None
+    futures = []
+    tokenized = 0
+
+    def submit(ready):
+        nonlocal pool, tokenized
+        if workers <= 1:
+            for pending in ready:
+                tokenized += _count_shard(str(cache_dir), pending)
+            return
+        if pool is None:
+            pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+        for pending in ready:
+            futures.append(pool.submit(_count_shard, str(cache_dir), pending))
+        while len(futures) > 2 * workers:
+            tokenized += futures.pop(0).result()
+
+    try:
+        for document in documents:
+            doc_hash = document_hash(document.text)
+            entries.append(_Entry(document.path, doc_hash, corpus_file.tell()))
+            corpus_file.write(document.text.encode("utf-8"))
+
+            if doc_hash in queued or _cache_path(cache_dir, doc_hash).exists():
+                continue
+            queued.add(doc_hash)
+            shard.append((doc_hash, document.text))
+            if len(shard) >= SHARD_SIZE:
+                shards.append(shard)
+                shard = []
+                # Hold the first shard back so a one-shard corpus never starts a pool
+                if pool is not None or len(shards) > 1:
+                    submit(shards)
+                    shards = []
+
+        if shard:
+            shards.append(shard)
+        if pool is None and len(shards) == 1:
+            tokenized += _count_shard(str(cache_dir), shards[0])
+        elif shards:
+            submit(shards)
+
+        for future in futures:
+            tokenized += future.result()
+    finally:
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+
+    return entries, tokenized
+
+
+def _load_counts(cache_dir: Path, doc_hash: str) -> Dict[str, np.ndarray]:
+    """One document's cached arrays, read in full so its file is closed again (corpora can have thousands)."""
+    with np.load(_cache_path(cache_dir, doc_hash)) as arrays:
+        return {name: arrays[name] for name in arrays.files}
+
+
+def _merge_counts(entries: List[_Entry], cache_dir: Path):
+    """
+    Combine cached per-document counts into corpus-wide TF-IDF vectors.
+
+    Mirrors ``TfidfVectorizer(max_features=500, min_df=1, max_df=0.95)`` fitted on
+    all chunks at once: sorted vocabulary, document-frequency pruning, the
+    ``max_features`` most frequent terms, smoothed IDF and L2-normalized rows.
+
+    Returns:
+        (offsets, headers, doc_ids, vocabulary, chunk vectors, idf), or None if
+        the corpus has no usable vocabulary
+    """
+    documents = [_load_counts(cache_dir, entry.doc_hash) for entry in entries]
+
+    offsets, headers, doc_ids = [], [], []
+    for doc_id, (entry, arrays) in enumerate(zip(entries, documents)):
+        offsets.append(arrays["offsets"] + entry.start)
+        headers.append(np.where(arrays["headers"] >= 0, arrays["headers"] + entry.start, -1))
+        doc_ids.append(np.full(len(arrays["offsets"]), doc_id, dtype=np.int32))
+    offsets = np.concatenate(offsets).astype(np.int64)
+    headers = np.concatenate(headers).astype(np.int64)
+    doc_ids = np.concatenate(doc_ids)
+    n_chunks = len(offsets)
+
+    terms = [arrays["terms"] for arrays in documents]
+    vocabulary = np.unique(np.concatenate(terms)) if n_chunks else np.array([], dtype=str)
+    if not vocabulary.size or MAX_DF * n_chunks < MIN_DF:
+        return None
+
+    rows, columns, values = [], [], []
+    row_offset = 0
+    for arrays, doc_terms in zip(documents, terms):
+        indptr = arrays["indptr"]
+        local_columns = np.searchsorted(vocabulary, doc_terms)
+        rows.append(row_offset + np.repeat(np.arange(len(indptr) - 1), np.diff(indptr)))
+        columns.append(local_columns[arrays["indices"]])
+        values.append(arrays["data"])
+        row_offset += len(indptr) - 1
+    counts = coo_matrix(
+        (np.concatenate(values).astype(np.float64), (np.concatenate(rows), np.concatenate(columns))),
+        shape=(n_chunks, len(vocabulary)),
+    ).tocsr()
+
+    # Same pruning as CountVectorizer._limit_features
+    dfs = np.bincount(counts.indices, minlength=counts.shape[1])
+    mask = (dfs <= MAX_DF * n_chunks) & (dfs >= MIN_DF)
+    if mask.sum() > MAX_FEATURES:
+        tfs = np.asarray(counts.sum(axis=0)).ravel()
+        top = (-tfs[mask]).argsort()[:MAX_FEATURES]
+        limited = np.zeros(len(dfs), dtype=bool)
+        limited[np.where(mask)[0][top]] = True
+        mask = limited
+    kept = np.where(mask)[0]
+    if not kept.size:
+        return None
+
+    counts = counts[:, kept]
+    idf = np.log((n_chunks + 1) / (dfs[kept] + 1)) + 1
+    counts.data *= idf[counts.indices]
+    chunk_vectors = normalize(counts, norm="l2").tocsr()
+
+    return offsets, headers, doc_ids, vocabulary[kept].tolist(), chunk_vectors, idf
+
+
+def _dense_base(index_root: Path) -> Optional[Tuple[Path, Dict]]:
+    """The most recently built artifact with a dense projection that can be reused, and its metadata."""
+    best = None
+    for path in index_root.iterdir():
+        meta_path = path / "meta.json"
+        if path.name.startswith(".") or not meta_path.exists():
+            continue
+        with open(meta_path, "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        dense_meta = meta.get("dense")
+        if meta.get("version") != INDEX_VERSION or not dense_meta or dense_meta["requested_dim"] != DENSE_DIM:
+            continue
+        built = meta_path.stat().st_mtime
+        if best is None or built > best[0]:
+            best = (built, path, dense_meta)
+    return best[1:] if best is not None else None
+
+
+def _build_dense(index_root: Path, entries: List[_Entry], doc_ids: np.ndarray,
+                 chunks: Sequence) -> Tuple[Optional[DenseIndex], Optional[Dict]]:
+    """
+    LSA embeddings for the chunks, reusing the projection of the previous build when possible.
+
+    Chunks of documents the previous artifact already has keep their embeddings
+    and new ones are projected with its SVD components. The projection is refit
+    over all chunks (streamed from the corpus file) when there is nothing to
+    reuse, or once the chunks changed since the last fit exceed
+    ``RAG_DENSE_REFIT_FRACTION`` or the fit is older than ``RAG_DENSE_REFIT_AGE``.
+
+    Returns:
+        (dense index, its metadata), or (None, None) if dense retrieval is off or
+        the corpus is too small
+    """
+    base = _dense_base(index_root) if DENSE_DIM > 0 else None
+    if base is not None:
+        base_dir, base_meta = base
+        previous = load_dense(base_dir)
+        with open(base_dir / "documents.json", "r", encoding="utf-8") as f:
+            base_hashes = [document["hash"] for document in json.load(f)]
+        base_doc_ids = np.load(base_dir / "doc_ids.npy", mmap_mode="r")
+        base_starts = np.searchsorted(base_doc_ids, np.arange(len(base_hashes) + 1))
+        base_rows = {doc_hash: (base_starts[i], base_starts[i + 1]) for i, doc_hash in enumerate(base_hashes)}
+
+        starts = np.searchsorted(doc_ids, np.arange(len(entries) + 1))
+        source = np.full(len(chunks), -1, dtype=np.int64)
+        for doc_id, entry in enumerate(entries):
+            rows = base_rows.get(entry.doc_hash)
+            if rows is not None:
+                source[starts[doc_id]:starts[doc_id + 1]] = np.arange(*rows)
+
+        reused = int((source >= 0).sum())
+        # Chunks added plus chunks removed since the projection was fitted
+        drift = base_meta["drift"] + (len(chunks) - reused) + (len(base_doc_ids) - reused)
+        stale = time.time() - base_meta["fitted_at"] > DENSE_REFIT_AGE
+        if previous is not None and not stale and drift <= DENSE_REFIT_FRACTION * len(chunks):
+            print(f"[RAG] Reusing the LSA projection of {base_dir.name}: "
+                  f"{len(chunks) - reused} of {len(chunks)} chunks projected")
+            return extend_dense(previous, chunks, source), {**base_meta, "drift": drift}
+
+    dense = fit_dense(chunks)
+    if dense is None:
+        return None, None
+    return dense, {"requested_dim": DENSE_DIM, "fitted_at": time.time(), "fitted_chunks": len(chunks), "drift": 0}
+
+
+def build_index(documents: Optional[Iterable[Document]] = None, index_root: Path = INDEX_ROOT,
+                workers: int = BUILD_WORKERS) -> Optional[Path]:
+    """
+    Build the TF-IDF index over the corpus and persist it to disk.
+
+    Documents are streamed once: their text is appended to the artifact's corpus
+    file and any document without cached counts is tokenized on the process
+    pool. Counts are then merged into the corpus-wide index. The artifact is
+    written to a temporary directory and renamed into place, so concurrent
+    builders and readers never observe a partially written index.
+
+    Args:
+        documents: Documents to index (defaults to the configured corpus)
+        index_root: Directory holding one sub-directory per corpus key
+        workers: Processes used to tokenize shards (1 tokenizes in-process)
+
+    Returns:
+        Path of the index directory, or None if the corpus has no indexable content
+    """
+    started = time.perf_counter()
+    if documents is None:
+        documents = iter_documents()
+
+    cache_dir = index_root / DOCUMENT_CACHE
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    with _index_lock(index_root):
+        index_dir, stats = _build(documents, index_root, cache_dir, workers, started)
+    if stats is None:
+        return index_dir
+
+    print(f"[RAG] Indexed {stats.documents} documents ({stats.tokenized} tokenized, {stats.cached} cached) "
+          f"into {stats.chunks} chunks in {stats.seconds:.2f}s ({stats.docs_per_second:.1f} docs/sec)")
+    prune_index(index_root, keep=[index_dir.name])
+    return index_dir
+
+
+def _build(documents: Iterable[Document], index_root: Path, cache_dir: Path, workers: int,
+           started: float) -> Tuple[Optional[Path], Optional[BuildStats]]:
+    """Body of ``build_index``; returns the index directory and the stats if a new artifact was written."""
+    tmp_dir = Path(tempfile.mkdtemp(prefix=".build-", dir=index_root))
+    try:
+        with open(tmp_dir / "corpus.txt", "wb") as corpus_file:
+            entries, tokenized = _tokenize_corpus(documents, corpus_file, cache_dir, workers)
+        if not entries:
+            return None, None
+
+        key = corpus_key((entry.path, entry.doc_hash) for entry in entries)
+        index_dir = index_root / key
+        if (index_dir / "meta.json").exists():
+            print(f"[RAG] Index {key} is up to date ({len(entries)} documents, {tokenized} tokenized)")
+            return index_dir, None
+
+        merged = _merge_counts(entries, cache_dir)
+        if merged is None:
+            return None, None
+        offsets, headers, doc_ids, vocabulary, chunk_vectors, idf = merged
+
+        np.save(tmp_dir / "offsets.npy", offsets)
+        np.save(tmp_dir / "headers.npy", headers)
+        np.save(tmp_dir / "doc_ids.npy", doc_ids)
+        np.save(tmp_dir / "idf.npy", idf)
+        np.save(tmp_dir / "data.npy", chunk_vectors.data)
+        np.save(tmp_dir / "indices.npy", chunk_vectors.indices)
+        np.save(tmp_dir / "indptr.npy", chunk_vectors.indptr)
+        with open(tmp_dir / "vocabulary.json", "w", encoding="utf-8") as f:
+            json.dump(vocabulary, f, ensure_ascii=False)
+        with open(tmp_dir / "documents.json", "w", encoding="utf-8") as f:
+            json.dump([{"path": entry.path, "hash": entry.doc_hash} for entry in entries], f, ensure_ascii=False)
+
+        with open(tmp_dir / "corpus.txt", "rb") as f, \
+                mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as corpus:
+            chunks = ChunkView(corpus, offsets, headers)
+            dense, dense_meta = _build_dense(index_root, entries, doc_ids, chunks)
+            if dense is not None:
+                dense.save(tmp_dir)
+            build_keyword_matrix(chunks).save(tmp_dir)
+            fit_bm25(chunks).save(tmp_dir)
+
+        stats = BuildStats(
+            documents=len(entries),
+            tokenized=tokenized,
+            cached=len(entries) - tokenized,
+            chunks=len(offsets),
+            features=len(vocabulary),
+            seconds=time.perf_counter() - started,
+        )
+        # meta.json is written last and marks the artifact as complete
+        with open(tmp_dir / "meta.json", "w", encoding="utf-8") as f:
+            json.dump({
+                "key": key,
+                "version": INDEX_VERSION,
+                "documents": stats.documents,
+                "chunks": stats.chunks,
+                "chunk_size": CHUNK_SIZE,
+                "chunk_overlap": CHUNK_OVERLAP,
+                "features": stats.features,
+                "shape": list(chunk_vectors.shape),
+                "dense_dim": dense.dim if dense is not None else 0,
+                "dense": dense_meta,
+                "build": {**stats._asdict(), "docs_per_second": stats.docs_per_second},
+            }, f)
+
+        try:
+            os.replace(tmp_dir, index_dir)
+        except OSError:
+            # Another worker won the race; its artifact is identical
+            if not (index_dir / "meta.json").exists():
+                raise
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    return index_dir, stats
+
+
+class ChunkView(Sequence):
+    """Chunk texts rendered on demand from byte offsets into the memory-mapped corpus."""
+
+    def __init__(self, corpus, offsets: np.ndarray, headers: np.ndarray):
+        self._corpus = corpus
+        self._offsets = offsets
+        self._headers = headers
+
+    def __len__(self) -> int:
+        return len(self._offsets)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        start, end = self._offsets[i]
+        lines = [
+            self._corpus[int(h_start):int(h_end)]
+            for h_start, h_end in self._headers[i]
+            if h_start >= 0
+        ]
+        lines.append(self._corpus[int(start):int(end)])
+        return b"\n".join(lines).decode("utf-8")
+
+
+class PlaybookIndex:
+    """
+    Read-only view over a built index: fitted vectorizer, chunk matrix, LSA
+    embeddings, keyword matrix, BM25 weights and chunk texts.
+    """
+
+    def __init__(self, key: str, corpus, documents: List[Dict], doc_ids: np.ndarray, offsets: np.ndarray,
+                 headers: np.ndarray, vectorizer: TfidfVectorizer, chunk_vectors: csr_matrix,
+                 dense: Optional[DenseIndex] = None, keyword_matrix: Optional[KeywordMatrix] = None,
+                 bm25: Optional[BM25Index] = None):
+        self.key = key
+        self.corpus = corpus
+        self.documents = documents
+        self.doc_ids = doc_ids
+        self.offsets = offsets
+        self.headers = headers
+        self.vectorizer = vectorizer
+        self.chunk_vectors = chunk_vectors
+        self.dense = dense
+        self.chunks = ChunkView(corpus, offsets, headers)
+        self.keyword_matrix = keyword_matrix or build_keyword_matrix(self.chunks)
+        self.bm25 = bm25
+
+
+def _new_vectorizer(**kwargs) -> TfidfVectorizer:
+    return TfidfVectorizer(**VECTORIZER_PARAMS, **kwargs)
+
+
+def current_key(documents: Optional[Iterable[Document]] = None) -> Optional[str]:
+    """Artifact key of the corpus as it is now, or None if it has no documents."""
+    if documents is None:
+        documents = iter_documents()
+    entries = [(document.path, document_hash(document.text)) for document in documents]
+    return corpus_key(entries) if entries else None
+
+
+def load_index(documents: Optional[Iterable[Document]] = None, index_root: Path = INDEX_ROOT,
+               build: bool = True) -> Optional[PlaybookIndex]:
+    """
+    Memory-map the index matching the current corpus content.
+
+    Args:
+        documents: Documents to index (defaults to the configured corpus)
+        index_root: Directory holding one sub-directory per corpus key
+        build: Build the artifact in-process if it is missing
+
+    Returns:
+        PlaybookIndex, or None if no index is available
+    """
+    if documents is not None:
+        documents = list(documents)
+
+    key = current_key(documents)
+    if key is None:
+        return None
+
+    _lease(index_root, key)
+    index_dir = index_root / key
+    if not (index_dir / "meta.json").exists():
+        if not build:
+            return None
+        print(f"[RAG] No index found for corpus {key}, building in-process "
+              f"(run `python -m services.rag_index` before deploying)")
+        # The corpus may have changed since it was hashed; use whatever was built
+        index_dir = build_index(documents, index_root)
+        if index_dir is None:
+            return None
+        _lease(index_root, index_dir.name)
+
+    with _index_lock(index_root):
+        if not (index_dir / "meta.json").exists():
+            return None  # Pruned before the lease was seen
+        return _open_index(index_dir)
+
+
+def _open_index(index_dir: Path) -> PlaybookIndex:
+    with open(index_dir / "meta.json", "r", encoding="utf-8") as f:
+        meta = json.load(f)
+    with open(index_dir / "vocabulary.json", "r", encoding="utf-8") as f:
+        vocabulary = json.load(f)
+    with open(index_dir / "documents.json", "r", encoding="utf-8") as f:
+        corpus_documents = json.load(f)
+
+    # Large arrays and the corpus text are memory-mapped read-only and shared between processes
+    with open(index_dir / "corpus.txt", "rb") as f:
+        corpus = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    offsets = np.load(index_dir / "offsets.npy", mmap_mode="r")
+    headers = np.load(index_dir / "headers.npy", mmap_mode="r")
+    doc_ids = np.load(index_dir / "doc_ids.npy", mmap_mode="r")
+    idf = np.load(index_dir / "idf.npy", mmap_mode="r")
+    chunk_vectors = csr_matrix(
+        (
+            np.load(index_dir / "data.npy", mmap_mode="r"),
+            np.load(index_dir / "indices.npy", mmap_mode="r"),
+            np.load(index_dir / "indptr.npy", mmap_mode="r"),
+        ),
+        shape=tuple(meta["shape"]),
+        copy=False,
+    )
+
+    vectorizer = _new_vectorizer(vocabulary={term: i for i, term in enumerate(vocabulary)})
+    vectorizer.idf_ = idf
+
+    return PlaybookIndex(meta["key"], corpus, corpus_documents, doc_ids, offsets, headers, vectorizer, chunk_vectors,
+                         load_dense(index_dir), load_keyword_matrix(index_dir), load_bm25(index_dir))
+
+
+if __name__ == "__main__":
+    path = build_index()
+    if path is None:
+        raise SystemExit(f"No indexable content in {CORPUS_DIR or PLAYBOOK_PATH}")
+    print(f"Index for {CORPUS_DIR or PLAYBOOK_PATH.name} written to {path}")
@@ -0,0 +1,339 @@
+"""
+Precomputed keyword features for playbook chunks.
+
+Keyword relevance used to lowercase every chunk and run a dozen substring checks
+per request. Instead, each chunk is scanned once for every keyword feature and the
+result is kept as a chunk-by-feature 0/1 matrix; a request only builds a weight
+vector from the user's answers and takes a single dot product.
+
+Scores are identical to ``rag_service.calculate_keyword_relevance``; a batch of
+answers is scored with one matrix product. The matrix is built with the index and
+saved alongside it, so workers memory-map it instead of rescanning the chunks.
+
+Phrases are matched through a ``PhraseIndex``: the chunks lowercased once at
+build time, plus the chunks each word occurs in. Only chunks that contain every
+word of a phrase are checked with a substring test, so a free-text answer term
+no longer scans the whole corpus.
+"""
+import json
+import mmap
+import re
+from collections import OrderedDict
+from collections.abc import Sequence as SequenceABC
+from itertools import chain
+from pathlib import Path
+from threading import Lock
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+# Static features; a chunk matches a feature if it contains any of its phrases
+KEYWORD_FEATURES = {
+    "student": ("student",),
+    "retirement": ("retirement",),
+    "business": ("business",),
+    "low_income": ("low income", "budget"),
+    "high_income": ("high income", "investment"),
+    "debt": ("debt",),
+    "emergency_fund": ("emergency fund",),
+    "investment": ("investment",),
+    "conservative": ("conservative",),
+    "aggressive": ("aggressive",),
+}
+
+# Answer options offered by the questionnaire (frontend QuestionnaireNew.vue)
+QUESTIONNAIRE_OPTIONS = {
+    "aboutYou": ["Student", "Not working", "Professional", "Business owner", "Retired"],
+    "income": ["0–36,000", "36,001–60,000", "60,001–100,000", "100,000+"],
+    "expenses": ["0–1,000", "1,001–2,500", "2,501–4,000", "4,000+"],
+    "debt": ["None", "Credit card", "Student loan", "Car loan", "Mortgage"],
+    "savings": ["0", "1k–10k", "10k–50k", "50k+"],
+    "riskTolerance": ["Low", "Medium", "High"],
+}
+
+# Answer fields whose (lowercased) value is itself searched for in chunks
+TERM_FIELDS = ("aboutYou", "debt", "riskTolerance")
+
+# Free-text answer terms outside the questionnaire options are cached up to this many
+MAX_EXTRA_TERMS = 256
+
+
+def keyword_weights(user_answers: Dict) -> Tuple[Dict[str, float], Dict[str, float]]:
+    """
+    Translate user answers into feature weights.
+
+    Returns:
+        (static feature weights, answer term weights), mirroring the rules in
+        ``calculate_keyword_relevance``
+    """
+    features = {}
+    terms = {}
+
+    def add(target, key, weight):
+        target[key] = target.get(key, 0.0) + weight
+
+    if user_answers.get("aboutYou"):
+        about_you_lower = user_answers["aboutYou"].lower()
+        add(terms, about_you_lower, 5.0)
+        if about_you_lower == "student":
+            add(features, "student", 3.0)
+        if about_you_lower == "retired":
+            add(features, "retirement", 3.0)
+        if about_you_lower == "business owner":
+            add(features, "business", 3.0)
+
+    if user_answers.get("income"):
+        income = user_answers["income"]
+        if "36,000" in income or "0-" in income or "0–" in income:
+            add(features, "low_income", 3.0)
+        if "100,000+" in income:
+            add(features, "high_income", 3.0)
+
+    if user_answers.get("debt"):
+        debt_lower = user_answers["debt"].lower()
+        add(terms, debt_lower, 4.0)
+        if debt_lower != "none":
+            add(features, "debt", 2.0)
+
+    if user_answers.get("savings"):
+        savings = user_answers["savings"]
+        if savings == "0":
+            add(features, "emergency_fund", 3.0)
+        if "50k+" in savings:
+            add(features, "investment", 3.0)
+
+    if user_answers.get("riskTolerance"):
+        risk_lower = user_answers["riskTolerance"].lower()
+        add(terms, risk_lower, 3.0)
+        if risk_lower == "low":
+            add(features, "conservative", 2.0)
+        if risk_lower == "high":
+            add(features, "aggressive", 2.0)
+
+    return features, terms
+
+
+_WORD_RE = re.compile(r"\w+")
+
+
+class _TextView(SequenceABC):
+    """Texts stored back to back as UTF-8, decoded on access."""
+
+    def __init__(self, data, offsets: np.ndarray):
+        self._data = data
+        self._offsets = offsets
+
+    def __len__(self) -> int:
+        return len(self._offsets) - 1
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        return self._data[int(self._offsets[i]):int(self._offsets[i + 1])].decode("utf-8")
+
+
+class PhraseIndex:
+    """Lowercased chunk texts and, for every word in them, the chunks it occurs in."""
+
+    def __init__(self, texts: Sequence[str], words: List[str], indptr: np.ndarray, postings: np.ndarray):
+        self.texts = texts
+        self.words = words
+        self._word_ids = {word: i for i, word in enumerate(words)}
+        self._indptr = indptr
+        self._postings = postings
+
+    def __len__(self) -> int:
+        return len(self.texts)
+
+    def _chunks_with(self, word_ids: Iterable[int]) -> np.ndarray:
+        ids = [self._postings[self._indptr[i]:self._indptr[i + 1]] for i in word_ids]
+        return np.unique(np.concatenate(ids)) if ids else np.array([], dtype=np.int64)
+
+    def candidates(self, phrase: str) -> np.ndarray:
+        """
+        Chunks that may contain ``phrase``: a superset of the chunks that do.
+
+        A word inside the phrase must occur as a whole word; a word at either end
+        of it may be part of a longer word ("loan" in "loans"), so it is looked up
+        in the vocabulary by substring.
+        """
+        runs = list(_WORD_RE.finditer(phrase))
+        if not runs:
+            return np.arange(len(self))
+        chunks = None
+        for run in runs:
+            word = run.group()
+            if 0 < run.start() and run.end() < len(phrase):
+                word_id = self._word_ids.get(word)
+                found = self._chunks_with([] if word_id is None else [word_id])
+            else:
+                found = self._chunks_with(i for i, candidate in enumerate(self.words) if word in candidate)
+            chunks = found if chunks is None else np.intersect1d(chunks, found, assume_unique=True)
+            if not chunks.size:
+                break
+        return chunks
+
+    def match(self, phrases: Tuple[str, ...]) -> np.ndarray:
+        """0/1 column of the chunks containing any of the phrases."""
+        column = np.zeros(len(self), dtype=np.float64)
+        for phrase in phrases:
+            for i in self.candidates(phrase):
+                if not column[i] and phrase in self.texts[i]:
+                    column[i] = 1.0
+        return column
+
+    def save(self, directory: Path) -> None:
+        texts = [text.encode("utf-8") for text in self.texts]
+        offsets = np.concatenate(([0], np.cumsum([len(text) for text in texts]))).astype(np.int64)
+        with open(directory / "chunks_lower.txt", "wb") as f:
+            f.write(b"".join(texts))
+        np.save(directory / "chunks_lower_offsets.npy", offsets)
+        with open(directory / "phrase_words.json", "w", encoding="utf-8") as f:
+            json.dump(self.words, f, ensure_ascii=False)
+        np.save(directory / "phrase_indptr.npy", self._indptr)
+        np.save(directory / "phrase_postings.npy", self._postings)
+
+
+def build_phrase_index(chunks: Sequence[str]) -> PhraseIndex:
+    """Lowercase the chunks and collect, for every word, the chunks it occurs in."""
+    texts = [chunk.lower() for chunk in chunks]
+    postings: Dict[str, List[int]] = {}
+    for chunk_id, text in enumerate(texts):
+        for word in set(_WORD_RE.findall(text)):
+            postings.setdefault(word, []).append(chunk_id)
+
+    words = sorted(postings)
+    indptr = np.concatenate(([0], np.cumsum([len(postings[word]) for word in words]))).astype(np.int64)
+    chunk_ids = np.fromiter(chain.from_iterable(postings[word] for word in words), dtype=np.int32, count=indptr[-1])
+    return PhraseIndex(texts, words, indptr, chunk_ids)
+
+
+def load_phrase_index(directory: Path) -> Optional[PhraseIndex]:
+    """Memory-map a phrase index saved alongside an index, or None if there is none."""
+    if not (directory / "chunks_lower.txt").exists():
+        return None
+    with open(directory / "chunks_lower.txt", "rb") as f:
+        # mmap cannot map an empty file; an index without text has nothing to match
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if f.seek(0, 2) else b""
+    with open(directory / "phrase_words.json", "r", encoding="utf-8") as f:
+        words = json.load(f)
+    return PhraseIndex(
+        _TextView(data, np.load(directory / "chunks_lower_offsets.npy", mmap_mode="r")),
+        words,
+        np.load(directory / "phrase_indptr.npy", mmap_mode="r"),
+        np.load(directory / "phrase_postings.npy", mmap_mode="r"),
+    )
+
+
+class KeywordMatrix:
+    """Chunk-by-feature matrix of keyword matches for a fixed list of chunks."""
+
+    def __init__(self, phrases: PhraseIndex, columns: List[Tuple[str, str]], matrix: np.ndarray):
+        self.phrases = phrases
+        self._extra_terms = OrderedDict()
+        self._lock = Lock()
+        self.columns = {tuple(column): i for i, column in enumerate(columns)}
+        self.matrix = matrix
+
+    def save(self, directory: Path) -> None:
+        self.phrases.save(directory)
+        with open(directory / "keyword_columns.json", "w", encoding="utf-8") as f:
+            json.dump(list(self.columns), f, ensure_ascii=False)
+        np.save(directory / "keyword_matrix.npy", self.matrix)
+
+    def _extra_term(self, term: str) -> np.ndarray:
+        """Column for an answer term that is not a questionnaire option (bounded LRU)."""
+        with self._lock:
+            column = self._extra_terms.get(term)
+            if column is not None:
+                self._extra_terms.move_to_end(term)
+                return column
+
+        column = self.phrases.match((term,))
+        with self._lock:
+            self._extra_terms[term] = column
+            while len(self._extra_terms) > MAX_EXTRA_TERMS:
+                self._extra_terms.popitem(last=False)
+        return column
+
+    def _weights(self, user_answers: Dict) -> Tuple[np.ndarray, List[Tuple[str, float]]]:
+        """Weight vector over the matrix columns, plus weights of uncached free-text terms."""
+        features, terms = keyword_weights(user_answers)
+
+        weights = np.zeros(self.matrix.shape[1])
+        extra = []
+        for name, weight in features.items():
+            weights[self.columns[("feature", name)]] += weight
+        for term, weight in terms.items():
+            column = self.columns.get(("term", term))
+            if column is None:
+                extra.append((term, weight))
+            else:
+                weights[column] += weight
+        return weights, extra
+
+    def scores(self, user_answers: Dict) -> np.ndarray:
+        """Keyword relevance of every chunk for the given answers."""
+        return self.scores_many([user_answers])[0]
+
+    def scores_many(self, answers_list: List[Dict], rows: Optional[np.ndarray] = None) -> np.ndarray:
+        """
+        Keyword relevance for a batch of answers, shape (len(answers_list), chunks).
+
+        Pass ``rows`` to score only those chunks (e.g. candidates from a first stage).
+        """
+        weights = np.zeros((self.matrix.shape[1], len(answers_list)))
+        extras = []
+        for i, user_answers in enumerate(answers_list):
+            weights[:, i], extra = self._weights(user_answers)
+            extras.append(extra)
+
+        matrix = self.matrix if rows is None else self.matrix[rows]
+        scores = (matrix @ weights).T
+        for i, extra in enumerate(extras):
+            for term, weight in extra:
+                column = self._extra_term(term)
+                scores[i] += weight * (column if rows is None else column[rows])
+        return scores
+
+
+def build_keyword_matrix(chunks: Sequence[str], answer_terms: Iterable[str] = None) -> KeywordMatrix:
+    """
+    Match every static feature and questionnaire answer term against the chunks once.
+
+    Args:
+        chunks: Chunk texts in index order
+        answer_terms: Lowercased answer terms to give their own column (defaults
+            to the questionnaire options of ``TERM_FIELDS``)
+    """
+    phrases = build_phrase_index(chunks)
+    if answer_terms is None:
+        answer_terms = [
+            option.lower()
+            for field in TERM_FIELDS
+            for option in QUESTIONNAIRE_OPTIONS[field]
+        ]
+
+    columns = []
+    matches = []
+    for name, feature_phrases in KEYWORD_FEATURES.items():
+        columns.append(("feature", name))
+        matches.append(phrases.match(feature_phrases))
+    for term in dict.fromkeys(answer_terms):
+        columns.append(("term", term))
+        matches.append(phrases.match((term,)))
+
+    matrix = np.column_stack(matches) if matches else np.zeros((len(chunks), 0))
+    return KeywordMatrix(phrases, columns, matrix)
+
+
+def load_keyword_matrix(directory: Path) -> Optional[KeywordMatrix]:
+    """Memory-map the keyword matrix saved alongside an index, or None if there is none."""
+    if not (directory / "keyword_matrix.npy").exists():
+        return None
+    phrases = load_phrase_index(directory)
+    if phrases is None:
+        return None
+    with open(directory / "keyword_columns.json", "r", encoding="utf-8") as f:
+        columns = json.load(f)
+    return KeywordMatrix(phrases, columns, np.load(directory / "keyword_matrix.npy", mmap_mode="r"))
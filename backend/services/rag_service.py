@@ -1,83 +1,193 @@
 import os
-import re
-from pathlib import Path
-from typing import Dict
-from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.metrics.pairwise import cosine_similarity
-
-playbook_cache = None
-vectorizer = None
-playbook_chunks = None
-chunk_vectors = None
-
-def load_playbook():
-    """Load and cache the financial playbook markdown file."""
-    global playbook_cache
-    if playbook_cache:
-        return playbook_cache
+import asyncio
+import itertools
+from threading import Lock
+from typing import Dict, List, Optional, Tuple
+import numpy as np
+from services.cache import LRUCache
+from services.executor import BoundedExecutor
+from services.rag_corpus import Document, corpus_fingerprint, iter_documents
+from services.rag_index import (
+    PlaybookIndex,
+    current_key,
+    load_index
+)
+from services.rag_bm25 import normalize_rows
+from services.rag_context import mmr_select, pack_chunks
+from services.rag_keywords import QUESTIONNAIRE_OPTIONS
 
+DEFAULT_CONTEXT = "Provide comprehensive financial planning advice based on Malaysian context, including EPF contributions, tax planning, and local investment options."
+
+# Questionnaire fields that drive retrieval; nothing else in user_answers affects the context
+ANSWER_FIELDS = tuple(QUESTIONNAIRE_OPTIONS)
+
+# Context assembly: token budget for the joined chunks and MMR de-duplication settings
+CONTEXT_TOKEN_BUDGET = int(os.getenv("RAG_CONTEXT_TOKEN_BUDGET", "800"))
+MMR_DIVERSITY = float(os.getenv("RAG_MMR_DIVERSITY", "0.3"))
+DUPLICATE_SIMILARITY = float(os.getenv("RAG_DUPLICATE_SIMILARITY", "0.85"))
+MMR_CANDIDATE_FACTOR = 3
+
+# Chunk scorer: "tfidf" (default), "bm25", "two_stage" (BM25 candidates reranked by TF-IDF + keywords),
+# or "dense" (offline LSA embeddings)
+RETRIEVAL_SCORER = os.getenv("RAG_SCORER", "tfidf").lower()
+BM25_CANDIDATES = int(os.getenv("RAG_BM25_CANDIDATES", "50"))
+
+# Least seconds between two on-demand reloads (POST /api/admin/reload-index)
+RELOAD_MIN_INTERVAL = float(os.getenv("RAG_RELOAD_MIN_INTERVAL", "60"))
+
+class IndexSnapshot:
+    """
+    Retrieval state for one version of the corpus, never mutated once built.
+
+    A reload builds a complete new snapshot and swaps the module reference in one
+    assignment; requests grab the current snapshot once and use it throughout, so
+    in-flight work keeps the old index and nobody sees a half-built one.
+    """
+
+    __slots__ = ("key", "vectorizer", "chunks", "chunk_vectors", "dense", "keyword_matrix", "bm25")
+
+    def __init__(self, index: PlaybookIndex):
+        self.key = index.key
+        self.vectorizer = index.vectorizer
+        self.chunks = index.chunks
+        self.chunk_vectors = index.chunk_vectors
+        self.dense = index.dense
+        self.keyword_matrix = index.keyword_matrix
+        self.bm25 = index.bm25
+
+_snapshot: Optional[IndexSnapshot] = None
+
+# Joined contexts keyed on (corpus hash, answers); the hash makes stale entries unreachable
+context_cache = LRUCache(max_size=int(os.getenv("RAG_CONTEXT_CACHE_SIZE", "8192")))
+
+# Ranking is CPU-bound scikit-learn/NumPy work, so it runs here instead of on the event loop
+retrieval_executor = BoundedExecutor(
+    "rag",
+    max_workers=int(os.getenv("RAG_POOL_SIZE", "2")),
+    max_queue=int(os.getenv("RAG_MAX_QUEUE", "64")),
+)
+_init_lock = Lock()
+
+def current_snapshot() -> Optional[IndexSnapshot]:
+    """The index snapshot new requests should use (None until an index is loaded)."""
+    return _snapshot
+
+def _build_snapshot(documents: Optional[List[Document]] = None) -> Optional[IndexSnapshot]:
     try:
-        current_dir = Path(__file__).parent
-        playbook_path = current_dir.parent / "data" / "financial-playbook.md"
-        
-        if not playbook_path.exists():
-            return ""
-            
-        with open(playbook_path, "r", encoding="utf-8") as f:
-            playbook_cache = f.read()
-        return playbook_cache
+        index = load_index(documents)
     except Exception as error:
-        return ""
-
-def chunk_text(text: str, chunk_size: int = 1500, overlap: int = 300):
-    """Split text into chunks by markdown sections."""
-    # Simple approach: split by ## headers
-    sections = text.split('\n## ')
-    chunks = []
+        print(f"[RAG] Failed to load corpus index: {error}")
+        return None
     
-    for i, section in enumerate(sections):
-        if i > 0:
-            section = '## ' + section  # Add back the header
-        section = section.strip()
-        if section:
-            chunks.append(section)
-    
-    return chunks
+    if index is None or not index.chunks:
+        return None
+    return IndexSnapshot(index)
+
+def _swap_snapshot(snapshot: IndexSnapshot):
+    global _snapshot
+    previous = _snapshot
+    _snapshot = snapshot
+    if previous is None or previous.key != snapshot.key:
+        # Old entries are unreachable under the new key; drop them to free memory
+        context_cache.clear()
 
 def initialize_vectorizer():
-    """Initialize TF-IDF vectorizer and create embeddings for playbook chunks."""
-    global vectorizer, playbook_chunks, chunk_vectors
-    
-    if vectorizer is not None:
+    """Load the prebuilt TF-IDF index for the corpus (memory-mapped, shared across workers)."""
+    if _snapshot is not None:
         return  # Already initialized
     
-    playbook = load_playbook()
-    if not playbook:
-        return
-    
-    # Chunk the playbook
-    playbook_chunks = chunk_text(playbook, chunk_size=1500, overlap=300)
-    
-    if not playbook_chunks:
-        return
-    
-    # Initialize TF-IDF vectorizer
-    vectorizer = TfidfVectorizer(
-        max_features=500,
-        stop_words='english',
-        ngram_range=(1, 2),
-        min_df=1,
-        max_df=0.95
-    )
+    with _init_lock:
+        if _snapshot is None:
+            snapshot = _build_snapshot()
+            if snapshot is not None:
+                _swap_snapshot(snapshot)
+
+def reload_index() -> bool:
+    """
+    Re-read the corpus and, if its content changed, build and swap in a new snapshot.
+
+    Blocking; call it from a worker thread. Only added or changed documents are
+    re-tokenized. Requests keep using the previous snapshot until the new one is
+    complete.
+
+    Returns:
+        True if a new snapshot was swapped in
+    """
+    with _init_lock:
+        documents = list(iter_documents())
+        key = current_key(documents)
+        if key is None:
+            print("[RAG] Corpus missing or empty, keeping the current index")
+            return False
+        if _snapshot is not None and key == _snapshot.key:
+            return False
+        
+        snapshot = _build_snapshot(documents)
+        if snapshot is None:
+            print("[RAG] Index rebuild failed, keeping the current index")
+            return False
+        
+        _swap_snapshot(snapshot)
     
-    # Create embeddings for all chunks
-    try:
-        chunk_vectors = vectorizer.fit_transform(playbook_chunks)
-    except Exception:
-        vectorizer = None
+    print(f"[RAG] Swapped in corpus index {snapshot.key} ({len(snapshot.chunks)} chunks)")
+    return True
+
+class ReloadThrottled(Exception):
+    """An on-demand reload was asked for too soon after the previous one."""
+
+    def __init__(self, retry_after: float):
+        super().__init__(f"Index was reloaded recently, retry in {retry_after:.0f}s")
+        self.retry_after = retry_after
+
+_reload_task: Optional[asyncio.Future] = None
+_last_reload_started = float("-inf")
+
+async def request_reload(min_interval: float = RELOAD_MIN_INTERVAL) -> bool:
+    """
+    On-demand reload, single-flight and rate-limited.
+
+    Callers that arrive while a reload is running wait for that one instead of
+    queueing another; a new reload starts at most once every ``min_interval``
+    seconds. A caller that goes away does not cancel the reload for the others.
+
+    Returns:
+        True if a new snapshot was swapped in
+
+    Raises:
+        ReloadThrottled: If no reload is running and the last one started less
+            than ``min_interval`` seconds ago
+    """
+    global _reload_task, _last_reload_started
+    if _reload_task is None or _reload_task.done():
+        now = asyncio.get_running_loop().time()
+        wait = _last_reload_started + min_interval - now
+        if wait > 0:
+            raise ReloadThrottled(wait)
+        _last_reload_started = now
+        _reload_task = asyncio.ensure_future(retrieval_executor.run(reload_index))
+    return await asyncio.shield(_reload_task)
+
+async def watch_playbook(interval: float):
+    """Poll the corpus files and hot-reload the index in the background when any of them change."""
+    last_seen = await retrieval_executor.run(corpus_fingerprint)
+    while True:
+        await asyncio.sleep(interval)
+        current = await retrieval_executor.run(corpus_fingerprint)
+        if current == last_seen:
+            continue
+        last_seen = current
+        try:
+            await retrieval_executor.run(reload_index)
+        except Exception as error:
+            print(f"[RAG] Corpus reload failed: {error}")
 
 def calculate_keyword_relevance(chunk: str, user_answers: Dict) -> float:
-    """Calculate relevance score based on keyword matching."""
+    """
+    Calculate relevance score based on keyword matching.
+
+    Reference implementation for a single chunk; retrieval scores all chunks at
+    once with ``KeywordMatrix.scores``, which returns the same values.
+    """
     chunk_lower = chunk.lower()
     score = 0.0
 
@@ -146,60 +256,219 @@ def create_query_vector(user_answers: Dict) -> str:
     
     return " ".join(query_parts)
 
-async def get_relevant_context(user_answers: Dict):
-    """Get relevant context from playbook using RAG (TF-IDF + cosine similarity + keyword matching)."""
-    global vectorizer, playbook_chunks, chunk_vectors
+def context_cache_key(user_answers: Dict, snapshot: Optional[IndexSnapshot] = None,
+                      token_budget: Optional[int] = None) -> Optional[Tuple]:
+    """Cache key for the retrieval inputs, or None if the answers are not cacheable."""
+    snapshot = snapshot or _snapshot
+    values = []
+    for field in ANSWER_FIELDS:
+        value = user_answers.get(field) or None
+        if value is not None and not isinstance(value, str):
+            return None
+        values.append(value)
+    token_budget = CONTEXT_TOKEN_BUDGET if token_budget is None else token_budget
+    return (snapshot.key if snapshot else None, token_budget, tuple(values))
+
+def top_k_indices(scores: np.ndarray, k: int) -> np.ndarray:
+    """
+    Indices of the k highest scores, best first, ties broken by chunk order.
+
+    Uses argpartition (linear time) and only sorts the candidates at or above the
+    k-th score, giving the same result as a full stable sort.
+    """
+    if k <= 0:
+        return np.empty(0, dtype=np.intp)
+    if k >= scores.shape[0]:
+        return np.argsort(-scores, kind="stable")
     
-    # Initialize vectorizer if not already done
-    initialize_vectorizer()
+    kth_score = scores[np.argpartition(-scores, k - 1)[k - 1]]
+    candidates = np.flatnonzero(scores >= kth_score)
+    order = np.lexsort((candidates, -scores[candidates]))
+    return candidates[order[:k]]
+
+def score_chunks(answers_list: List[Dict], snapshot: IndexSnapshot) -> np.ndarray:
+    """
+    Combined relevance of every chunk for each query, shape (len(answers_list), chunks).
+
+    Uses the scorer selected by RAG_SCORER. In two-stage mode only the BM25
+    candidates get a score; every other chunk is -inf.
+    """
+    # Create queries from user answers
+    query_texts = [create_query_vector(user_answers) for user_answers in answers_list]
     
-    if not playbook_chunks or vectorizer is None:
-        return "Provide comprehensive financial planning advice based on Malaysian context, including EPF contributions, tax planning, and local investment options."
+    if RETRIEVAL_SCORER == "two_stage" and snapshot.bm25 is not None:
+        return _score_two_stage(answers_list, query_texts, snapshot)
     
-    # Create query from user answers
-    query_text = create_query_vector(user_answers)
+    if RETRIEVAL_SCORER == "bm25" and snapshot.bm25 is not None:
+        # BM25 is unbounded, so scale each query's scores into [0, 1] before blending
+        semantic = normalize_rows(snapshot.bm25.scores_many(query_texts))
+    elif RETRIEVAL_SCORER == "dense" and snapshot.dense is not None:
+        # Embeddings are unit length, so one product with the embedding matrix gives all cosines
+        semantic = snapshot.dense.scores_many(query_texts).astype(np.float64)
+    else:
+        # TF-IDF rows are L2-normalized, so one sparse product gives all cosine similarities
+        query_vectors = snapshot.vectorizer.transform(query_texts)
+        semantic = (query_vectors @ snapshot.chunk_vectors.T).toarray()
     
-    try:
-        # Vectorize the query
-        query_vector = vectorizer.transform([query_text])
-        
-        # Calculate cosine similarity
-        similarities = cosine_similarity(query_vector, chunk_vectors).flatten()
-        
-        # Combine semantic similarity with keyword relevance
-        combined_scores = []
-        for i, chunk in enumerate(playbook_chunks):
-            semantic_score = float(similarities[i])
-            keyword_score = calculate_keyword_relevance(chunk, user_answers)
-            # Normalize keyword score (max is around 20)
-            normalized_keyword = keyword_score / 20.0
-            # Weighted combination: 70% semantic, 30% keyword
-            combined_score = 0.7 * semantic_score + 0.3 * normalized_keyword
-            combined_scores.append((combined_score, chunk))
-        
-        # Sort by combined score and take top 5
-        combined_scores.sort(key=lambda x: x[0], reverse=True)
-        top_chunks = [chunk for score, chunk in combined_scores[:5] if score > 0.1]
-        
-        # Fallback to top 3 if no good matches
-        if not top_chunks:
-            top_chunks = [chunk for _, chunk in combined_scores[:3]]
+    # Combine semantic similarity with keyword relevance
+    keyword_scores = snapshot.keyword_matrix.scores_many(answers_list)
+    # Normalize keyword score (max is around 20)
+    normalized_keyword = keyword_scores / 20.0
+    # Weighted combination: 70% semantic, 30% keyword
+    return 0.7 * semantic + 0.3 * normalized_keyword
+
+def _score_two_stage(answers_list: List[Dict], query_texts: List[str], snapshot: IndexSnapshot) -> np.ndarray:
+    """Cheap BM25 candidate generation, then TF-IDF + keyword reranking of the candidates only."""
+    bm25_scores = snapshot.bm25.scores_many(query_texts)
+    query_vectors = snapshot.vectorizer.transform(query_texts)
+    
+    combined_scores = np.full(bm25_scores.shape, -np.inf)
+    for i, user_answers in enumerate(answers_list):
+        candidates = np.sort(top_k_indices(bm25_scores[i], BM25_CANDIDATES))
+        similarities = (query_vectors[i] @ snapshot.chunk_vectors[candidates].T).toarray().ravel()
+        keyword_scores = snapshot.keyword_matrix.scores_many([user_answers], rows=candidates)[0]
+        combined_scores[i, candidates] = 0.7 * similarities + 0.3 * keyword_scores / 20.0
+    return combined_scores
+
+def rank_contexts(answers_list: List[Dict], top_k: int = 5, snapshot: Optional[IndexSnapshot] = None,
+                  token_budget: Optional[int] = None) -> List[str]:
+    """
+    Rank playbook chunks for a batch of answers and assemble each context (no caching).
+
+    The best candidates are de-duplicated with maximal marginal relevance and
+    packed into ``token_budget`` tokens.
+    """
+    snapshot = snapshot or _snapshot
+    playbook_chunks = snapshot.chunks
+    token_budget = CONTEXT_TOKEN_BUDGET if token_budget is None else token_budget
+    
+    combined_scores = score_chunks(answers_list, snapshot)
+    
+    contexts = []
+    for scores in combined_scores:
+        # Take more candidates than needed so MMR can skip near-duplicates (ties keep playbook order)
+        ranking = top_k_indices(scores, top_k * MMR_CANDIDATE_FACTOR)
+        candidates = [i for i in ranking if scores[i] > 0.1]
         
-        # Combine top chunks
-        context = "\n\n---\n\n".join(top_chunks)
+        # Fallback to top 3 if no good matches; chunks the scorer ruled out (-inf) never qualify
+        if not candidates:
+            candidates = [i for i in ranking[:3] if np.isfinite(scores[i])]
+        if not candidates:
+            contexts.append("")  # Nothing scored at all; no context beats unrelated chunks
+            continue
         
-        return context if context else "Standard financial planning guidance."
+        candidate_vectors = snapshot.chunk_vectors[candidates]
+        chunk_similarity = (candidate_vectors @ candidate_vectors.T).toarray()
+        selected = mmr_select(
+            candidates,
+            scores[candidates],
+            chunk_similarity,
+            k=top_k,
+            diversity=MMR_DIVERSITY,
+            duplicate_threshold=DUPLICATE_SIMILARITY,
+        )
         
+        # Combine top chunks within the token budget
+        context = pack_chunks([playbook_chunks[i] for i in selected], token_budget)
+        contexts.append(context if context else "Standard financial planning guidance.")
+    
+    return contexts
+
+def rank_context(user_answers: Dict, snapshot: Optional[IndexSnapshot] = None,
+                 token_budget: Optional[int] = None) -> str:
+    """Rank playbook chunks for the answers and assemble the context (no caching)."""
+    return rank_contexts([user_answers], snapshot=snapshot, token_budget=token_budget)[0]
+
+def keyword_fallback_context(user_answers: Dict, snapshot: Optional[IndexSnapshot] = None,
+                             token_budget: Optional[int] = None) -> str:
+    """Keyword-only retrieval used when the TF-IDF path fails."""
+    playbook_chunks = (snapshot or _snapshot).chunks
+    token_budget = CONTEXT_TOKEN_BUDGET if token_budget is None else token_budget
+    scored_chunks = [
+        (calculate_keyword_relevance(chunk, user_answers), chunk)
+        for chunk in playbook_chunks
+    ]
+    scored_chunks.sort(key=lambda x: x[0], reverse=True)
+    top_chunks = [chunk for score, chunk in scored_chunks[:5] if score > 0]
+    
+    if not top_chunks:
+        top_chunks = playbook_chunks[:3]
+    
+    return pack_chunks(top_chunks, token_budget)
+
+async def get_relevant_contexts(answers_list: List[Dict], token_budget: Optional[int] = None) -> List[str]:
+    """
+    Get relevant contexts for a batch of user answers, each within token_budget tokens.
+
+    Cached contexts are served directly; the rest are ranked together with one
+    vectorizer call and one similarity matrix on the retrieval thread pool, so
+    the event loop keeps serving other requests meanwhile.
+    """
+    # Initialize vectorizer if not already done (may build the index on a cold start)
+    if _snapshot is None:
+        await retrieval_executor.run(initialize_vectorizer)
+    
+    # Pin one snapshot for the whole request, even if a reload swaps it meanwhile
+    snapshot = _snapshot
+    if snapshot is None:
+        return [DEFAULT_CONTEXT] * len(answers_list)
+    
+    token_budget = CONTEXT_TOKEN_BUDGET if token_budget is None else token_budget
+    
+    # Questionnaire answers come from a small discrete space, so most lookups are cache hits
+    contexts = [None] * len(answers_list)
+    cache_keys = [context_cache_key(user_answers, snapshot, token_budget) for user_answers in answers_list]
+    misses = []
+    for i, cache_key in enumerate(cache_keys):
+        if cache_key is not None:
+            contexts[i] = context_cache.get(cache_key)
+        if contexts[i] is None:
+            misses.append(i)
+    
+    if not misses:
+        return contexts
+    
+    try:
+        ranked = await retrieval_executor.run(
+            rank_contexts, [answers_list[i] for i in misses], snapshot=snapshot, token_budget=token_budget
+        )
     except Exception:
         # Fallback to keyword-based retrieval
-        scored_chunks = [
-            (calculate_keyword_relevance(chunk, user_answers), chunk)
-            for chunk in playbook_chunks
-        ]
-        scored_chunks.sort(key=lambda x: x[0], reverse=True)
-        top_chunks = [chunk for score, chunk in scored_chunks[:5] if score > 0]
-        
-        if not top_chunks:
-            top_chunks = playbook_chunks[:3]
-        
-        return "\n\n---\n\n".join(top_chunks)
+        for i in misses:
+            contexts[i] = await retrieval_executor.run(
+                keyword_fallback_context, answers_list[i], snapshot, token_budget
+            )
+        return contexts
+    
+    for i, context in zip(misses, ranked):
+        contexts[i] = context
+        if cache_keys[i] is not None:
+            context_cache.set(cache_keys[i], context)
+    return contexts
+
+async def get_relevant_context(user_answers: Dict, token_budget: Optional[int] = None):
+    """Get relevant context from playbook using RAG (TF-IDF + cosine similarity + keyword matching)."""
+    return (await get_relevant_contexts([user_answers], token_budget))[0]
+
+def warm_context_cache(batch_size: int = 500) -> int:
+    """
+    Precompute the context for every combination of questionnaire answers.
+
+    Returns:
+        Number of contexts cached
+    """
+    initialize_vectorizer()
+    snapshot = _snapshot
+    if snapshot is None:
+        return 0
+    
+    combinations = itertools.product(*QUESTIONNAIRE_OPTIONS.values())
+    count = 0
+    while True:
+        batch = [dict(zip(ANSWER_FIELDS, values)) for values in itertools.islice(combinations, batch_size)]
+        if not batch:
+            break
+        for user_answers, context in zip(batch, rank_contexts(batch, snapshot=snapshot)):
+            context_cache.set(context_cache_key(user_answers, snapshot), context)
+        count += len(batch)
+    return count
@@ -0,0 +1,322 @@
+"""
+Retries and hedged requests for Gemini calls, bounded by a per-endpoint deadline.
+
+An endpoint creates one ``Deadline`` for everything it asks the model and passes
+it to ``call_with_retries`` (one response) or ``open_stream`` (a streamed
+response). Within that budget:
+
+- a call that fails with a transient error (unavailable, rate limited, internal
+  error, attempt timeout) is retried after a jittered exponential backoff, but
+  only if enough of the budget is left for another attempt to finish
+- with hedging on, a second identical request is sent once the first has been
+  outstanding for longer than the operation's recent p95 latency, and whichever
+  answers first wins; the other is cancelled
+
+A stream counts as answered when its first chunk arrives, so retries and hedges
+never duplicate text already sent to the client.
+"""
+import asyncio
+import collections
+import os
+import random
+import time
+from typing import Any, AsyncIterator, Awaitable, Callable, Deque, Dict, Optional, Tuple
+
+from google.api_core import exceptions as google_exceptions
+
+from services.llm import LLMTimeoutError, PriorityLike, with_deadline
+
+# Overall budget per endpoint in seconds, covering every attempt and backoff
+PLAN_BUDGET = float(os.getenv("GEMINI_PLAN_BUDGET", "90"))
+CHAT_BUDGET = float(os.getenv("GEMINI_CHAT_BUDGET", "45"))
+SUMMARY_BUDGET = float(os.getenv("GEMINI_SUMMARY_BUDGET", "120"))
+
+MAX_ATTEMPTS = int(os.getenv("LLM_MAX_ATTEMPTS", "3"))
+RETRY_BASE_DELAY = float(os.getenv("LLM_RETRY_BASE_DELAY", "0.5"))
+RETRY_MAX_DELAY = float(os.getenv("LLM_RETRY_MAX_DELAY", "8"))
+
+# Hedging doubles the cost of slow calls, so it is opt-in
+HEDGE_REQUESTS = os.getenv("LLM_HEDGE_REQUESTS", "false").lower() == "true"
+# Latency samples an operation needs before its p95 is trusted as the hedge delay
+HEDGE_MIN_SAMPLES = int(os.getenv("LLM_HEDGE_MIN_SAMPLES", "20"))
+
+RETRYABLE_ERRORS = (
+    LLMTimeoutError,
+    ConnectionError,
+    google_exceptions.ServiceUnavailable,
+    google_exceptions.TooManyRequests,
+    google_exceptions.InternalServerError,
+    google_exceptions.GatewayTimeout,
+)
+
+
+class Deadline:
+    """Time budget shared by all model calls made for one request."""
+
+    def __init__(self, budget: float):
+        self.budget = budget
+        self.expires = time.monotonic() + budget
+
+    def remaining(self) -> float:
+        return max(0.0, self.expires - time.monotonic())
+
+    def attempt_timeout(self, cap: float, operation: str) -> float:
+        """
+        Timeout for the next attempt: the per-call cap, or whatever is left of the budget.
+
+        Raises:
+            LLMTimeoutError: The budget is spent
+        """
+        remaining = self.remaining()
+        if remaining <= 0:
+            raise LLMTimeoutError(f"{operation} exceeded its {self.budget:g}s budget")
+        return min(cap, remaining)
+
+
+class LatencyTracker:
+    """Recent successful attempt latencies of one operation."""
+
+    def __init__(self, max_samples: int = 500):
+        self._samples: Deque[float] = collections.deque(maxlen=max_samples)
+
+    def record(self, seconds: float):
+        self._samples.append(seconds)
+
+    def percentile(self, percentile: float) -> Optional[float]:
+        if not self._samples:
+            return None
+        values = sorted(self._samples)
+        return values[min(len(values) - 1, int(len(values) * percentile / 100))]
+
+    def hedge_delay(self) -> Optional[float]:
+        """The p95 latency, once there are enough samples to trust it."""
+        if len(self._samples) < HEDGE_MIN_SAMPLES:
+            return None
+        return self.percentile(95)
+
+
+latency_trackers: Dict[str, LatencyTracker] = collections.defaultdict(LatencyTracker)
+_counts: Dict[str, Dict[str, int]] = collections.defaultdict(
+    lambda: dict.fromkeys(("calls", "attempts", "retries", "hedges", "hedge_wins", "failures"), 0)
+)
+
+
+def backoff_delay(retry: int) -> float:
+    """Full-jitter exponential backoff before the given retry (1-based)."""
+    return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** (retry - 1)))
+
+
+def _can_retry(error: Exception, retry: int, deadline: Deadline, operation: str) -> Optional[float]:
+    """Backoff before the next attempt, or None if the error is final or the budget cannot cover it."""
+    if not isinstance(error, RETRYABLE_ERRORS) or retry >= MAX_ATTEMPTS:
+        return None
+    delay = backoff_delay(retry)
+    # Leave room for an attempt of typical length after the backoff
+    typical = latency_trackers[operation].percentile(50) or 0.0
+    if deadline.remaining() <= delay + typical:
+        return None
+    return delay
+
+
+async def _race(
+    start: Callable[[], Awaitable],
+    operation: str,
+    timeout: float,
+    hedge: bool,
+    discard: Optional[Callable[[Any], Awaitable]] = None,
+) -> Any:
+    """
+    Run one attempt, plus a hedge if it is slower than the operation's p95.
+
+    Returns the first successful result; losing attempts are cancelled, and
+    ``discard`` releases a result that arrived too late to be used.
+    """
+    loop = asyncio.get_running_loop()
+    tracker = latency_trackers[operation]
+    hedge_delay = tracker.hedge_delay() if hedge else None
+    started = loop.time()
+    ends = started + timeout
+    attempts: Dict[asyncio.Future, float] = {asyncio.ensure_future(start()): started}
+    hedge_task = None
+    last_error: Optional[BaseException] = None
+
+    try:
+        while attempts:
+            wait = ends - loop.time()
+            if hedge_delay is not None and hedge_task is None:
+                wait = min(wait, started + hedge_delay - loop.time())
+            if wait > 0:
+                done, _ = await asyncio.wait(attempts, timeout=wait, return_when=asyncio.FIRST_COMPLETED)
+            else:
+                done = {task for task in attempts if task.done()}
+
+            for task in done:
+                attempt_started = attempts.pop(task)
+                if task.exception() is None:
+                    tracker.record(loop.time() - attempt_started)
+                    if task is hedge_task:
+                        _counts[operation]["hedge_wins"] += 1
+                    return task.result()
+                last_error = task.exception()
+
+            if loop.time() >= ends:
+                break
+            if hedge_delay is not None and hedge_task is None and loop.time() >= started + hedge_delay:
+                hedge_task = asyncio.ensure_future(start())
+                attempts[hedge_task] = loop.time()
+                _counts[operation]["hedges"] += 1
+                _counts[operation]["attempts"] += 1
+
+        if last_error is not None and not attempts:
+            raise last_error
+        raise LLMTimeoutError(f"{operation} timed out after {timeout:g}s")
+    finally:
+        for task in attempts:
+            task.cancel()
+        for task in attempts:
+            try:
+                result = await task
+            except BaseException:
+                continue
+            if discard is not None:
+                await discard(result)  # Finished while being cancelled
+
+
+async def call_with_retries(
+    make_call: Callable[[], Awaitable],
+    operation: str,
+    priority: PriorityLike,
+    deadline: Deadline,
+    attempt_timeout: float,
+    hedge: bool = False,
+) -> Any:
+    """
+    Await a model call, retrying transient failures and optionally hedging it.
+
+    Args:
+        make_call: Returns a fresh, not yet awaited call for each attempt
+        operation: Name used for latency tracking, metrics and errors
+        priority: Scheduling class of every attempt, or a function returning it
+            (read again when each attempt is admitted)
+        deadline: Budget shared with the endpoint's other model calls
+        attempt_timeout: Upper bound for a single attempt in seconds
+        hedge: Send a second request if the first is slower than the p95;
+            only for calls that are safe to send twice
+
+    Raises:
+        LLMTimeoutError: The budget ran out before any attempt succeeded
+    """
+    _counts[operation]["calls"] += 1
+    retry = 0
+    while True:
+        timeout = deadline.attempt_timeout(attempt_timeout, operation)
+        _counts[operation]["attempts"] += 1
+        try:
+            return await _race(
+                lambda: with_deadline(make_call(), timeout, operation, priority),
+                operation,
+                timeout,
+                hedge and HEDGE_REQUESTS,
+            )
+        except Exception as error:
+            retry += 1
+            delay = _can_retry(error, retry, deadline, operation)
+            if delay is None:
+                _counts[operation]["failures"] += 1
+                raise
+            _counts[operation]["retries"] += 1
+            print(f"[LLM] {operation} attempt {retry} failed ({type(error).__name__}: {error}), retrying in {delay:.2f}s")
+            await asyncio.sleep(delay)
+
+
+_EMPTY = object()
+
+
+async def _first_chunk(make_stream: Callable[[], Tuple[Any, AsyncIterator]]) -> Tuple[Any, AsyncIterator, Any]:
+    handle, stream = make_stream()
+    try:
+        first = await stream.__anext__()
+    except StopAsyncIteration:
+        first = _EMPTY
+    except BaseException:
+        await stream.aclose()
+        raise
+    return handle, stream, first
+
+
+async def _discard_stream(opened: Tuple[Any, AsyncIterator, Any]):
+    await opened[1].aclose()
+
+
+async def _resume(stream: AsyncIterator, first: Any) -> AsyncIterator:
+    try:
+        if first is _EMPTY:
+            return
+        yield first
+        async for item in stream:
+            yield item
+    finally:
+        await stream.aclose()
+
+
+async def open_stream(
+    make_stream: Callable[[], Tuple[Any, AsyncIterator]],
+    operation: str,
+    deadline: Deadline,
+    first_chunk_timeout: float,
+    hedge: bool = False,
+) -> Tuple[Any, AsyncIterator]:
+    """
+    Open a model stream, retrying or hedging until its first chunk arrives.
+
+    Args:
+        make_stream: Opens a new attempt and returns ``(handle, stream)``; the
+            handle (e.g. the chat session the stream belongs to) is returned
+            for the winning attempt
+        operation: Name used for latency tracking, metrics and errors
+        deadline: Budget shared with the endpoint's other model calls
+        first_chunk_timeout: Upper bound for one attempt's time to first chunk
+        hedge: Open a second stream if the first chunk is slower than the p95
+
+    Returns:
+        The winning handle and its stream, starting with the first chunk
+    """
+    _counts[operation]["calls"] += 1
+    retry = 0
+    while True:
+        timeout = deadline.attempt_timeout(first_chunk_timeout, operation)
+        _counts[operation]["attempts"] += 1
+        try:
+            handle, stream, first = await _race(
+                lambda: asyncio.wait_for(_first_chunk(make_stream), timeout),
+                operation,
+                timeout,
+                hedge and HEDGE_REQUESTS,
+                discard=_discard_stream,
+            )
+            return handle, _resume(stream, first)
+        except asyncio.TimeoutError:
+            error = LLMTimeoutError(f"{operation} produced no output within {timeout:g}s")
+        except Exception as failure:
+            error = failure
+        retry += 1
+        delay = _can_retry(error, retry, deadline, operation)
+        if delay is None:
+            _counts[operation]["failures"] += 1
+            raise error
+        _counts[operation]["retries"] += 1
+        print(f"[LLM] {operation} attempt {retry} failed ({type(error).__name__}: {error}), retrying in {delay:.2f}s")
+        await asyncio.sleep(delay)
+
+
+def resilience_stats() -> Dict[str, Dict[str, Any]]:
+    stats = {}
+    for operation, counts in _counts.items():
+        tracker = latency_trackers[operation]
+        p50, p95 = tracker.percentile(50), tracker.percentile(95)
+        stats[operation] = {
+            **counts,
+            "latency_p50_ms": round(p50 * 1000, 1) if p50 is not None else None,
+            "latency_p95_ms": round(p95 * 1000, 1) if p95 is not None else None,
+        }
+    return stats
@@ -0,0 +1,159 @@
+"""
+Server-sent events writer for streamed chat responses.
+
+``sse_frames`` turns an async iterator of event dicts into SSE frames:
+
+- consecutive text-only events (``{"content": ...}``) are coalesced into one
+  frame, sent once it reaches ``SSE_FLUSH_CHARS`` or ``SSE_FLUSH_INTERVAL``
+  seconds after its first part; the first text of a response goes out at once
+  so time to first token is unchanged
+- any other event (tool notices, action cards, done, errors) flushes pending
+  text and goes out as its own frame, so ordering is preserved
+- a comment frame is sent after ``SSE_HEARTBEAT_INTERVAL`` idle seconds, so
+  proxies and browsers keep the connection open while tools run
+- every ``SSE_DISCONNECT_POLL`` seconds the client connection is checked; when
+  it is gone, the producer is cancelled, which closes the upstream model stream
+  and cancels tool calls that are still waiting for a worker
+
+The producer runs as its own task and hands events over through a bounded
+queue, so a slow client pauses it instead of buffering the whole response.
+"""
+import asyncio
+import json
+import os
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict
+
+SSE_FLUSH_CHARS = int(os.getenv("SSE_FLUSH_CHARS", "200"))
+SSE_FLUSH_INTERVAL = float(os.getenv("SSE_FLUSH_INTERVAL", "0.05"))
+SSE_HEARTBEAT_INTERVAL = float(os.getenv("SSE_HEARTBEAT_INTERVAL", "15"))
+SSE_DISCONNECT_POLL = float(os.getenv("SSE_DISCONNECT_POLL", "1"))
+
+# Events buffered between the producer and the client
+_EVENT_BUFFER = 64
+
+HEARTBEAT = ": keep-alive\n\n"
+
+_END = object()
+
+_counts: Dict[str, int] = dict.fromkeys(("streams", "events", "frames", "heartbeats", "disconnects"), 0)
+
+
+class _Failure:
+    def __init__(self, error: Exception):
+        self.error = error
+
+
+def sse_event(data: Dict[str, Any]) -> str:
+    """One SSE data frame carrying ``data`` as JSON."""
+    return f"data: {json.dumps(data)}\n\n"
+
+
+def _is_text(event: Dict[str, Any]) -> bool:
+    return event.keys() == {"content"}
+
+
+async def sse_frames(
+    events: AsyncIterator[Dict[str, Any]],
+    is_disconnected: Callable[[], Awaitable[bool]],
+) -> AsyncIterator[str]:
+    """
+    Write an event stream as coalesced SSE frames with heartbeats.
+
+    Args:
+        events: Event dicts to send, in order; cancelled if the client goes away
+        is_disconnected: Reports whether the client has gone away
+            (``Request.is_disconnected``)
+
+    Yields:
+        SSE frames ready to send
+    """
+    loop = asyncio.get_running_loop()
+    queue: asyncio.Queue = asyncio.Queue(maxsize=_EVENT_BUFFER)
+
+    async def produce():
+        try:
+            async for event in events:
+                await queue.put(event)
+        except Exception as error:
+            await queue.put(_Failure(error))
+        finally:
+            # Also runs the generator's cleanup when cancelled while it waits on a full queue
+            await events.aclose()
+        await queue.put(_END)
+
+    producer = asyncio.ensure_future(produce())
+    _counts["streams"] += 1
+    pending = []
+    pending_chars = 0
+    flush_at = None
+    sent_text = False
+    now = loop.time()
+    last_sent = now
+    next_poll = now + SSE_DISCONNECT_POLL
+
+    def flush() -> str:
+        nonlocal flush_at, last_sent, sent_text, pending_chars
+        frame = sse_event({"content": "".join(pending)})
+        pending.clear()
+        pending_chars = 0
+        flush_at = None
+        sent_text = True
+        last_sent = loop.time()
+        _counts["frames"] += 1
+        return frame
+
+    try:
+        while True:
+            wake_at = min(last_sent + SSE_HEARTBEAT_INTERVAL, next_poll)
+            if flush_at is not None:
+                wake_at = min(wake_at, flush_at)
+            try:
+                event = await asyncio.wait_for(queue.get(), max(0.0, wake_at - loop.time()))
+            except asyncio.TimeoutError:
+                event = None
+
+            now = loop.time()
+            if now >= next_poll:
+                next_poll = now + SSE_DISCONNECT_POLL
+                if await is_disconnected():
+                    _counts["disconnects"] += 1
+                    print("[SSE] Client disconnected, cancelling the stream")
+                    return
+
+            if event is _END:
+                if pending:
+                    yield flush()
+                return
+            if isinstance(event, _Failure):
+                raise event.error
+            if event is not None:
+                _counts["events"] += 1
+                if _is_text(event):
+                    if event["content"]:
+                        pending.append(event["content"])
+                        pending_chars += len(event["content"])
+                        if flush_at is None:
+                            flush_at = now + SSE_FLUSH_INTERVAL
+                        if not sent_text or pending_chars >= SSE_FLUSH_CHARS:
+                            yield flush()
+                else:
+                    if pending:
+                        yield flush()
+                    last_sent = loop.time()
+                    _counts["frames"] += 1
+                    yield sse_event(event)
+
+            if flush_at is not None and loop.time() >= flush_at:
+                yield flush()
+            elif loop.time() - last_sent >= SSE_HEARTBEAT_INTERVAL:
+                last_sent = loop.time()
+                _counts["heartbeats"] += 1
+                yield HEARTBEAT
+    finally:
+        # Stops the upstream model stream and any tool calls still waiting to run
+        producer.cancel()
+        await asyncio.gather(producer, return_exceptions=True)
+
+
+def sse_stats() -> Dict[str, int]:
+    return dict(_counts)
@@ -0,0 +1,176 @@
+"""
+Bridge blocking iterators (the Gemini SDK's streaming responses) into async code.
+
+``iterate_in_thread`` pulls from the iterator on a worker thread and hands items
+to the event loop through a bounded ``asyncio.Queue``:
+
+- the event loop never waits on the network, so other SSE clients keep flowing
+- a full queue blocks the worker thread, so a slow client throttles the upstream
+  read instead of buffering the whole response in memory
+- when the consumer stops early (client disconnect, cancellation, error) the
+  worker stops at the next item and closes the iterator
+
+A worker that is stuck inside the SDK cannot be interrupted, so an attempt that
+timed out may still finish on its thread later. ``open_chat_stream`` therefore
+sends every attempt on its own chat session.
+"""
+import asyncio
+import concurrent.futures
+import os
+import threading
+from typing import Any, AsyncIterator, Callable, Iterable, Optional, Tuple
+
+from services.executor import BoundedExecutor
+from services.llm import LLMTimeoutError, Priority, llm_scheduler
+from services.resilience import Deadline, open_stream
+
+# Each open stream holds one thread while the model is generating
+stream_executor = BoundedExecutor(
+    "stream",
+    max_workers=int(os.getenv("STREAM_POOL_SIZE", "64")),
+    max_queue=int(os.getenv("STREAM_MAX_QUEUE", "256")),
+)
+
+# Chunks buffered between the upstream reader and the client
+STREAM_BUFFER = int(os.getenv("STREAM_BUFFER", "32"))
+
+# How often a blocked worker re-checks whether the consumer has gone away
+_STOP_POLL_SECONDS = 0.1
+
+_ITEM, _DONE, _ERROR = range(3)
+
+
+async def iterate_in_thread(
+    make_iterator: Callable[[], Iterable],
+    executor: BoundedExecutor = stream_executor,
+    max_buffer: int = STREAM_BUFFER,
+    idle_timeout: Optional[float] = None,
+) -> AsyncIterator:
+    """
+    Iterate a blocking iterable without blocking the event loop.
+
+    Args:
+        make_iterator: Called on the worker thread to open the stream (the
+            request that starts a stream blocks too)
+        executor: Pool whose threads pump the stream
+        max_buffer: Items read ahead of the consumer before the worker waits
+        idle_timeout: Seconds to wait for the next item before giving up
+
+    Raises:
+        LLMTimeoutError: No item arrived within idle_timeout
+    """
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue(maxsize=max(1, max_buffer))
+    stop = threading.Event()
+
+    def put(kind, value) -> bool:
+        """Hand an item to the loop, waiting while the queue is full. False once the consumer is gone."""
+        try:
+            future = asyncio.run_coroutine_threadsafe(queue.put((kind, value)), loop)
+        except RuntimeError:
+            return False  # Event loop closed
+        while True:
+            try:
+                future.result(timeout=_STOP_POLL_SECONDS)
+                return True
+            except concurrent.futures.TimeoutError:
+                if stop.is_set():
+                    future.cancel()
+                    return False
+            except concurrent.futures.CancelledError:
+                return False
+
+    def pump():
+        iterator = None
+        try:
+            iterator = iter(make_iterator())
+            for item in iterator:
+                if stop.is_set() or not put(_ITEM, item):
+                    return
+            put(_DONE, None)
+        except BaseException as error:
+            if not stop.is_set():
+                put(_ERROR, error)
+        finally:
+            close = getattr(iterator, "close", None)
+            if close is not None:
+                close()
+
+    task = asyncio.ensure_future(executor.run(pump))
+    task.add_done_callback(lambda t: t.cancelled() or t.exception())
+    try:
+        while True:
+            try:
+                kind, value = await asyncio.wait_for(queue.get(), idle_timeout)
+            except asyncio.TimeoutError:
+                raise LLMTimeoutError(f"Stream produced nothing for {idle_timeout:g}s") from None
+            if kind == _DONE:
+                return
+            if kind == _ERROR:
+                raise value
+            yield value
+    finally:
+        # Tell the worker to stop; it notices at its next item or queue wait
+        stop.set()
+
+
+async def stream_model(
+    make_iterator: Callable[[], Iterable],
+    priority: Priority,
+    timeout: float,
+) -> AsyncIterator:
+    """
+    Stream a model response through ``iterate_in_thread``, holding a scheduler slot until it ends.
+
+    Args:
+        make_iterator: Opens the SDK stream (called on the worker thread)
+        priority: Scheduling class the stream is admitted under
+        timeout: Seconds to wait for admission, and for each chunk
+    """
+    async with llm_scheduler.slot(priority, timeout=timeout):
+        stream = iterate_in_thread(make_iterator, idle_timeout=timeout)
+        try:
+            async for item in stream:
+                yield item
+        finally:
+            await stream.aclose()  # Stop the reader now rather than when the generator is collected
+
+
+async def open_chat_stream(
+    start_chat: Callable[[], Any],
+    message: Any,
+    deadline: Deadline,
+    timeout: float,
+    hedge: bool = False,
+    operation: str = "Chat stream",
+    **send_options,
+) -> Tuple[Any, AsyncIterator]:
+    """
+    Stream the reply to one chat message, retrying (or hedging) until its first chunk arrives.
+
+    Every attempt sends on a fresh session from ``start_chat``. The thread of an
+    attempt that timed out may still be in ``send_message`` and append to its
+    session's history when it returns; on a shared session that would interleave
+    with the retry's send.
+
+    Args:
+        start_chat: Returns a new chat session holding the conversation so far
+        message: Content to send
+        deadline: Budget shared with the endpoint's other model calls
+        timeout: Upper bound for one attempt's time to first chunk
+        hedge: Open a second attempt if the first chunk is slower than the p95
+        operation: Name used for latency tracking, metrics and errors
+        **send_options: Passed to ``send_message`` (e.g. ``generation_config``)
+
+    Returns:
+        The winning attempt's chat session and its stream, starting with the first chunk
+    """
+    def start():
+        chat = start_chat()
+        return chat, stream_model(
+            lambda: chat.send_message(message, stream=True, **send_options),
+            Priority.INTERACTIVE,
+            deadline.attempt_timeout(timeout, operation),
+        )
+
+    return await open_stream(start, operation, deadline, timeout, hedge=hedge)
@@ -0,0 +1,21 @@
+"""
+Cheap, offline token estimates for prompt budgeting.
+
+Gemini's tokenizer is only reachable through the API, so budgets use the usual
+approximation of about four characters per token for English text.
+"""
+import math
+
+CHARS_PER_TOKEN = 4
+
+
+def estimate_tokens(text: str) -> int:
+    """Approximate number of model tokens in text."""
+    if not text:
+        return 0
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+
+def token_budget_chars(tokens: int) -> int:
+    """Approximate number of characters that fit in a token budget."""
+    return max(0, tokens) * CHARS_PER_TOKEN
@@ -0,0 +1,164 @@
+"""
+Per-user context for the chat stream: profile summary, document summaries and RAG context.
+
+The three lookups are independent, so ``prefetch_query_context`` runs them
+concurrently, each with its own timeout. A lookup that fails or runs late is
+replaced by a fallback and logged, so a slow Supabase query or retrieval delays
+the first token by at most its timeout and never fails the request.
+
+The user's profile summary, document summaries and the system prompt built from
+them are cached per user, so follow-up chat turns make no database round-trips.
+Whatever changes them (saving or deleting the profile, finishing a document
+extraction) calls ``invalidate_user_context``; the TTL bounds staleness from
+changes made outside this process.
+"""
+import asyncio
+import itertools
+import os
+import time
+from typing import Any, Awaitable, Callable, Dict, NamedTuple, Optional
+
+from auth import get_supabase_client
+from services.cache import LRUCache
+from services.executor import BoundedExecutor
+from services.rag_service import get_relevant_context
+from services.user_profile_service import get_user_profile_summary
+
+# Supabase client calls are blocking, so they run here
+db_executor = BoundedExecutor(
+    "db",
+    max_workers=int(os.getenv("DB_POOL_SIZE", "16")),
+    max_queue=int(os.getenv("DB_MAX_QUEUE", "256")),
+)
+
+# Per-lookup timeouts in seconds
+PROFILE_TIMEOUT = float(os.getenv("QUERY_PROFILE_TIMEOUT", "2"))
+DOCUMENTS_TIMEOUT = float(os.getenv("QUERY_DOCUMENTS_TIMEOUT", "2"))
+RAG_TIMEOUT = float(os.getenv("QUERY_RAG_TIMEOUT", "3"))
+
+PROFILE_FALLBACK = "User profile is temporarily unavailable; ask the user for details you need."
+
+# Lookups that failed or timed out are never cached
+_FAILED = object()
+
+
+class UserContext(NamedTuple):
+    profile_summary: str
+    document_summaries: str
+    prompt_prefix: str  # System prompt built from the two summaries
+
+
+class QueryContext(NamedTuple):
+    profile_summary: str
+    document_summaries: str
+    prompt_prefix: str
+    rag_context: str
+
+
+# A few KB of prompt per entry
+user_context_cache = LRUCache(
+    max_size=int(os.getenv("USER_CONTEXT_CACHE_SIZE", "1024")),
+    ttl=float(os.getenv("USER_CONTEXT_CACHE_TTL", "900")) or None,
+)
+
+# When each user's context was last invalidated, so a lookup that started before
+# the invalidation cannot cache what it read
+_epochs = itertools.count(1)
+_invalidated = LRUCache(max_size=max(1, user_context_cache.max_size))
+
+
+def invalidate_user_context(user_id: str) -> None:
+    """Drop the user's cached context; call after anything that changes their profile or documents."""
+    user_id = str(user_id)
+    user_context_cache.pop(user_id)
+    _invalidated.set(user_id, next(_epochs))
+
+
+def get_document_summaries(user_id: str) -> str:
+    """Summaries of the user's extracted documents, formatted for the prompt ("" if none)."""
+    supabase = get_supabase_client()
+    docs_result = supabase.table('user_uploaded_documents')\
+        .select('fileName, summary, extractionStatus')\
+        .eq('userId', str(user_id))\
+        .eq('extractionStatus', 'completed')\
+        .execute()
+
+    if not docs_result.data:
+        print("[CONTEXT] No document summaries found")
+        return ""
+
+    document_summaries = "\n\nUser's Financial Documents:\n"
+    for doc in docs_result.data:
+        if doc.get('summary'):
+            document_summaries += f"\n- {doc['fileName']}:\n{doc['summary']}\n"
+    print(f"[CONTEXT] Found {len(docs_result.data)} document summaries")
+    return document_summaries
+
+
+async def with_fallback(lookup: Awaitable, timeout: float, fallback: Any, name: str) -> Any:
+    """Await a lookup, returning ``fallback`` if it fails or takes longer than ``timeout`` seconds."""
+    started = time.perf_counter()
+    try:
+        return await asyncio.wait_for(lookup, timeout)
+    except asyncio.TimeoutError:
+        print(f"[CONTEXT] {name} timed out after {timeout:g}s, continuing without it")
+    except Exception as error:
+        print(f"[CONTEXT] {name} failed after {time.perf_counter() - started:.2f}s: {error}")
+    return fallback
+
+
+async def _load_user_context(user_id: str, build_prompt_prefix: Callable[[str, str], str]) -> UserContext:
+    """The user's cached context, or fetch both summaries concurrently and cache them if both succeeded."""
+    key = str(user_id)
+    cached = user_context_cache.get(key)
+    if cached is not None:
+        return cached
+
+    epoch = next(_epochs)
+    profile_summary, document_summaries = await asyncio.gather(
+        with_fallback(db_executor.run(get_user_profile_summary, user_id), PROFILE_TIMEOUT, _FAILED, "Profile"),
+        with_fallback(db_executor.run(get_document_summaries, user_id), DOCUMENTS_TIMEOUT, _FAILED, "Documents"),
+    )
+    complete = profile_summary is not _FAILED and document_summaries is not _FAILED
+    if profile_summary is _FAILED:
+        profile_summary = PROFILE_FALLBACK
+    if document_summaries is _FAILED:
+        document_summaries = ""
+
+    context = UserContext(
+        profile_summary,
+        document_summaries,
+        build_prompt_prefix(profile_summary, document_summaries),
+    )
+    invalidated = _invalidated.get(key)
+    if complete and (invalidated is None or invalidated < epoch):
+        user_context_cache.set(key, context)
+    return context
+
+
+async def prefetch_query_context(
+    user_id: str,
+    rag_answers: Optional[Dict],
+    build_prompt_prefix: Callable[[str, str], str],
+) -> QueryContext:
+    """
+    Fetch the user's context (cached per user) and the RAG context concurrently.
+
+    Args:
+        user_id: The signed-in user
+        rag_answers: Questionnaire-style answers to retrieve guidance for; no
+            retrieval when None
+        build_prompt_prefix: Builds the system prompt from the profile and
+            document summaries; its result is cached with them
+
+    Returns:
+        QueryContext with a fallback in place of any lookup that failed or timed out
+    """
+    started = time.perf_counter()
+    rag_lookup = get_relevant_context(rag_answers) if rag_answers else asyncio.sleep(0, "")
+    user_context, rag_context = await asyncio.gather(
+        _load_user_context(user_id, build_prompt_prefix),
+        with_fallback(rag_lookup, RAG_TIMEOUT, "", "RAG context"),
+    )
+    print(f"[CONTEXT] Prefetched query context in {(time.perf_counter() - started) * 1000:.0f} ms")
+    return QueryContext(*user_context, rag_context)
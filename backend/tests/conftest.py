@@ -0,0 +1,17 @@
+import os
+import sys
+
+# Tests import the backend modules the way main.py does (``services.…``)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Models come from the local fake and settings need placeholder values; nothing
+# here talks to Google or Supabase
+os.environ.setdefault("LLM_BACKEND", "fake")
+for name, value in {
+    "GOOGLE_API_KEY": "test",
+    "SUPABASE_URL": "http://localhost",
+    "SUPABASE_KEY": "test.test.test",  # The client only checks that it looks like a JWT
+    "SUPABASE_JWT_SECRET": "test",
+    "WORKER_URL": "http://localhost",
+}.items():
+    os.environ.setdefault(name, value)
@@ -0,0 +1,40 @@
+import asyncio
+
+from services.chat_sessions import ChatSessionStore
+
+
+def test_seed_history_drops_the_current_message():
+    store = ChatSessionStore(db_path=None)
+    history = [
+        {"role": "user", "content": "first"},
+        {"role": "assistant", "content": "answer"},
+        {"role": "user", "content": "second"},
+    ]
+
+    async def scenario():
+        session = await store.open(None, "u1", "query", history, "second")
+        await store.record_turn(session, "second", "reply")
+        return session
+
+    session = asyncio.run(scenario())
+
+    assert [message["parts"][0] for message in session.messages] == ["first", "answer", "second", "reply"]
+
+
+def test_turns_are_shared_between_workers_through_sqlite(tmp_path):
+    db_path = str(tmp_path / "sessions.db")
+    first, second = ChatSessionStore(db_path=db_path), ChatSessionStore(db_path=db_path)
+
+    async def scenario():
+        session = await first.open(None, "u1", "query")
+        await first.record_turn(session, "hello", "hi")
+        # The next message lands on another worker
+        elsewhere = await second.open(session.session_id, "u1", "query", message="and now?")
+        assert elsewhere.session_id == session.session_id
+        await second.record_turn(elsewhere, "and now?", "this")
+        # Back on the first worker, whose in-memory copy is now behind
+        return await first.get(session.session_id, "u1", "query")
+
+    session = asyncio.run(asyncio.wait_for(scenario(), timeout=10))
+
+    assert [message["parts"][0] for message in session.messages] == ["hello", "hi", "and now?", "this"]
@@ -0,0 +1,99 @@
+import asyncio
+
+from services.llm import Priority, llm_scheduler
+from services.plan_jobs import PlanJobQueue
+
+ANSWERS = {"aboutYou": "Student", "income": "0–36,000", "savings": "0", "riskTolerance": "Low"}
+
+
+def test_joining_a_running_background_job_raises_its_priority():
+    async def scenario():
+        seen = []
+        attempt_failed = asyncio.Event()
+        retry = asyncio.Event()
+
+        async def generate(user_answers, priority):
+            # First attempt runs at the priority the worker started it with
+            seen.append(priority())
+            attempt_failed.set()
+            await retry.wait()
+            # The retry reads the job's priority again
+            seen.append(priority())
+            return {"situation": "ok"}
+
+        jobs = PlanJobQueue(generate, workers=1, max_queue=4)
+        assert jobs.submit("user-1", ANSWERS)
+        await asyncio.wait_for(attempt_failed.wait(), timeout=1)
+
+        joined = asyncio.ensure_future(jobs.get_plan("user-1", ANSWERS))
+        await asyncio.sleep(0)
+        retry.set()
+        plan = await asyncio.wait_for(joined, timeout=1)
+
+        assert plan == {"situation": "ok"}
+        assert seen == [Priority.BACKGROUND, Priority.PLAN]
+        assert jobs.stats()["joined"] == 1
+
+    asyncio.run(asyncio.wait_for(scenario(), timeout=5))
+
+
+def test_joined_job_waiting_for_admission_moves_to_the_plan_class():
+    async def scenario():
+        background_limit = llm_scheduler.limits[Priority.BACKGROUND]
+        release = asyncio.Event()
+        holding = 0
+
+        async def hold_background_slot():
+            nonlocal holding
+            async with llm_scheduler.slot(Priority.BACKGROUND):
+                holding += 1
+                await release.wait()
+
+        # Every background slot is taken, so a background call has to wait
+        holders = [asyncio.ensure_future(hold_background_slot()) for _ in range(background_limit)]
+        while holding < background_limit:
+            await asyncio.sleep(0)
+
+        admitted_as = []
+
+        async def generate(user_answers, priority):
+            async with llm_scheduler.slot(priority):
+                admitted_as.append(priority())
+            return {"situation": "ok"}
+
+        jobs = PlanJobQueue(generate, workers=1, max_queue=4)
+        jobs.submit("user-1", ANSWERS)
+        for _ in range(10):
+            await asyncio.sleep(0)
+        assert admitted_as == []  # Queued behind the background calls
+
+        plan = await asyncio.wait_for(jobs.get_plan("user-1", ANSWERS), timeout=1)
+
+        assert plan == {"situation": "ok"}
+        assert admitted_as == [Priority.PLAN]
+        release.set()
+        await asyncio.gather(*holders)
+
+    asyncio.run(asyncio.wait_for(scenario(), timeout=5))
+
+
+def test_a_job_started_by_get_plan_is_not_run_again_by_a_worker():
+    async def scenario():
+        calls = []
+
+        async def generate(user_answers, priority):
+            calls.append(priority())
+            await asyncio.sleep(0.01)
+            return {"situation": "ok"}
+
+        jobs = PlanJobQueue(generate, workers=2, max_queue=4)
+        jobs.submit("user-1", ANSWERS)
+        # Promoted before any worker has had a chance to dequeue it
+        plan = await asyncio.wait_for(jobs.get_plan("user-1", ANSWERS), timeout=1)
+        for _ in range(10):
+            await asyncio.sleep(0)
+
+        assert plan == {"situation": "ok"}
+        assert calls == [Priority.PLAN]
+
+    asyncio.run(asyncio.wait_for(scenario(), timeout=5))
@@ -0,0 +1,21 @@
+from services.rag_index import chunk_text
+
+PLAYBOOK = (
+    "## Big section\n\n"
+    "### Part one\n" + "word " * 80 + "\n\n"
+    "### Part two\nshort text here.\n\n"
+    "## Next\nmore\n"
+)
+
+
+def test_chunks_stay_within_the_budget_including_their_header_prefix():
+    for chunk_size in (60, 100, 250):
+        chunks = chunk_text(PLAYBOOK, chunk_size, 20)
+        assert max(len(chunk) for chunk in chunks) <= chunk_size
+
+
+def test_a_section_header_is_not_a_chunk_of_its_own():
+    chunks = chunk_text(PLAYBOOK, 100, 20)
+
+    assert "## Big section" not in chunks
+    assert chunks[0].startswith("## Big section\n### Part one\n")
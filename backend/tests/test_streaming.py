@@ -0,0 +1,72 @@
+import asyncio
+import threading
+
+from services.resilience import Deadline
+from services.streaming import open_chat_stream
+
+
+class HangingModel:
+    """Chat model whose first send blocks its thread until released, like a stuck SDK call."""
+
+    def __init__(self):
+        self.release = threading.Event()
+        self.finished = threading.Event()
+        self.sessions = []
+
+    def start_chat(self, history):
+        session = HangingChat(self, history)
+        self.sessions.append(session)
+        return session
+
+
+class HangingChat:
+    def __init__(self, model, history):
+        self.model = model
+        self.history = list(history)
+
+    def send_message(self, content, stream=False, **kwargs):
+        attempt = self.model.sessions.index(self)
+        if attempt == 0:
+            self.model.release.wait(timeout=5)
+        # Like the SDK, the session records the exchange once the call returns
+        self.history.append(content)
+
+        def chunks():
+            try:
+                yield f"reply {attempt}"
+                self.history.append(f"reply {attempt}")
+            finally:
+                if attempt == 0:
+                    self.model.finished.set()
+
+        return chunks()
+
+
+def test_retry_after_a_hung_attempt_uses_its_own_session():
+    async def scenario():
+        model = HangingModel()
+        turn_history = ["question", "function call"]
+
+        chat, stream = await open_chat_stream(
+            lambda: model.start_chat(turn_history),
+            "tool results",
+            Deadline(5),
+            0.2,
+            operation="Test chat stream",
+        )
+        replies = [chunk async for chunk in stream]
+
+        # The first attempt timed out and the second one won
+        assert len(model.sessions) == 2
+        assert chat is model.sessions[1]
+        assert replies == ["reply 1"]
+        assert chat.history == ["question", "function call", "tool results", "reply 1"]
+
+        # The abandoned attempt finishes later, writing only into its own session
+        model.release.set()
+        assert await asyncio.get_running_loop().run_in_executor(None, model.finished.wait, 5)
+        assert model.sessions[0].history == ["question", "function call", "tool results"]
+        assert chat.history == ["question", "function call", "tool results", "reply 1"]
+        assert turn_history == ["question", "function call"]
+
+    asyncio.run(asyncio.wait_for(scenario(), timeout=10))